@@ -0,0 +1,117 @@
+# Licensed under the terms of the GNU-GPL-3.0
+
+"""
+A content-addressed on-disk cache for intermediate traces.
+
+A :class:`TraceCache` stores :class:`dpa.preprocessor.Buffer` objects under
+a key, which is typically derived from the content of the input trace and
+the configuration of all processors that produced the buffer (see
+:meth:`dpa.workflow.DPAWorkflow.process`). Changing any processor parameter
+thus changes the key of its output and of all outputs depending on it.
+
+The total size of the cache is limited. If it is exceeded, the least
+recently used entries are removed, for example::
+
+  cache = TraceCache("/tmp/dpa-cache", max_size=1 << 30)
+  key = digest(trace, "Normalize(...)")
+  cache.put(key, buf)
+  buf = cache.get(key) # None if the entry has been evicted
+"""
+import os
+import struct
+import hashlib
+import thread
+import threading
+
+from preprocessor import map_file
+
+header = struct.Struct("=4sI")
+MAGIC = "DPAC"
+
+def digest(*parts):
+	"returns the hex sha1 digest of the strings or buffers in *parts*"
+	h = hashlib.sha1()
+	for part in parts:
+		h.update(part)
+	return h.hexdigest()
+
+class TraceCache:
+	"""
+	TraceCache(path, max_size=1 << 30)
+
+	opens (or creates) the cache in directory *path*, limited to *max_size* bytes
+	"""
+	def __init__(self, path, max_size=1 << 30):
+		self.path = path
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.size = sum(size for mtime, size, name in self._entries())
+
+	def _entries(self):
+		for root, dirs, files in os.walk(self.path):
+			for f in files:
+				name = os.path.join(root, f)
+				try:
+					st = os.stat(name)
+				except OSError: #removed concurrently
+					continue
+				yield st.st_mtime, st.st_size, name
+
+	def _filename(self, key):
+		return os.path.join(self.path, key[:2], key + ".dat")
+
+	def get(self, key):
+		"""
+		returns the :class:`dpa.preprocessor.Buffer` stored under *key* or None
+
+		The buffer is memory-mapped read-only.
+		"""
+		name = self._filename(key)
+		try:
+			with open(name, "rb") as f:
+				magic, type = header.unpack(f.read(header.size))
+			os.utime(name, None) #mark as recently used
+		except (IOError, OSError, struct.error):
+			return None
+		if magic != MAGIC:
+			return None
+		return map_file(name, type, offset=header.size)
+
+	def put(self, key, buf):
+		"stores the :class:`dpa.preprocessor.Buffer` *buf* under *key*"
+		name = self._filename(key)
+		if not os.path.isdir(os.path.dirname(name)):
+			try:
+				os.makedirs(os.path.dirname(name))
+			except OSError: #created concurrently
+				pass
+		tmp = "%s.%d.%d.tmp" % (name, os.getpid(), thread.get_ident())
+		with open(tmp, "wb") as f:
+			f.write(header.pack(MAGIC, buf.get_type()))
+			f.write(memoryview(buf))
+		os.rename(tmp, name)
+		with self.lock:
+			self.size += header.size + len(buf) * (buf.get_type() & 0xf)
+			full = self.size > self.max_size
+		if full:
+			self.evict(self.max_size * 9 / 10)
+
+	def evict(self, size=0):
+		"removes the least recently used entries until the cache is smaller than *size* bytes"
+		with self.lock:
+			entries = sorted(self._entries())
+			self.size = sum(e[1] for e in entries)
+			for mtime, length, name in entries:
+				if self.size <= size:
+					break
+				try:
+					os.unlink(name)
+				except OSError:
+					pass
+				self.size -= length
+
+	def clear(self):
+		"removes all entries"
+		self.evict(0)
@@ -79,6 +79,81 @@ def save_avg(out_path, avg, var):
 def init_record(record):
 	raster_config(record.get('trigger', 150), record.get('pause_trigger', 1100), record.get('min_pause', 0), record.get('max_pause', 0), record.get('header_size', 128))
 
+def _parse_cpu_list(text):
+	"parses a cpu list like ``0-3,8,10-11`` into a list of cpu numbers"
+	cpus = []
+	for part in text.strip().split(','):
+		if '-' in part:
+			start, stop = part.split('-')
+			cpus.extend(xrange(int(start), int(stop) + 1))
+		elif part:
+			cpus.append(int(part))
+	return cpus
+
+def allowed_cpus():
+	"returns the list of cpus this process may run on according to its affinity mask"
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("Cpus_allowed_list:"):
+					return _parse_cpu_list(line.split(":", 1)[1])
+	except IOError:
+		pass
+	import multiprocessing
+	return range(multiprocessing.cpu_count())
+
+def _cgroup_cpu_limit():
+	"returns the cpu quota of the cgroup (v2 or v1) this process is in, or None"
+	try:
+		with open("/sys/fs/cgroup/cpu.max") as f:
+			quota, period = f.read().split()
+		if quota != "max":
+			return float(quota) / float(period)
+		return None
+	except (IOError, ValueError):
+		pass
+	try:
+		with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+			quota = int(f.read())
+		with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+			period = int(f.read())
+		if quota > 0 and period > 0:
+			return float(quota) / period
+	except (IOError, ValueError):
+		pass
+	return None
+
+def cpu_count():
+	"""
+	returns the number of cpus available to this process
+
+	Unlike :func:`multiprocessing.cpu_count` this respects the affinity mask
+	and cgroup cpu quotas (e.g. of containers)
+
+	>>> cpu_count() >= 1
+	True
+	"""
+	count = len(allowed_cpus())
+	limit = _cgroup_cpu_limit()
+	if limit is not None:
+		count = min(count, int(math.ceil(limit)))
+	return max(count, 1)
+
+def pin_to_cpu(cpu):
+	"""
+	restricts the calling thread to run on *cpu* only
+
+	returns False if the affinity could not be set
+	"""
+	import ctypes.util
+	libc = CDLL(ctypes.util.find_library("c"), use_errno=True)
+	mask = (c_ulong * 16)()
+	bits = sizeof(c_ulong) * 8
+	if cpu >= len(mask) * bits:
+		return False
+	mask[cpu / bits] = 1 << (cpu % bits)
+	return libc.sched_setaffinity(0, sizeof(mask), byref(mask)) == 0
+
 def show(buf):
 	"plots the contents of buf using matplotlib"
 	from matplotlib import pyplot
@@ -15,8 +15,9 @@ Further processors can be listed with::
   $ pydoc dpa.processors
 """
 import math
-import preprocessor
-from preprocessor import types, new_buffer
+import os, tempfile, hashlib
+import preprocessor, ttest
+from preprocessor import types
 
 class TraceProcessor(object):
 	"""
@@ -36,6 +37,8 @@ class TraceProcessor(object):
 	
 	max_size = 0
 	min_size = -1
+	#: outputs may be stored in the stage cache of a :class:`dpa.workflow.DPAWorkflow`
+	cacheable = True
 
 	def __init__(self, dst_type=types.void, ref=None, save=False, name=None):
 		self.dst_type = dst_type
@@ -53,12 +56,76 @@ class TraceProcessor(object):
 		self.max_size = max(self.max_size, len(buf))
 		self.min_size = min(self.min_size, len(buf))
 		return buf
+	def fuse(self, chain):
+		"""
+		appends the processing step to the :class:`dpa.preprocessor.Chain` *chain*
+
+		returns False if the processor cannot be executed as part of a chain
+		"""
+		return False
+	def get_profile(self):
+		"returns the statistics gathered by :meth:`profile` in a picklable form"
+		return self.min_size, self.max_size
+	def merge_profile(self, profile):
+		"adds statistics returned by :meth:`get_profile` of another instance to this one"
+		min_size, max_size = profile
+		if min_size >= 0:
+			self.min_size = min_size if self.min_size < 0 else min(self.min_size, min_size)
+		self.max_size = max(self.max_size, max_size)
+	def finish_profile(self):
+		"is called once the statistics of all profiled traces have been gathered or merged"
+		pass
+	@classmethod
+	def merges_profile(cls):
+		"""
+		returns whether :meth:`get_profile` and :meth:`merge_profile` cover the
+		statistics gathered by :meth:`profile`, so that profiling can be split
+		among processes. This is not the case if a subclass overrides
+		:meth:`profile` only.
+		"""
+		owner = lambda name: next(c for c in cls.__mro__ if name in vars(c))
+		profile = owner("profile")
+		if profile in (TraceProcessor, VoidProcessor): #only track the trace sizes
+			return True
+		return all(issubclass(owner(name), profile) for name in ("get_profile", "merge_profile"))
+	def get_config(self, processors=()):
+		"""
+		returns a description of the configuration of this processor, which
+		identifies its profiling results. References to other *processors*
+		are described by their index.
+		"""
+		def describe(v):
+			if isinstance(v, (int, long, float, str, bool, type(None))):
+				return v
+			if isinstance(v, (list, tuple)):
+				return [describe(x) for x in v]
+			if isinstance(v, dict):
+				return sorted((k, describe(x)) for k, x in v.items())
+			if isinstance(v, TraceProcessor):
+				return ("ref", processors.index(v)) if v in processors else v.get_config(processors)
+			if isinstance(v, preprocessor.Buffer):
+				return hashlib.sha1(memoryview(v).tobytes()).hexdigest()
+			return type(v).__name__
+		return (self.__class__.__name__, sorted((k, describe(v)) for k, v in vars(self).items()
+			if k not in ("res", "idx", "chain")))
 	def get_samples(self):
 		"returns the estimated number of samples of a output trace based on the profiling phase"
 		return self.max_size
 	def finalize(self):
 		"finishes pending tasks"
 		pass
+	def reset_state(self):
+		"""
+		discards accumulated results. This is called in each worker process of
+		a :class:`dpa.workflow.DPAWorkflow` before it processes its share of traces
+		"""
+		pass
+	def get_state(self):
+		"returns the results accumulated by :meth:`process` in a picklable form"
+		return None
+	def merge_state(self, state):
+		"adds results returned by :meth:`get_state` of another instance to this one"
+		pass
 	def __call__(self, p2, **kwargs):
 		return CombinedProcessor(self, p2, **kwargs)
 	def __str__(self):
@@ -67,18 +134,54 @@ class TraceProcessor(object):
 class CombinedProcessor(TraceProcessor):
 	"""
 	A helper class to provide the chaining functionality for a :class:`TraceProcessor`
+
+	If all processors of the chain are built-in ones (:class:`AvgScaleProcessor`,
+	:class:`IntegrateProcessor`, :class:`RectifyProcessor`, :class:`PeakProcessor`
+	and :class:`NormalizeProcessor`), the chain is executed as a single native
+	:class:`dpa.preprocessor.Chain` after profiling. This can be disabled with
+	the *fuse_chain* attribute.
 	"""
+	fuse_chain = True
 	def __init__(self, a, b, name = None):
 		self.a = a
 		self.b = b
 		self.ref = self.b.ref
 		self.save = self.a.save
 		self.name = name
+		self.chain = None
+	@property
+	def cacheable(self):
+		"the outputs are only cached if neither processor of the chain has side effects"
+		return self.a.cacheable and self.b.cacheable
 	def process(self, trace, idx=-1):
+		if self.fuse_chain:
+			if self.chain is None:
+				chain = preprocessor.Chain()
+				self.chain = chain if self.fuse(chain) else False
+			if self.chain and self.chain.accepts(trace.get_type()):
+				return self.chain.process(trace)
 		return self.a.process( self.b.process( trace, idx ), idx)
 	def profile(self, trace):
+		self.chain = None #parameters may change while profiling
 		buf_a = self.a.profile( self.b.profile( trace ) ) #make sure these get profiled indepently
 		return super(CombinedProcessor, self).profile( trace )
+	def fuse(self, chain):
+		return self.b.fuse(chain) and self.a.fuse(chain)
+	def get_profile(self):
+		return super(CombinedProcessor, self).get_profile(), self.a.get_profile(), self.b.get_profile()
+	def merge_profile(self, profile):
+		self.chain = None
+		super(CombinedProcessor, self).merge_profile(profile[0])
+		self.a.merge_profile(profile[1])
+		self.b.merge_profile(profile[2])
+	def reset_state(self):
+		self.a.reset_state()
+		self.b.reset_state()
+	def get_state(self):
+		return self.a.get_state(), self.b.get_state()
+	def merge_state(self, state):
+		self.a.merge_state(state[0])
+		self.b.merge_state(state[1])
 	def __str__(self):
 		return self.name if self.name else "%s(%s)" % (str(self.a), str(self.b))
 
@@ -97,6 +200,9 @@ class AvgScaleProcessor(TraceProcessor):
 		super(AvgScaleProcessor, self).__init__(**kwargs)
 	def process(self, trace, idx=-1):
 		return preprocessor.average(trace, n=self.count, scale=self.scale, signed_scale=False, dst_type=types.float)
+	def fuse(self, chain):
+		chain.average(self.count, scale=self.scale, dst_type=types.float)
+		return True
 	def __str__(self):
 		return super(AvgScaleProcessor, self).__str__() + "-%d-%d" % (self.count, self.scale)
 
@@ -107,6 +213,9 @@ class IntegrateProcessor(TraceProcessor):
 	def process(self, trace, idx=-1): 
 		buf = (preprocessor.integrate(trace, self.count, dst_type=self.dst_type))
 		return buf
+	def fuse(self, chain):
+		chain.integrate(self.count, dst_type=self.dst_type)
+		return True
 	def __str__(self):
 		return super(IntegrateProcessor, self).__str__() + "-%d" % self.count
 
@@ -133,15 +242,17 @@ class RasterizeProcessor(TraceProcessor):
 	*header_size*
 		number of samples to skip from the beginning of the trace
 
-	FIXME: there can only ever be one active configuration of this running at the same time
+	Each processor keeps its own configuration, so several of them can be used
+	in the same workflow.
 	"""
 	def __init__(self, edge, period, trigger=150, pause_trigger=1100, min_pause=0, max_pause=0, header_size=128, **kwargs):
-		preprocessor.set_raster_config(trigger, pause_trigger, min_pause, max_pause, header_size)
 		self.edge = edge
 		self.period = period
+		self.config = dict(trigger=trigger, pause_trigger=pause_trigger, min_pause=min_pause,
+			max_pause=max_pause, header_size=header_size)
 		super(RasterizeProcessor, self).__init__(**kwargs)
 	def process(self, trace, idx=-1):
-		return preprocessor.raster(trace, self.edge, self.period, dst_type=self.dst_type)
+		return preprocessor.raster(trace, self.edge, self.period, dst_type=self.dst_type, **self.config)
 
 class PeakProcessor(TraceProcessor):
 	"""
@@ -160,6 +271,11 @@ class PeakProcessor(TraceProcessor):
 		return preprocessor.peak_extract(trace, self.avg, self.var,
 			break_count=self.break_count, break_length=self.break_length,
 			dst_type=self.dst_type)
+	def fuse(self, chain):
+		if self.break_count or not self.avgs:
+			return False
+		chain.peak_extract(self.avg, self.var, dst_type=self.dst_type)
+		return True
 	def profile(self, trace):
 		avg, var, _min, _max = preprocessor.analyze(trace)
 		self.avgs.append(avg)
@@ -167,6 +283,15 @@ class PeakProcessor(TraceProcessor):
 		self.avg = sum(self.avgs) / len(self.avgs)
 		self.var = sum(self.vars) / len(self.vars)
 		return super(PeakProcessor, self).profile(trace)
+	def get_profile(self):
+		return super(PeakProcessor, self).get_profile(), self.avgs, self.vars
+	def merge_profile(self, profile):
+		super(PeakProcessor, self).merge_profile(profile[0])
+		self.avgs = self.avgs + profile[1]
+		self.vars = self.vars + profile[2]
+		if self.avgs:
+			self.avg = sum(self.avgs) / len(self.avgs)
+			self.var = sum(self.vars) / len(self.vars)
 
 class RectifyProcessor(TraceProcessor):
 	"""
@@ -177,11 +302,23 @@ class RectifyProcessor(TraceProcessor):
 		super(RectifyProcessor, self).__init__(*args, **kwargs)
 	def process(self, trace, idx=-1):
 		return preprocessor.rectify(trace, avg=self.avg, dst_type=self.dst_type)
+	def fuse(self, chain):
+		if not self.avgs:
+			return False
+		chain.rectify(self.avg, dst_type=self.dst_type)
+		return True
 	def profile(self, trace):
 		avg, tmp, tmp, tmp = preprocessor.analyze(trace, include_variance=False)
 		self.avgs.append(avg)
 		self.avg = sum(self.avgs) / len(self.avgs)
 		return super(RectifyProcessor, self).profile(trace)
+	def get_profile(self):
+		return super(RectifyProcessor, self).get_profile(), self.avgs
+	def merge_profile(self, profile):
+		super(RectifyProcessor, self).merge_profile(profile[0])
+		self.avgs = self.avgs + profile[1]
+		if self.avgs:
+			self.avg = sum(self.avgs) / len(self.avgs)
 
 class NormalizeProcessor(TraceProcessor):
 	"""
@@ -200,6 +337,11 @@ class NormalizeProcessor(TraceProcessor):
 	def process(self, trace, idx=-1):
 		#TODO casting to int might screw floaters. however this is an unlikely scenario
 		return preprocessor.normalize(trace, min=self.min, max=self.max, dst_type=self.dst_type)
+	def fuse(self, chain):
+		if self.min == -1 and self.max == 0: #not profiled
+			return False
+		chain.normalize(self.min, self.max, dst_type=self.dst_type)
+		return True
 	def profile(self, trace):
 		tmp, tmp, _min, _max = preprocessor.analyze(trace, include_variance=False)
 		if self.min == -1: self.min = _min
@@ -207,10 +349,144 @@ class NormalizeProcessor(TraceProcessor):
 		self.min = int(min(_min - 0.1 * diff, self.min))
 		self.max = int(max(_max + 0.1 * diff, self.max))
 		return super(NormalizeProcessor, self).profile(trace)
+	def get_profile(self):
+		return super(NormalizeProcessor, self).get_profile(), self.min, self.max
+	def merge_profile(self, profile):
+		super(NormalizeProcessor, self).merge_profile(profile[0])
+		_min, _max = profile[1:]
+		if _min == -1 and _max == 0: #not profiled
+			return
+		self.min = _min if self.min == -1 else min(self.min, _min)
+		self.max = max(self.max, _max)
+
+class SecondOrderProcessor(TraceProcessor):
+	"""
+	Combines pairs of samples to their centered products for second-order
+	attacks on masked implementations (see :func:`dpa.preprocessor.centered_product`)
+
+	The mean of each sample is determined in the profiling phase. Processors
+	referencing this one are profiled on products centered on the mean of
+	the traces profiled so far.
+
+	*pairs*
+		a list of sample index pairs or a :attr:`dpa.preprocessor.types.int32_t`
+		:class:`dpa.preprocessor.Buffer` holding the two indices of each pair
+		one after the other
+	*window*
+		instead of *pairs*, all pairs i < j of the samples of the window
+		(start, stop) or, if the window *other* is given, all pairs of i in
+		*window* and j in *other*. The pairs of each tile are generated when
+		needed (see :func:`dpa.preprocessor.window_pairs`).
+	*tile_size*
+		the number of pairs combined per output trace. The pairs are split
+		into :meth:`tiles` tiles, of which the one selected by :attr:`tile`
+		is processed. :meth:`correlate` covers all of them.
+	"""
+	#: the products are not stored in the stage cache, as they are at least
+	#: as large as the input traces
+	cacheable = False
+
+	def __init__(self, pairs=None, window=None, other=None, tile_size=0, **kwargs):
+		if pairs is not None and not isinstance(pairs, preprocessor.Buffer):
+			pairs = preprocessor.buffer_from_list(types.int32_t, [i for pair in pairs for i in pair])
+		self.pairs = pairs
+		self.window = window
+		self.other = other
+		if pairs is not None:
+			self.count = len(pairs) / 2
+			self.size = int(preprocessor.analyze(pairs, include_variance=False)[3]) + 1 if len(pairs) else 0
+		elif window is None:
+			raise Exception("either pairs or a window must be given")
+		elif other is None:
+			self.count = (window[1] - window[0]) * (window[1] - window[0] - 1) / 2
+			self.size = window[1]
+		else:
+			self.count = (window[1] - window[0]) * (other[1] - other[0])
+			self.size = max(window[1], other[1])
+		#: the index of the tile of pairs to process
+		self.tile = 0
+		self.tile_size = tile_size or self.count
+		self.counter = None
+		self.mean = None
+		self.profiled = 0
+		self.tile_pairs = None
+		kwargs.setdefault('dst_type', types.float)
+		super(SecondOrderProcessor, self).__init__(**kwargs)
+	def tiles(self):
+		"returns the number of tiles"
+		return (self.count + self.tile_size - 1) / self.tile_size
+	def get_tile(self, tile):
+		"returns the pairs of the given *tile*"
+		first = tile * self.tile_size
+		count = min(self.tile_size, self.count - first)
+		if self.pairs is not None:
+			return self.pairs.get_view(2 * first, 2 * (first + count))
+		return preprocessor.window_pairs(self.window[0], self.window[1], self.other, first=first, count=count)
+	def process(self, trace, idx=-1):
+		tile, pairs = self.tile_pairs or (None, None)
+		if tile != self.tile:
+			pairs = self.get_tile(self.tile)
+			self.tile_pairs = self.tile, pairs
+		return preprocessor.centered_product(trace, self.mean, pairs, dst_type=self.dst_type)
+	def profile(self, trace):
+		if self.counter is None:
+			self.counter = preprocessor.AverageCounter(self.size, types.double, generate_variance=False)
+		self.counter.add_trace(trace, length=self.size)
+		self.profiled += 1
+		if self.profiled & (self.profiled - 1) == 0: #refresh the mean after 1, 2, 4, ... traces
+			self.finish_profile()
+		return super(SecondOrderProcessor, self).profile(trace)
+	def get_profile(self):
+		return super(SecondOrderProcessor, self).get_profile(), self.counter
+	def merge_profile(self, profile):
+		super(SecondOrderProcessor, self).merge_profile(profile[0])
+		if profile[1] is None:
+			return
+		if self.counter is None:
+			self.counter = profile[1]
+		else:
+			self.counter.merge(profile[1])
+	def finish_profile(self):
+		"computes the mean of the profiled traces"
+		if self.counter is not None:
+			self.mean = self.counter.get_buf()[0]
+	def get_config(self, processors=()):
+		name, config = super(SecondOrderProcessor, self).get_config(processors)
+		return name, [(k, v) for k, v in config if k not in ("counter", "mean", "profiled", "tile_pairs")]
+	def correlate(self, workflow, correlator, callback):
+		"""
+		correlates all pairs in one pass over the traces of the
+		:class:`dpa.workflow.DPAWorkflow` *workflow* (which contains this
+		processor) per tile, so only the correlator of one tile is held at a time.
+		The traces are profiled once, with the first tile selected.
+
+		*correlator* is called with the number of pairs of a tile and returns a
+		preprocessed :class:`dpa.correlation.Correlator` for them. After each
+		pass ``callback(tile, correlator)`` is called.
+		"""
+		self.tile = 0
+		workflow._profile()
+		for tile in xrange(self.tiles()):
+			self.tile = tile
+			c = correlator(min(self.tile_size, self.count - tile * self.tile_size))
+			p = CorrelationProcessor(correlator=c, ref=self)
+			workflow.processors.append(p)
+			try:
+				workflow.process(profile=False)
+			finally:
+				workflow.processors.remove(p)
+			callback(tile, c)
+		self.tile = 0
 
 class VoidProcessor(TraceProcessor):
 	"Base class for processors not producing new traces"
-	pass
+	cacheable = False
+	def profile(self, trace):
+		"tracks the lengths of the input traces"
+		if self.min_size < 0:
+			self.min_size = len(trace)
+		self.min_size = min(self.min_size, len(trace))
+		self.max_size = max(self.max_size, len(trace))
 
 class AverageCountProcessor(VoidProcessor):
 	"""
@@ -234,13 +510,20 @@ class AverageCountProcessor(VoidProcessor):
 		super(AverageCountProcessor, self).__init__(**kwargs)
 	def process(self, trace, idx=-1):
 		if self.avg_counter is None:
-			self.avg_counter = preprocessor.AverageCounter(size=self.min_size, type=types.float)
+			self.avg_counter = preprocessor.AverageCounter(size=self.min_size, type=types.double)
 		self.avg_counter.add_trace(trace, length=min(self.min_size, len(trace)))
 		return trace
-	def profile(self, trace):
-		if self.min_size < 0:
-			self.min_size = len(trace)
-		self.min_size = min(self.min_size, len(trace))
+	def reset_state(self):
+		self.avg_counter = None
+	def get_state(self):
+		return self.avg_counter
+	def merge_state(self, state):
+		if state is None:
+			return
+		if self.avg_counter is None:
+			self.avg_counter = state
+		else:
+			self.avg_counter.merge(state)
 	def finalize(self):
 		"calculates the average and calls the *callback* function"
 		avg, var = self.avg_counter.get_buf()
@@ -259,6 +542,60 @@ class AverageCountProcessor(VoidProcessor):
 		preprocessor.write_file(name % "var", var)
 
 
+class TTestProcessor(VoidProcessor):
+	"""
+	Accumulates the traces of two groups (e.g. of fixed and of random inputs)
+	for Welch's t-test (TVLA), see :class:`dpa.ttest.TTest`
+
+	*group*
+		a sequence or a function mapping the index of a trace to its label
+	*labels*
+		the labels of the first and the second group. Processing a trace with
+		any other label raises an exception naming the trace.
+	*order*
+		the t-tests of the orders 1 to *order* are computed
+	*callback*
+		is called after processing finished as::
+
+		  callback(t, name)
+
+		where *t* is the list of the t-statistic buffers of each order
+	"""
+	callback = None
+	ttest    = None
+
+	def __init__(self, group, labels=(0, 1), order=1, callback=lambda t, **kwargs: 0, **kwargs):
+		self.group = group
+		self.labels = list(labels)
+		self.order = order
+		self.callback = callback
+		super(TTestProcessor, self).__init__(**kwargs)
+	def process(self, trace, idx=-1):
+		label = self.group(idx) if callable(self.group) else self.group[idx]
+		if label not in self.labels:
+			raise Exception("trace %d has the label %r, which is in neither group %r" % (idx, label, self.labels))
+		if self.ttest is None:
+			self.ttest = ttest.TTest(self.min_size, self.order)
+		self.ttest.add_trace(trace, self.labels.index(label), length=min(self.min_size, len(trace)))
+		return trace
+	def reset_state(self):
+		self.ttest = None
+	def get_state(self):
+		return self.ttest
+	def merge_state(self, state):
+		if state is None:
+			return
+		if self.ttest is None:
+			self.ttest = state
+		else:
+			self.ttest.merge(state)
+	def t(self):
+		"returns the t-statistic buffers of the orders 1 to *order*"
+		return [self.ttest.t(order) for order in xrange(1, self.order + 1)]
+	def finalize(self):
+		"calculates the t-statistics and calls the *callback* function"
+		self.callback(self.t(), name=str(self.ref))
+
 class CorrelationProcessor(VoidProcessor):
 	"""
 	Adds each processed trace to the correlation module
@@ -273,8 +610,19 @@ class CorrelationProcessor(VoidProcessor):
 		super(CorrelationProcessor, self).__init__(**kwargs)
 	def process(self, trace, idx=-1):
 		self.correlator.add_trace(trace, idx)
-	def profile(self, trace):
-		self.max_size = max(self.max_size, len(trace))
+	def reset_state(self):
+		self.correlator.reset()
+	def get_state(self):
+		"dumps the state of the correlator to a temporary file and returns its name"
+		fd, filename = tempfile.mkstemp(prefix="dpa-correlator-")
+		os.close(fd)
+		self.correlator.dump_state(filename)
+		return filename
+	def merge_state(self, filename):
+		try:
+			self.correlator.merge(type(self.correlator).load_state(filename))
+		finally:
+			os.unlink(filename)
 	def finalize(self):
 		self.correlator.update_matrix()
 	def correlations(self):
@@ -282,14 +630,10 @@ class CorrelationProcessor(VoidProcessor):
 		retrieves the correlations after processing finished,
 		by cutting the correlation matrix into corresponding chunks
 		"""
+		matrix   = self.correlator.matrix
 		_samples = self.get_samples()
-		_keys    = len(self.correlator.matrix) / _samples
-		out = []
-		sizeof_double = 8
-		for i in xrange(_keys):
-			out.append( new_buffer(_samples, types.double,
-				ptr=self.correlator.matrix.get_addr()+(i * _samples * sizeof_double)) )
-		return out
+		_keys    = len(matrix) / _samples
+		return [matrix[i * _samples:(i + 1) * _samples] for i in xrange(_keys)]
 	@staticmethod
 	def correlize(processors, **kwargs):
 		return [CorrelationProcessor(ref=p, **kwargs) for p in processors]
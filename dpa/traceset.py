@@ -0,0 +1,159 @@
+# Licensed under the terms of the GNU-GPL-3.0
+
+"""
+A packed container format for large sets of traces.
+
+Storing every trace in its own ``%06d.dat`` file does not scale to millions
+of traces, as opening and closing the files dominates the I/O. A trace set
+instead stores all traces of a campaign in one file:
+
+* a 64 byte header (magic, version, sample type, trace count, fixed trace
+  length or 0 for variable lengths, size of the per-trace metadata and the
+  positions of the data and index sections)
+* the raw samples of all traces back to back
+* an index with one entry per trace: offset and length of the samples, flags
+  (e.g. :attr:`ERROR`) and *meta_size* bytes of metadata such as the plaintext
+
+The index is written last, so traces can be appended while recording::
+
+  with TraceSetWriter("traces.dts", types.uint8_t, meta_size=16) as w:
+      for trace, plaintext in recording:
+          w.append(trace, meta=plaintext)
+  ts = TraceSet("traces.dts")
+  trace, plaintext = ts[5], ts.meta(5)
+"""
+import os
+import struct
+
+from preprocessor import types, map_file, buffer_from_array
+
+MAGIC = "DPATRSET"
+VERSION = 1
+
+#: flag for traces which are broken and should not be processed
+ERROR = 1
+
+header = struct.Struct("=8sII5Q8x")
+index_entry = struct.Struct("=QQI4x")
+
+def _entry_size(meta_size):
+    return index_entry.size + ((meta_size + 7) & ~7)
+
+class TraceSetWriter:
+    """
+    TraceSetWriter(filename, type, trace_length=0, meta_size=0)
+
+    creates the trace set *filename* for traces of the given *type*
+
+    A non-zero *trace_length* requires all traces to have this number of
+    samples. Each trace carries *meta_size* bytes of metadata.
+    """
+    def __init__(self, filename, type, trace_length=0, meta_size=0):
+        self.type = type
+        self.trace_length = trace_length
+        self.meta_size = meta_size
+        self.index = []
+        self.f = open(filename, "wb")
+        self.f.write("\0" * header.size)
+        self.offset = header.size
+
+    def append(self, buf, meta="", error=False):
+        """
+        append(buf, meta="", error=False)
+
+        appends the :class:`dpa.preprocessor.Buffer` *buf* to the trace set
+        """
+        if buf.get_type() != self.type:
+            raise TypeError("trace type %s does not match the trace set type %s" % (buf.get_type(), self.type))
+        if self.trace_length and len(buf) != self.trace_length:
+            raise ValueError("trace has %d samples, expected %d" % (len(buf), self.trace_length))
+        if len(meta) > self.meta_size:
+            raise ValueError("metadata exceeds %d bytes" % self.meta_size)
+        self.f.write(memoryview(buf))
+        self.index.append((self.offset, len(buf), ERROR if error else 0, meta))
+        self.offset += len(buf) * (self.type & 0xf)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        "writes the index and the header and closes the file"
+        if self.f is None:
+            return
+        pad = (self.offset + 7) & ~7
+        self.f.write("\0" * (pad - self.offset))
+        for offset, length, flags, meta in self.index:
+            self.f.write(index_entry.pack(offset, length, flags))
+            self.f.write(meta.ljust(_entry_size(self.meta_size) - index_entry.size, "\0"))
+        self.f.seek(0)
+        self.f.write(header.pack(MAGIC, VERSION, self.type, len(self.index),
+            self.trace_length, self.meta_size, header.size, pad))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TraceSet:
+    """
+    TraceSet(filename)
+
+    opens the trace set *filename* for reading
+
+    The file is mapped into memory once; ``ts[i]`` returns trace *i* as
+    a read-only :class:`dpa.preprocessor.Buffer` sharing the mapped memory,
+    so random access is O(1) and iterating reads the file sequentially.
+    """
+    def __init__(self, filename):
+        f = open(filename, "rb")
+        try:
+            data = f.read(header.size)
+        finally:
+            f.close()
+        if len(data) != header.size:
+            raise IOError("%s: truncated trace set" % filename)
+        (magic, version, self.type, self.count, self.trace_length,
+            self.meta_size, data_offset, index_offset) = header.unpack(data)
+        if magic != MAGIC or version != VERSION:
+            raise IOError("%s: not a trace set" % filename)
+        self.filename = filename
+        self.data = memoryview(map_file(filename, types.uint8_t))
+        self.entry_size = _entry_size(self.meta_size)
+        self.index_offset = index_offset
+        if index_offset + self.count * self.entry_size > len(self.data):
+            raise IOError("%s: truncated trace set" % filename)
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("trace index out of range")
+        return self.index_offset + i * self.entry_size
+
+    def __getitem__(self, i):
+        offset, length, flags = index_entry.unpack_from(self.data, self._entry(i))
+        return buffer_from_array(self.data[offset:offset + length * (self.type & 0xf)], self.type)
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def meta(self, i):
+        "returns the metadata of trace *i* as a string"
+        pos = self._entry(i) + index_entry.size
+        return self.data[pos:pos + self.meta_size].tobytes()
+
+    def flags(self, i):
+        "returns the flags of trace *i*"
+        return index_entry.unpack_from(self.data, self._entry(i))[2]
+
+    @property
+    def errors(self):
+        "a list of the indices of traces flagged with :attr:`ERROR`"
+        return [i for i in xrange(self.count) if self.flags(i) & ERROR]
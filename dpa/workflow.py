@@ -3,8 +3,12 @@
 # Licensed under the terms of the GNU-GPL-3.0
 
 import math
+import threading, Queue, multiprocessing, traceback, itertools
+import random, hashlib, pickle
 from helpers import *
 from threadpool import Pool
+from traceset import TraceSet
+from cache import TraceCache, digest
 
 class DPAWorkflow:
     """
@@ -13,7 +17,7 @@ class DPAWorkflow:
     Processes a set of traces in a series of analysis steps.
     Each step is executed by a trace processor. See the :mod:`dpa.processors` module for details.
 
-    In a profiling phase, 100 input traces will be processed sequentially to
+    In a profiling phase, 100 randomly chosen input traces will be processed to
     experimentally determine boundaries and lengths (e.g. for the 
     :class:`dpa.processors.AverageCountProcessor`).
     This phase is necessary, because several processors require further information.
@@ -42,11 +46,20 @@ class DPAWorkflow:
     *trace_type*
        the data type of input traces. Default: :attr:`dpa.preprocessor.types.uint8_t`
 
+    Instead of one file per trace in *base_path*, the traces can be read from a
+    packed :class:`dpa.traceset.TraceSet` passed as *trace_set* (a filename or an
+    opened set). Its trace type is used and traces flagged as errors are skipped.
+
     In the actual processing phase the traces are processed in parallel using
     all available cores if the corresponding trace processors are implemented
     to release the GIL for the actual processing. This is the case for the
     preprocessing toolsuite including the correlator.
 
+    As the chaining of processors still needs the GIL, the ``"processes"``
+    :attr:`backend` instead distributes the traces to forked worker processes.
+    Each of them accumulates into private copies of e.g. the average counters
+    and correlators, which are merged before :meth:`dpa.processors.TraceProcessor.finalize`.
+
     See this source file for a more practical and thorough application of this class.
 
     >>> w = DPAWorkflow(count=100)
@@ -55,21 +68,70 @@ class DPAWorkflow:
     """
     profile_size = 100
     errors = []
+    #: recycle the memory of intermediate buffers in a :class:`dpa.preprocessor.BufferPool`
+    buffer_pool = True
+    #: map trace files into memory instead of reading them (see :func:`dpa.preprocessor.map_file`)
+    map_files = False
+    #: number of traces loaded ahead of the processing threads, 0 loads them synchronously
+    prefetch = 0
+    #: number of threads loading traces ahead
+    prefetch_workers = 1
+    #: ``"threads"`` processes traces in a pool of :attr:`threads` threads,
+    #: ``"processes"`` in :attr:`processes` forked worker processes.
+    #: Both default to the number of available cpus (see :func:`dpa.helpers.cpu_count`)
+    backend = "threads"
+    threads = None
+    processes = None
+    #: number of traces handed to a worker at once
+    chunk_size = 16
+    #: pin each worker to one of the available cpus
+    pin_cpus = False
+    #: seed of the random selection of :attr:`profile_size` traces to profile,
+    #: None profiles the first traces
+    profile_seed = 0
+    #: number of processes profiling in parallel, defaults to the number of cpus.
+    #: Profiling stays in this process if a processor cannot merge its profile
+    #: (see :meth:`dpa.processors.TraceProcessor.merges_profile`)
+    profile_workers = None
+    #: directory storing profiling results (e.g. ``~/.cache/dpa``), None disables the cache
+    profile_cache = None
+    #: directory of a :class:`dpa.cache.TraceCache` storing the outputs of the
+    #: processors for each trace, None disables the cache
+    stage_cache = None
+    #: size limit of the :attr:`stage_cache` in bytes
+    stage_cache_size = 1 << 30
 
-    def __init__(self, info_dict = {}, count = None, base_path="."):
+    def __init__(self, info_dict = {}, count = None, base_path=".", trace_set=None):
+        if isinstance(trace_set, basestring):
+            trace_set = TraceSet(trace_set)
         self.record = info_dict
-        self.count  = info_dict['trace_count'] if count is None else count
+        self.traces = trace_set
+        if count is None:
+            if trace_set is None:
+                count = info_dict['trace_count']
+            else:
+                count = len(trace_set) - len(trace_set.errors)
+        self.count  = count
         self.path   = base_path
         self.processors = []
 
-    def __iter__(self):
+    def numbers(self):
+        """
+        iterates over the (1-based) numbers of the traces to process
+        """
         _count = 0
-        errors = self.record.get('errors', [])
+        errors = set(self.record.get('errors', []))
+        if self.traces is not None:
+            errors.update(i + 1 for i in self.traces.errors)
         for i in xrange(1, self.count+len(errors)+1):
             if not i in errors:
                 if _count == self.count: break
                 _count += 1
-                yield "%06d.dat" % i
+                yield i
+
+    def __iter__(self):
+        for i in self.numbers():
+            yield "%06d.dat" % i
 
     def path_iter(self, in_path, out_path=None):
         for i in self:
@@ -81,52 +143,172 @@ class DPAWorkflow:
 #    def start(self):
 #        init_record(self.record)
 
+    def trace_type(self):
+        if self.traces is not None:
+            return self.traces.type
+        return self.record.get('trace_type', types.uint8_t)
+
+    def load(self, i):
+        """
+        returns the trace with the (1-based) number *i* as a :class:`dpa.preprocessor.Buffer`
+        """
+        if self.traces is not None:
+            return self.traces[i - 1]
+        return load_file(os.path.join(self.path, "%06d.dat" % i), self.trace_type(), mmap=self.map_files)
+
     def store_avg(self, avg, name=""):
         avg, var = avg.get_buf()
         save_avg(os.path.join(self.path, name + "%s.dat"), avg, var)
   
+    def _profile_sample(self):
+        "returns the numbers of the traces to profile"
+        numbers = list(self.numbers())
+        if self.profile_seed is None:
+            sample = numbers[:self.profile_size + 1]
+        else:
+            sample = random.Random(self.profile_seed).sample(numbers, min(self.profile_size, len(numbers)))
+        extra = self.record.get('profile_traces', {})
+        sample.extend(numbers[j - 1] for j in extra if 0 < j <= len(numbers))
+        return sorted(set(sample))
+
+    def _profile_key(self, sample):
+        "identifies the trace set and the processor configuration for the profile cache"
+        if self.traces is not None:
+            st = os.stat(self.traces.filename)
+            dataset = (os.path.abspath(self.traces.filename), st.st_size, st.st_mtime)
+        else:
+            def stat(i):
+                try:
+                    st = os.stat(os.path.join(self.path, "%06d.dat" % i))
+                    return st.st_size, st.st_mtime
+                except OSError:
+                    return None
+            dataset = (os.path.abspath(self.path), self.trace_type(), [stat(i) for i in sample])
+        config = [p.get_config(self.processors) for p in self.processors]
+        return hashlib.sha1(repr((dataset, sample, config))).hexdigest()
+
+    def _profile_traces(self, numbers):
+        for i in numbers:
+            buf = self.load(i)
+            for p in self.processors:
+                if p.ref:
+                    p.res = p.profile(p.ref.res)
+                else:
+                    p.res = p.profile(buf)
+
     def _profile(self):
         """
         profile the active trace set, to learn about output-lengths and limits
         this method is automatically called by :meth:`process`()
+
+        The traces to profile are split among :attr:`profile_workers` forked
+        processes, whose statistics are merged afterwards
+        (see :meth:`dpa.processors.TraceProcessor.get_profile`). The merged
+        statistics are stored in :attr:`profile_cache` and reused by later runs
+        with the same traces and processor configuration. Both require all
+        processors to merge their statistics
+        (see :meth:`dpa.processors.TraceProcessor.merges_profile`), otherwise
+        the traces are profiled in-process. Finally
+        :meth:`dpa.processors.TraceProcessor.finish_profile` is called.
         """
-        trace_type = self.record.get('trace_type', types.uint8_t)
-        profile_traces = self.record.get('profile_traces', {})
-        for j,f_in in enumerate(self.path_iter(self.path)):
-            if j > self.profile_size and not (j+1) in profile_traces: continue
-            buf = load_file(f_in, trace_type)
-            for i, p in enumerate(self.processors):
-                p.idx = i
-                if p.ref:
-                    p.res = p.profile(p.ref.res)
-                else:
-                    p.res = p.profile(buf)
+        for i, p in enumerate(self.processors):
+            p.idx = i
+        sample = self._profile_sample()
+        merges = all(p.merges_profile() for p in self.processors)
+
+        cache = None
+        if self.profile_cache and merges:
+            cache = os.path.join(self.profile_cache, "profile-%s.pickle" % self._profile_key(sample))
+            if os.path.exists(cache):
+                with open(cache, "rb") as f:
+                    profiles = pickle.load(f)
+                for p, profile in zip(self.processors, profiles):
+                    p.merge_profile(profile)
+                for p in self.processors:
+                    p.finish_profile()
+                return
+
+        n = min(self.profile_workers or cpu_count(), len(sample))
+        if not merges:
+            n = 1
+        if n > 1:
+            def worker(k):
+                self._profile_traces(sample[k::n])
+                return [p.get_profile() for p in self.processors]
+            def merge(profiles):
+                for p, profile in zip(self.processors, profiles):
+                    p.merge_profile(profile)
+            self._fork(n, worker, merge)
+        else:
+            self._profile_traces(sample)
+
+        if cache:
+            if not os.path.isdir(self.profile_cache):
+                os.makedirs(self.profile_cache)
+            tmp = "%s.%d" % (cache, os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump([p.get_profile() for p in self.processors], f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, cache)
+        for p in self.processors:
+            p.finish_profile()
+
+    def _stage_keys(self):
+        """
+        returns a hash for each processor, which identifies its configuration
+        and the configuration of all processors it depends on
+        """
+        keys = []
+        for p in self.processors:
+            upstream = keys[p.ref.idx] if p.ref else ""
+            keys.append(digest(upstream, repr(p.get_config(self.processors))))
+        return keys
 
-    def process(self):
+    def process(self, profile=True):
         """
         processes the active trace set
 
         See :class:`DPAWorkflow` for a generic overview of provided functionality.
+        Unless *profile* is False, the traces are profiled first (see :meth:`_profile`).
+
+        If :attr:`stage_cache` is set, the output of each cacheable processor
+        (see :attr:`dpa.processors.TraceProcessor.cacheable`) is stored under
+        a key derived from the content of the input trace and :meth:`_stage_keys`.
+        Later runs load the stored outputs instead of recomputing them.
         """
-        trace_type = self.record.get('trace_type', types.uint8_t)
         out_bufs = [None for p in self.processors]
 
-        self._profile()
+        if profile:
+            self._profile()
+        for i, p in enumerate(self.processors):
+            p.idx = i
+
+        cache = None
+        if self.stage_cache:
+            cache = TraceCache(self.stage_cache, self.stage_cache_size)
+            stages = self._stage_keys()
 
-        def handle((j, (f_in, f_out))):
+        def handle((j, (i, f_out)), buf):
             if j % 13 == 0: print j
-            buf = load_file(f_in, trace_type)
+            if cache:
+                trace = digest(str(buf.get_type()), memoryview(buf))
             out = []
             for i, p in enumerate(self.processors):
-                try:
-                    if p.ref:
-                        b = p.process(out[p.ref.idx], idx=j)
-                    else:
-                        b = p.process(buf, idx=j)
-                except NormalizeException, e: #mark errors and report them later. we are in threading unfortunately
-                    self.errors.append(j+1)
-                    out.append(None)
-                    continue
+                key = b = None
+                if cache and p.cacheable:
+                    key = digest(trace, stages[i])
+                    b = cache.get(key)
+                if b is None:
+                    try:
+                        if p.ref:
+                            b = p.process(out[p.ref.idx], idx=j)
+                        else:
+                            b = p.process(buf, idx=j)
+                    except NormalizeException, e: #mark errors and report them later. we are in threading unfortunately
+                        self.errors.append(j+1)
+                        out.append(None)
+                        continue
+                    if key and b is not None:
+                        cache.put(key, b)
 
                 out.append(b)
 
@@ -134,20 +316,166 @@ class DPAWorkflow:
 		    print "saving file", f_out, p.save
                     write_file(f_out % str(p), b)
 
-        p = Pool(4)
+        out_path = os.path.join(self.path, "%s")
+        items = list(enumerate((i, os.path.join(out_path, "%06d.dat" % i)) for i in self.numbers()))
+
+        old_pool = set_buffer_pool(BufferPool() if self.buffer_pool else None)
         try:
-            p.map(handle, enumerate(self.path_iter(self.path, os.path.join(self.path, "%s"))))
-        except Exception, e:
-            p.terminate()
-            print self.errors
-            raise e
+            if self.backend == "processes":
+                self._run_processes(handle, items)
+            else:
+                self._run_threads(handle, items, self.threads or cpu_count(), self.pin_cpus)
+        finally:
+            set_buffer_pool(old_pool)
         print "handling"
         print self.errors
-        p.terminate()
 
         for i, p in enumerate(self.processors):
 	    p.finalize()
         
+    def _run_threads(self, handle, items, threads, pin=False):
+        """
+        processes *items* with a pool of *threads* threads
+
+        The items are dispatched in chunks of :attr:`chunk_size`. If *pin* is set,
+        each thread is pinned to one of the available cpus.
+        """
+        load = lambda (j, (i, f_out)): self.load(i)
+        if self.prefetch:
+            prefetcher = Prefetcher(load, items, self.prefetch, self.prefetch_workers)
+            work = lambda _: handle(*prefetcher.get())
+        else:
+            work = lambda item: handle(item, load(item))
+
+        cpus = allowed_cpus() if pin else []
+        next_cpu = itertools.count()
+        pinned = threading.local()
+        def run(chunk):
+            if cpus and not hasattr(pinned, "cpu"):
+                pinned.cpu = cpus[next_cpu.next() % len(cpus)]
+                pin_to_cpu(pinned.cpu)
+            for item in chunk:
+                work(item)
+
+        size = max(self.chunk_size, 1)
+        p = Pool(threads)
+        try:
+            p.map(run, [items[k:k + size] for k in xrange(0, len(items), size)])
+        except Exception, e:
+            p.terminate()
+            print self.errors
+            raise e
+        p.terminate()
+
+    def _run_processes(self, handle, items):
+        """
+        processes *items* in forked worker processes
+
+        Each worker process handles a contiguous part of the trace set with its
+        own copy of the processors, whose results are then merged into the
+        processors of this process (see :meth:`dpa.processors.TraceProcessor.get_state`).
+        """
+        n = self.processes or cpu_count()
+        cpus = allowed_cpus()
+
+        def worker(k):
+            if self.pin_cpus:
+                pin_to_cpu(cpus[k % len(cpus)])
+            for p in self.processors:
+                p.reset_state()
+            del self.errors[:]
+            self._run_threads(handle, items[k * len(items) / n:(k + 1) * len(items) / n], 1)
+            return [p.get_state() for p in self.processors], self.errors
+
+        def merge((states, errors)):
+            for p, state in zip(self.processors, states):
+                p.merge_state(state)
+            self.errors.extend(errors)
+
+        self._fork(n, worker, merge)
+
+    def _fork(self, n, worker, merge):
+        """
+        calls ``worker(k)`` for k in 0..n-1 in forked processes and passes
+        each (picklable) result to ``merge(result)`` in this process
+        """
+        results = multiprocessing.Queue()
+
+        def run(k):
+            try:
+                results.put((k, None, worker(k)))
+            except:
+                results.put((k, traceback.format_exc(), None))
+
+        workers = [multiprocessing.Process(target=run, args=(k,)) for k in xrange(n)]
+        for w in workers:
+            w.start()
+        try:
+            pending = n
+            while pending:
+                try:
+                    k, error, result = results.get(timeout=1)
+                except Queue.Empty:
+                    if any(w.exitcode for w in workers):
+                        raise Exception("a worker process died unexpectedly")
+                    continue
+                if error:
+                    raise Exception("worker process %d failed:\n%s" % (k, error))
+                merge(result)
+                pending -= 1
+        except:
+            for w in workers:
+                w.terminate()
+            raise
+        finally:
+            for w in workers:
+                w.join()
+
+class Prefetcher:
+    """
+    Prefetcher(load, items, depth=16, workers=1)
+
+    loads traces ahead of their processing
+
+    *workers* threads call ``load(item)`` for the *items* in order and keep up
+    to *depth* loaded traces in a bounded queue, from which :meth:`get` takes
+    them. Loaded traces are paged in (see :func:`dpa.preprocessor.readahead`),
+    so memory-mapped traces do not block the processing threads either.
+    """
+    def __init__(self, load, items, depth=16, workers=1):
+        self.load  = load
+        self.items = iter(items)
+        self.queue = Queue.Queue(depth)
+        self.lock  = threading.Lock()
+        for n in xrange(workers):
+            t = threading.Thread(target=self._run, name="Prefetch-%d" % n)
+            t.daemon = True
+            t.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                try:
+                    item = self.items.next()
+                except StopIteration:
+                    return
+            try:
+                buf = self.load(item)
+                if buf is not None:
+                    readahead(buf)
+            except Exception, e:
+                buf = e
+            self.queue.put((item, buf))
+
+    def get(self):
+        """
+        returns the next ``(item, trace)`` tuple, blocking until a trace is loaded
+        """
+        item, buf = self.queue.get()
+        if isinstance(buf, Exception):
+            raise buf
+        return item, buf
+
 if __name__ == "__main__":
     # this is a sample workflow that reads some information about the traces to process
     # from the record_data structure in the trace_characteristics.py module
@@ -14,6 +14,8 @@ t_u8    = types.uint8_t
 t_u16   = types.uint16_t
 
 t_s8    = types.int8_t
+t_s16   = types.int16_t
+t_s32   = types.int32_t
 
 type_list = [t_u8, t_u16, t_float]
 
@@ -39,6 +41,57 @@ class PreprocessorTests(unittest.TestCase):
             else:
                 self.assertEqual([int(j) for j in self.array], self.b[t].as_list())
 
+    def test_buffer_protocol(self):
+        "buffers export and wrap memory without copying"
+        for t, fmt in [(t_u8, 'B'), (t_u16, 'H'), (t_float, 'f'), (t_s8, 'b'), (types.double, 'd')]:
+            view = memoryview(buffer_from_list(t, [1, 2, 3]))
+            self.assertEqual((view.format, view.itemsize, view.shape), (fmt, t & 0xf, (3,)))
+        data = bytearray([1, 2, 3, 4])
+        buf = buffer_from_array(data)
+        self.assertEqual((buf.get_type(), buf.as_list()), (t_u8, [1, 2, 3, 4]))
+        data[1] = 9
+        self.assertEqual(buf[1], 9)
+        wide = buffer_from_array(data, t_u16)
+        self.assertEqual(len(wide), 2)
+        self.assertEqual(memoryview(buffer_from_array(memoryview(buffer_from_list(t_float, [0.5])))).tobytes(),
+                         memoryview(buffer_from_list(t_float, [0.5])).tobytes())
+
+    def test_buffer_byte_order(self):
+        "only arrays in native byte order are wrapped"
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        native, swapped = ('<', '>') if sys.byteorder == 'little' else ('>', '<')
+        self.assertEqual(buffer_from_array(numpy.array([1, 2, 256], dtype=native + 'u2')).as_list(), [1, 2, 256])
+        self.assertRaises(Exception, buffer_from_array, numpy.array([1, 2, 256], dtype=swapped + 'u2'))
+        self.assertEqual(buffer_from_array(numpy.array([1, 2], dtype=swapped + 'u1')).as_list(), [1, 2])
+
+    def test_out_buffer(self):
+        "results can be written to existing buffers"
+        out = new_buffer(len(self.array), t_float)
+        addr = out.get_addr()
+        res = scale(self.b[t_u8], 2, out=out)
+        self.assertEqual((res.get_addr(), res.get_type()), (addr, t_float))
+        self.assertEqual(res.as_list(), [2 * int(x) for x in self.array])
+        res = integrate(self.b[t_float], 9, out=out)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res.get_addr(), addr)
+        self.assertRaises(Exception, scale, self.b[t_u8], out=new_buffer(3, t_u8))
+        self.assertRaises(Exception, scale, self.b[t_u8], dst_type=t_u8, out=out)
+
+    def test_buffer_pool(self):
+        "freed buffers return their memory to the pool"
+        pool = BufferPool()
+        old = set_buffer_pool(pool)
+        try:
+            for i in xrange(20):
+                buf = average(scale(self.b[t_u8], 2), 3, dst_type=t_float)
+            self.assertEqual(buf.get_addr() % 64, 0)
+            self.assertEqual(pool.allocations, 3)
+        finally:
+            set_buffer_pool(old)
+
     def test_average(self):
         self.assertEqual(average(self.b[t_u8], 3, skip=2).as_list(), [1,3,5,7])
         self.compareFloatList(average(self.b[t_float], len(self.array), skip=len(self.array)/2).as_list(), [4.65])
@@ -60,6 +113,150 @@ class PreprocessorTests(unittest.TestCase):
         for t in type_list:
             self.compareFloatList(filter(self.b[t], filt).as_list(), [sum([l[i] * self.b[t][i] for i in xrange(len(l))]) / sum(l) ])
 
+    def test_fft_filter(self):
+        "band passes of single and batched traces, sharing the cached plans"
+        import random, tempfile, threading
+        r = random.Random(5)
+        traces = [buffer_from_list(t_float, [r.randint(0, 100) for i in xrange(250)]) for k in xrange(20)]
+        self.compareFloatList(fft_filter(traces[0], 0, 1000).as_list(), traces[0].as_list(), 3)
+        no_dc = fft_filter(traces[0], 1, 1000)
+        self.assertAlmostEqual(sum(no_dc.as_list()), 0, 2)
+        single = [fft_filter(b, 3, 40).as_list() for b in traces]
+        many = fft_filter_many(traces, 3, 40)
+        self.assertEqual(len(many), 20)
+        for a, b in zip(single, many):
+            self.compareFloatList(a, b.as_list(), 4)
+        res = {}
+        def work(k):
+            res[k] = fft_filter(traces[k], 3, 40).as_list()
+        threads = [threading.Thread(target=work, args=(k,)) for k in xrange(8)]
+        for th in threads: th.start()
+        for th in threads: th.join()
+        self.assertEqual([res[k] for k in xrange(8)], single[:8])
+        self.assertRaises(ValueError, fft_filter_many, [traces[0], self.b[t_float]], 3, 40)
+
+        wisdom = tempfile.mktemp()
+        try:
+            save_fft_wisdom(wisdom)
+            self.assertTrue(load_fft_wisdom(wisdom))
+        finally:
+            os.unlink(wisdom)
+        self.assertFalse(load_fft_wisdom(wisdom))
+
+    def test_trace_matrix(self):
+        "batched functions match the per-trace functions"
+        import random
+        r = random.Random(7)
+        bufs = [buffer_from_list(t_u8, [r.randint(10, 200) for i in xrange(3000)]) for k in xrange(60)]
+        m = TraceMatrix.from_buffers(bufs)
+        self.assertEqual((len(m), m.cols, m[5].as_list()), (60, 3000, bufs[5].as_list()))
+        view = memoryview(m)
+        self.assertEqual((view.shape, view.strides), ((60, 3000), (3000, 1)))
+        old = get_threads()
+        set_threads(4)
+        try:
+            for batched, single in [
+                    (m.average(3, skip=2, dst_type=t_float), [average(b, 3, skip=2, dst_type=t_float) for b in bufs]),
+                    (m.integrate(5, dst_type=t_u16), [integrate(b, 5, dst_type=t_u16) for b in bufs]),
+                    (m.scale(1.5, dst_type=t_float), [scale(b, 1.5, dst_type=t_float) for b in bufs]),
+                    (m.rectify(100, dst_type=t_u8), [rectify(b, 100, dst_type=t_u8) for b in bufs]),
+                    (m.diff(m.scale(0.5), dst_type=t_s8), [diff(b, scale(b, 0.5), dst_type=t_s8) for b in bufs]),
+                    (m.normalize(0, 255, dst_type=t_u8), [normalize(b, 0, 255, dst_type=t_u8) for b in bufs])]:
+                self.assertEqual(batched.as_list(), [b.as_list() for b in single])
+            self.assertEqual(m.analyze(), [analyze(b) for b in bufs])
+        finally:
+            set_threads(old)
+        out = TraceMatrix(60, 2996, t_u16)
+        self.assertTrue(m.integrate(5, out=out) is out)
+        try:
+            m.normalize(20, 190)
+            self.fail("normalize accepted samples out of range")
+        except NormalizeException, e:
+            self.assertEqual(e.rows, range(60))
+
+    def test_buffer_slice(self):
+        "slices are views sharing the memory of the buffer"
+        buf = buffer_from_list(t_u16, range(20))
+        view = buf[5:15]
+        self.assertEqual((view.as_list(), view.get_addr() - buf.get_addr(), view.get_stride()), (range(5, 15), 10, 2))
+        view[0] = 100
+        self.assertEqual(buf[5], 100)
+        strided = buf[1::3]
+        self.assertEqual((strided.as_list(), strided.get_stride()), ([1, 4, 7, 10, 13, 16, 19], 6))
+        self.assertEqual((buf[::-5].as_list(), buf[-1], buf[15:2].as_list()), ([19, 14, 9, 4], 19, []))
+        self.assertEqual(strided[1:3].as_list(), [4, 7])
+        self.assertRaises(IndexError, lambda: strided[7])
+        mem = memoryview(strided)
+        self.assertEqual((mem.strides, mem.shape, mem.readonly), ((6,), (7,), False))
+        self.assertEqual(analyze(strided), analyze(strided.copy()))
+        self.assertEqual(integrate(buf[::2], 3).as_list(), integrate(buf[::2].copy(), 3).as_list())
+        self.assertRaises(Exception, scale, view, 2.0, out=new_buffer(40, t_u16)[::2])
+
+        from dpa.processors import CorrelationProcessor
+        from dpa.correlation import Correlator
+        c = Correlator(4, 3, 2)
+        p = CorrelationProcessor(correlator=c)
+        p.max_size = 4
+        corr = p.correlations()
+        self.assertEqual([b.get_addr() for b in corr], [c.matrix.get_addr(), c.matrix.get_addr() + 32])
+
+    def test_simd(self):
+        "the vector kernels give the results of the scalar loops"
+        import random
+        r = random.Random(11)
+        traces = [buffer_from_list(t, [r.randint(0, 250) for i in xrange(1013)]) for t in (t_u8, t_u16)]
+        traces.append(buffer_from_list(t_float, [r.uniform(-100, 300) for i in xrange(1013)]))
+        traces.append(buffer_from_list(t_s16, [r.randint(-120, 250) for i in xrange(1013)]))
+        def run():
+            res = []
+            for b in traces:
+                other = scale(b, 0.5)
+                counter = AverageCounter(len(b), t_float)
+                counter.add_trace(b)
+                counter.add_trace(other)
+                counter.add_trace(b)
+                res.append([scale(b, 0.3, dst_type=t_float), scale(b, 1.7, signed_scale=128, dst_type=t_float),
+                    diff(b, other, dst_type=t_float), diff(b, other, absolute=False, dst_type=t_float),
+                    square(b, dst_type=t_float), rectify(b, 99.5, dst_type=t_float), counter.get_buf()[0], counter.get_buf()[1],
+                    normalize(scale(b, 1, dst_type=t_float), -120, 350, dst_type=t_u8)])
+                res[-1] = [x.as_list() for x in res[-1]] + [analyze(b)]
+            return res
+        old = get_simd()
+        try:
+            self.assertEqual(set_simd("none"), "none")
+            scalar = run()
+            levels = ["sse2", "avx2", "avx512"]
+            results = [run() for level in levels if set_simd(level) == level]
+        finally:
+            set_simd(old)
+        self.assertRaises(ValueError, set_simd, "neon")
+        for res in results:
+            for s, v in zip(scalar, res):
+                self.assertEqual(s[:-1], v[:-1])
+                self.compareFloatList(s[-1], v[-1], 9)
+            self.assertEqual(res, results[0])
+        self.assertEqual(scalar[0][-1][::2], results[0][0][-1][::2]) #exact sums of integers
+
+    def test_fir_filter(self):
+        "float coefficients, and fft filtering matching the direct computation"
+        import random
+        r = random.Random(3)
+        trace = buffer_from_list(t_u16, [r.randint(0, 4000) for i in xrange(5000)])
+        coeffs = [r.uniform(-1, 1) for i in xrange(300)]
+        direct = FIRFilter(coeffs, method="direct")
+        fft = FIRFilter(coeffs)
+        self.assertEqual((direct.method, fft.method, FIRFilter(coeffs[:10]).method), ("direct", "fft", "direct"))
+        a = direct.process(trace, dst_type=types.double)
+        b = fft.process(trace, dst_type=types.double)
+        self.assertEqual(len(a), len(trace) - len(coeffs) + 1)
+        self.assertEqual(a[7], sum(c * trace[7 + j] for j, c in enumerate(coeffs)))
+        self.compareFloatList(a.as_list(), b.as_list(), 6)
+        self.compareFloatList(filter(self.b[t_float], buffer_from_list(t_float, [0.5, 0.25])).as_list(),
+            [0.5 * x + 0.25 * y for x, y in zip(self.array, self.array[1:])])
+        out = new_buffer(len(a), types.float)
+        self.assertEqual(fft.process(trace, out=out).get_addr(), out.get_addr())
+        self.assertRaises(ValueError, FIRFilter, [1, -1], normalize=True)
+
     def test_scale(self):
         for t in type_list:
             for factor in [1, 2.0, 1.5]:
@@ -85,6 +282,78 @@ class PreprocessorTests(unittest.TestCase):
             os.unlink(tmp_name % t)
         self.test_buffer()
 
+    def test_map_file(self):
+        tmp_name = "tmpfile.unittest.map"
+        write_file(tmp_name, buffer_from_list(t_u16, range(5000)))
+        try:
+            buf = map_file(tmp_name, t_u16)
+            part = load_file(tmp_name, t_u16, length=10, mmap=True)
+            shifted = map_file(tmp_name, t_u16, length=2, offset=2 * 4097)
+            tail = load_file(tmp_name, t_u16, length=6000, mmap=True)
+            end = map_file(tmp_name, t_u16, offset=2 * 5000)
+            self.assertRaises(IOError, map_file, tmp_name, t_u16, offset=2 * 5000 + 1)
+        finally:
+            os.unlink(tmp_name)
+        self.assertEqual(buf.as_list(), range(5000))
+        self.assertEqual(part.as_list(), range(10))
+        self.assertEqual(shifted.as_list(), [4097, 4098])
+        self.assertEqual(len(tail), 5000)
+        self.assertEqual(tail[4999], 4999)
+        self.assertEqual(len(end), 0)
+        self.assertRaises(Exception, scale, buf, out=end)
+        self.assertEqual(scale(buf, 2)[4999], (2 * 4999) % 65536)
+        self.assertRaises(Exception, buf.__setitem__, 0, 1)
+        self.assertRaises(Exception, scale, part, out=part)
+        self.assertTrue(memoryview(buf).readonly)
+        view = buf[10:20]
+        free_buffer(view)
+        self.assertEqual(len(view), 0)
+        self.assertEqual(buf[10:12].as_list(), [10, 11])
+        free_buffer(buf)
+        free_buffer(buf)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(shifted.as_list(), [4097, 4098])
+
+    def test_trace_set(self):
+        from dpa.traceset import TraceSet, TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import TraceProcessor
+        tmp_name = "tmpfile.unittest.dts"
+        traces = [range(10), range(5, 12), [], range(3)]
+        with TraceSetWriter(tmp_name, t_u16, meta_size=3) as w:
+            for i, t in enumerate(traces):
+                w.append(buffer_from_list(t_u16, t), meta="p%d" % i, error=(i == 1))
+        self.assertRaises(TypeError, w.append, self.b[t_u8])
+        try:
+            ts = TraceSet(tmp_name)
+            self.assertEqual(len(ts), 4)
+            self.assertEqual([t.as_list() for t in ts], traces)
+            self.assertEqual(ts[-1].as_list(), range(3))
+            self.assertEqual(ts.meta(2), "p2\0")
+            self.assertEqual(ts.errors, [1])
+            self.assertRaises(Exception, ts[0].__setitem__, 0, 1)
+
+            class Collect(TraceProcessor):
+                def process(self, trace, idx=None):
+                    seen.append(trace.as_list())
+                    return trace
+                def profile(self, trace):
+                    return trace
+            seen = []
+            w = DPAWorkflow(trace_set=tmp_name)
+            w.profile_cache = None
+            w.processors = [Collect()]
+            w.process()
+            self.assertEqual(w.count, 3)
+            self.assertEqual(sorted(seen), sorted([traces[0], traces[2], traces[3]]))
+
+            seen = []
+            w.prefetch, w.prefetch_workers = 2, 2
+            w.process()
+            self.assertEqual(sorted(seen), sorted([traces[0], traces[2], traces[3]]))
+        finally:
+            os.unlink(tmp_name)
+
     def test_raster(self):
         pattern = buffer_from_list(t_u8, [1,5,9])
         l = buffer_from_list(t_u8, [9,3,1, 1,5,9,8,6,4,3,2, 1,6,9,8,6,5,3,2, 1,5,10,7,3, 0,4,9,6,3,2, 0,7])
@@ -92,6 +361,17 @@ class PreprocessorTests(unittest.TestCase):
         set_raster_config(trigger=10, header_size=0)
         out = raster(l, pattern, 5) #, dst_type=t_float)
         self.assertEqual([1,8,7,3,2, 1,8,7,4,2, 1,5,10,7,3], out.as_list())
+
+        #explicit arguments override the defaults
+        set_raster_config()
+        self.assertEqual(raster(l, pattern, 5, trigger=10, header_size=0, min_pause=0).as_list(), out.as_list())
+        self.assertEqual(raster(l, pattern, 5, trigger=10, header_size=11, min_pause=0).as_list(), [1,5,10,7,3])
+
+        from dpa.processors import RasterizeProcessor
+        a = RasterizeProcessor(pattern, 5, trigger=10, header_size=0)
+        b = RasterizeProcessor(pattern, 5, trigger=10, header_size=11)
+        self.assertEqual((a.process(l).as_list(), b.process(l).as_list()), (out.as_list(), [1,5,10,7,3]))
+        self.assertNotEqual(a.get_config(), b.get_config())
         
         #TODO test pause trigger and related stuff
 
@@ -128,9 +408,520 @@ class PreprocessorTests(unittest.TestCase):
         b = buffer_from_list(types.float, [2,4,6,8, 5,3,2,6,9, 3,1,2,5,10, 7,5,2])
         self.assertEqual(peak_extract(b).as_list(), [8,9,10])
 
+    def test_chain(self):
+        "fused chains give the same results as the separate functions"
+        import random
+        from dpa.processors import IntegrateProcessor, PeakProcessor, RectifyProcessor, NormalizeProcessor
+        rnd = random.Random(1)
+        trace = buffer_from_list(t_u8, [rnd.randint(0, 255) for i in xrange(2000)])
+        ftrace = buffer_from_list(t_float, [rnd.random() * 100 for i in xrange(2000)])
+
+        i = integrate(trace, 3, dst_type=t_float)
+        avg, var, _min, _max = analyze(i)
+        chain = Chain().integrate(3, dst_type=t_float).peak_extract(avg, var ** .5)
+        self.assertEqual(chain.process(trace).as_list(), peak_extract(i, avg, var ** .5).as_list())
+
+        a = average(trace, 4, scale=256, dst_type=t_float)
+        r = rectify(a, 127 * 256)
+        chain = Chain().average(4, scale=256, dst_type=t_float).rectify(127 * 256).normalize(0, 40000, dst_type=t_u8)
+        self.assertEqual(chain.process(trace).as_list(), normalize(r, 0, 40000, dst_type=t_u8).as_list())
+
+        chain = Chain().integrate(5).rectify(100)
+        self.assertEqual(chain.process(trace).as_list(), rectify(integrate(trace, 5), 100).as_list())
+        self.assertEqual(chain.process(ftrace).as_list(), rectify(integrate(ftrace, 5), 100).as_list())
+
+        self.assertRaises(NormalizeException, Chain().integrate(2).normalize(0, 100, dst_type=t_u8).process, ftrace)
+        self.assertFalse(Chain().normalize(0, 1, dst_type=t_float).accepts(t_u8))
+        self.assertFalse(Chain().peak_extract(1, 1, dst_type=t_float).accepts(t_u8))
+
+        integ = IntegrateProcessor(count=4, dst_type=t_float)
+        p = NormalizeProcessor(dst_type=t_u8)(RectifyProcessor()(PeakProcessor()(integ)))
+        p.profile(trace)
+        fused = p.process(trace).as_list()
+        self.assertTrue(p.chain)
+        p.fuse_chain = False
+        self.assertEqual(fused, p.process(trace).as_list())
+        self.assertFalse(NormalizeProcessor(dst_type=t_u8).fuse(Chain()))
+
     def test_correlation(self):
         from dpa import correlation
         doctest.testmod(correlation)
+
+    def test_correlation_batch(self):
+        "add_traces() must yield the same result as single add_trace() calls"
+        import random
+        from dpa.correlation import Correlator
+        samples, traces, keys = 1100, 40, 3
+        rnd = random.Random(1)
+        hypo = [rnd.randint(0, 255) for i in xrange(keys * traces)]
+        bufs = [buffer_from_list(t_u8, [rnd.randint(0, 255) for i in xrange(samples)]) for j in xrange(traces)]
+        single, batch = Correlator(samples, traces, keys), Correlator(samples, traces, keys)
+        for c in (single, batch):
+            for i, h in enumerate(hypo): c.hypo[i] = h
+            c.preprocess()
+        for i, b in enumerate(bufs):
+            single.add_trace(b, i)
+        order = range(traces)
+        rnd.shuffle(order)
+        batch.add_traces([bufs[i] for i in order[:25]], order[:25])
+        batch.add_traces([bufs[i] for i in order[25:]], order[25:])
+        single.update_matrix()
+        batch.update_matrix()
+        self.compareFloatList(single.matrix.as_list(), batch.matrix.as_list(), 10)
+
+    def test_correlation_shards(self):
+        "traces added concurrently to several shards are reduced to the same result"
+        import random, threading
+        from dpa.correlation import Correlator
+        samples, traces, keys = 50, 64, 4
+        rnd = random.Random(2)
+        hypo = [rnd.randint(0, 255) for i in xrange(keys * traces)]
+        bufs = [buffer_from_list(t_float, [rnd.random() for i in xrange(samples)]) for j in xrange(traces)]
+        single, sharded = Correlator(samples, traces, keys), Correlator(samples, traces, keys, shards=4)
+        for c in (single, sharded):
+            for i, h in enumerate(hypo): c.hypo[i] = h
+            c.preprocess()
+        for i, b in enumerate(bufs):
+            single.add_trace(b, i)
+        def worker(offset):
+            for i in xrange(offset, traces, 4):
+                sharded.add_trace(bufs[i], i)
+        threads = [threading.Thread(target=worker, args=(k,)) for k in xrange(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        single.update_matrix()
+        sharded.update_matrix()
+        self.compareFloatList(single.matrix.as_list(), sharded.matrix.as_list(), 10)
+
+    def test_correlation_int64(self):
+        "the exact integer accumulator matches the double accumulator"
+        import random
+        from dpa.correlation import Correlator
+        samples, traces, keys = 30, 50, 2
+        rnd = random.Random(3)
+        hypo = [rnd.randint(0, 255) for i in xrange(keys * traces)]
+        bufs = [buffer_from_list(t_u16, [rnd.randint(0, 65535) for i in xrange(samples)]) for j in xrange(traces)]
+        exact, approx = Correlator(samples, traces, keys, accumulator='int64'), Correlator(samples, traces, keys)
+        for c in (exact, approx):
+            for i, h in enumerate(hypo): c.hypo[i] = h
+            c.preprocess()
+            c.add_traces(bufs)
+            c.update_matrix()
+        self.compareFloatList(exact.matrix.as_list(), approx.matrix.as_list(), 8)
+        self.assertRaises(Exception, exact.add_trace, buffer_from_list(t_float, [0] * samples))
+
+    def test_signed_types(self):
+        "int16_t and int32_t traces are processed like their float equivalents"
+        import random
+        from dpa.correlation import Correlator
+        r = random.Random(4)
+        values = [r.randint(-30000, 30000) for i in xrange(200)]
+        b = buffer_from_list(t_s16, values)
+        f = buffer_from_list(t_float, values)
+        self.assertEqual(scale(b, 0.5).as_list(), [int(v * 0.5) for v in values])
+        half = scale(b, 0.5)
+        self.assertEqual(diff(b, half, dst_type=t_float).as_list(), diff(f, buffer_from_list(t_float, half.as_list())).as_list())
+        self.assertEqual(rectify(b, 10.5, dst_type=t_float).as_list(), rectify(f, 10.5).as_list())
+        self.compareFloatList(analyze(b), analyze(f), 6)
+        wide = scale(b, 1, dst_type=t_s32)
+        self.assertEqual(wide.as_list(), values)
+        self.assertEqual(square(wide, dst_type=t_float).as_list(), square(f).as_list())
+        self.assertEqual(normalize(f, -30000, 30000, dst_type=t_s16).as_list()[:3],
+            [int((v + 30000) * 65535 / 60000. - 32768) for v in values[:3]])
+        n = normalize(f, -30000, 30000, dst_type=t_s32).as_list()
+        self.assertEqual((min(n) >= -2**31, max(n) < 2**31), (True, True))
+        counter = AverageCounter(len(b), t_s16, auto_type=True)
+        counter.add_trace(b)
+        counter.add_trace(b)
+        self.assertEqual(counter.get_buf()[0].as_list(), values)
+
+        samples, traces, keys = 20, 30, 2
+        hypo = [r.randint(0, 255) for i in xrange(keys * traces)]
+        data = [[r.randint(-30000, 30000) for i in xrange(samples)] for j in xrange(traces)]
+        results = []
+        for t, acc in ((t_float, 'double'), (t_s16, 'double'), (t_s16, 'int64'), (t_s32, 'double')):
+            c = Correlator(samples, traces, keys, accumulator=acc)
+            for i, h in enumerate(hypo): c.hypo[i] = h
+            c.preprocess()
+            c.add_trace(buffer_from_list(t, data[0]), 0)
+            c.add_traces([buffer_from_list(t, d) for d in data[1:]], range(1, traces))
+            c.update_matrix()
+            results.append(c.matrix.as_list())
+        for res in results[1:]:
+            self.compareFloatList(results[0], res, 8)
+        c = Correlator(samples, traces, keys, accumulator='int64')
+        c.preprocess()
+        self.assertRaises(Exception, c.add_trace, buffer_from_list(t_s32, data[0]))
+
+    def test_correlation_state(self):
+        "states of disjoint trace ranges merge to the result of a single run"
+        import random
+        from dpa.correlation import Correlator
+        samples, traces, keys = 20, 30, 3
+        rnd = random.Random(4)
+        hypo = [rnd.randint(0, 255) for i in xrange(keys * traces)]
+        bufs = [buffer_from_list(t_u8, [rnd.randint(0, 255) for i in xrange(samples)]) for j in xrange(traces)]
+        parts = [Correlator(samples, traces, keys, accumulator='int64') for i in xrange(3)]
+        for c in parts:
+            for i, h in enumerate(hypo): c.hypo[i] = h
+            c.preprocess()
+        for i, b in enumerate(bufs):
+            parts[i % 3].add_trace(b, i)
+
+        tmp_name = "tmpfile.unittest.state%d"
+        for i, c in enumerate(parts):
+            c.dump_state(tmp_name % i)
+        try:
+            merged = Correlator.load_state(tmp_name % 0)
+            for i in (1, 2):
+                merged.merge(Correlator.load_state(tmp_name % i))
+        finally:
+            for i in xrange(3):
+                os.unlink(tmp_name % i)
+
+        full = Correlator(samples, traces, keys, accumulator='int64')
+        for i, h in enumerate(hypo): full.hypo[i] = h
+        full.preprocess()
+        full.add_traces(bufs)
+        full.update_matrix()
+        merged.update_matrix()
+        self.assertEqual(full.matrix.as_list(), merged.matrix.as_list())
+        self.assertRaises(Exception, merged.merge, Correlator(samples, traces, keys))
+        other = Correlator(samples, traces, keys, accumulator='int64')
+        for i, h in enumerate(hypo): other.hypo[i] = h ^ (i == 7)
+        other.preprocess()
+        self.assertRaises(Exception, merged.merge, other)
+
+    def test_average_counter_merge(self):
+        import pickle
+        traces = [buffer_from_list(t_u8, [i, 2 * i, 255 - i]) for i in xrange(10)]
+        full, a, b = [AverageCounter(size=3, type=t_float) for i in xrange(3)]
+        for i, t in enumerate(traces):
+            full.add_trace(t)
+            (a if i < 4 else b).add_trace(t)
+        b = pickle.loads(pickle.dumps(b, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(len(b), 6)
+        a.merge(b)
+        self.assertEqual(len(a), 10)
+        for x, y in zip(a.get_buf(), full.get_buf()):
+            self.compareFloatList(x.as_list(), y.as_list())
+        self.assertRaises(Exception, a.merge, AverageCounter(size=4, type=t_float))
+
+    def test_average_counter_threads(self):
+        "traces added by several threads are combined, the variance survives large offsets"
+        import random, threading
+        r = random.Random(5)
+        traces = [buffer_from_list(t_float, [1e6 + r.uniform(-1, 1) for i in xrange(8)]) for j in xrange(200)]
+        single, sharded = AverageCounter(8, t_float, auto_type=True), AverageCounter(8, t_float, auto_type=True)
+        for t in traces:
+            single.add_trace(t)
+        def worker(offset):
+            for i in xrange(offset, len(traces), 4):
+                sharded.add_trace(traces[i])
+        threads = [threading.Thread(target=worker, args=(k,)) for k in xrange(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(sharded), 200)
+        values = [t.as_list() for t in traces]
+        mean = [sum(v[i] for v in values) / 200 for i in xrange(8)]
+        var = [sum((v[i] - mean[i]) ** 2 for v in values) / 200 for i in xrange(8)]
+        for counter in (single, sharded):
+            avg, variance = counter.get_buf()
+            self.compareFloatList(avg.as_list(), mean, 1)
+            self.compareFloatList(variance.as_list(), var, 5)
+
+    def test_profile(self):
+        "parallel profiling merges the statistics, which are then cached"
+        import shutil, tempfile
+        from dpa.traceset import TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import TraceProcessor, IntegrateProcessor, PeakProcessor, NormalizeProcessor
+        tmp_dir = tempfile.mkdtemp()
+        tmp_name = os.path.join(tmp_dir, "traces.dts")
+        with TraceSetWriter(tmp_name, t_u8) as w:
+            for i in xrange(60):
+                w.append(buffer_from_list(t_u8, [(i * 37 + j * j * 11) % 251 for j in xrange(100 + i)]))
+        def workflow(workers, cache=None):
+            w = DPAWorkflow(trace_set=tmp_name)
+            w.profile_size, w.profile_workers, w.profile_cache = 20, workers, cache
+            peak = PeakProcessor()(IntegrateProcessor(count=3))
+            w.processors = [peak, NormalizeProcessor(ref=peak)]
+            return w
+        try:
+            serial, parallel = workflow(1), workflow(3)
+            serial._profile()
+            parallel._profile()
+            self.assertEqual(len(serial._profile_sample()), 20)
+            integ = serial.processors[0].b, parallel.processors[0].b
+            self.assertEqual(*[(p.min_size, p.max_size) for p in integ])
+            self.assertEqual(sorted(serial.processors[0].a.avgs), sorted(parallel.processors[0].a.avgs))
+            self.assertAlmostEqual(serial.processors[0].a.avg, parallel.processors[0].a.avg)
+
+            cache = os.path.join(tmp_dir, "cache")
+            first = workflow(2, cache)
+            first._profile()
+            self.assertEqual(len(os.listdir(cache)), 1)
+            cached = workflow(2, cache)
+            cached.load = None # must not read any trace
+            cached._profile()
+            for a, b in zip(first.processors, cached.processors):
+                self.assertEqual(a.get_profile(), b.get_profile())
+            other = workflow(2, cache)
+            other.processors[1].dst_type = t_u16
+            other._profile()
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+            class Counting(TraceProcessor): #profile() without get_profile()/merge_profile()
+                profiled = 0
+                def profile(self, trace):
+                    self.profiled += 1
+                    return trace
+            self.assertTrue(all(p.merges_profile() for p in first.processors))
+            self.assertFalse(Counting.merges_profile())
+            for run in xrange(2): # neither read from nor written to the cache
+                counting = workflow(3, cache)
+                counting.processors.append(Counting())
+                counting._profile()
+                self.assertEqual(counting.processors[-1].profiled, 20)
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+            files = DPAWorkflow({'trace_count': 3}, base_path=tmp_dir)
+            for i in xrange(1, 4):
+                write_file(os.path.join(tmp_dir, "%06d.dat" % i), buffer_from_list(t_u8, range(10)))
+            key = files._profile_key([1, 2, 3])
+            write_file(os.path.join(tmp_dir, "000002.dat"), buffer_from_list(t_u8, range(20)))
+            self.assertNotEqual(files._profile_key([1, 2, 3]), key)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_stage_cache(self):
+        "cached stage outputs are reused and evicted in lru order"
+        import shutil, tempfile, time
+        from dpa.cache import TraceCache
+        from dpa.traceset import TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import IntegrateProcessor, AverageCountProcessor
+        tmp_dir = tempfile.mkdtemp()
+        tmp_name = os.path.join(tmp_dir, "traces.dts")
+        with TraceSetWriter(tmp_name, t_u8, trace_length=100) as w:
+            for i in xrange(20):
+                w.append(buffer_from_list(t_u8, [(i * 37 + j * j * 11) % 251 for j in xrange(100)]))
+        calls = []
+        class Counting(IntegrateProcessor):
+            def process(self, trace, idx=-1):
+                calls.append(idx)
+                return IntegrateProcessor.process(self, trace, idx)
+        def run(count=3, wrapped=False):
+            w = DPAWorkflow(trace_set=tmp_name)
+            w.profile_cache, w.profile_workers = None, 1
+            w.stage_cache = os.path.join(tmp_dir, "stages")
+            integ = Counting(count=count, dst_type=t_u16)
+            if wrapped: # the void processor must see every trace
+                avg = AverageCountProcessor()(integ)
+                self.assertFalse(avg.cacheable)
+                w.processors = [avg]
+                w.process()
+                return avg.a.avg_counter.get_buf()[0].as_list()
+            avg = AverageCountProcessor(ref=integ)
+            w.processors = [integ, avg]
+            w.process()
+            return avg.avg_counter.get_buf()[0].as_list()
+        try:
+            first = run()
+            self.assertEqual(len(calls), 20 + 20)
+            del calls[:]
+            self.assertEqual(run(), first)
+            self.assertEqual(calls, [-1] * 20) # only the profiling phase
+            del calls[:]
+            self.assertNotEqual(run(count=4), first)
+            self.assertEqual(len(calls), 20 + 20)
+            self.assertTrue(Counting(count=3)(Counting(count=2)).cacheable)
+            self.assertEqual(run(wrapped=True), first)
+            self.assertEqual(run(wrapped=True), first)
+
+            cache = TraceCache(os.path.join(tmp_dir, "lru"), max_size=3 * 108 + 50)
+            bufs = [buffer_from_list(t_u8, [k] * 100) for k in xrange(4)]
+            for k in xrange(3):
+                cache.put("key%d" % k, bufs[k])
+                os.utime(cache._filename("key%d" % k), (k, k))
+            self.assertEqual(cache.get("key0").as_list(), bufs[0].as_list()) # now the most recent entry
+            cache.put("key3", bufs[3])
+            self.assertEqual(cache.get("key1"), None)
+            for k in (0, 2, 3):
+                self.assertEqual(cache.get("key%d" % k).as_list(), bufs[k].as_list())
+            cache.clear()
+            self.assertEqual(cache.size, 0)
+            self.assertEqual(cache.get("key0"), None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_cpu_count(self):
+        from dpa import helpers
+        self.assertEqual(helpers._parse_cpu_list("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+        cpus = helpers.allowed_cpus()
+        self.assertTrue(1 <= helpers.cpu_count() <= len(cpus))
+        import threading
+        res = []
+        t = threading.Thread(target=lambda: res.append((helpers.pin_to_cpu(cpus[-1]), helpers.allowed_cpus())))
+        t.start()
+        t.join()
+        self.assertEqual(res, [(True, [cpus[-1]])])
+
+    def test_workflow_processes(self):
+        "the process backend gives the same results as the thread backend"
+        from dpa.traceset import TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import AverageCountProcessor, CorrelationProcessor
+        from dpa.correlation import Correlator
+        tmp_name = "tmpfile.unittest.dts"
+        with TraceSetWriter(tmp_name, t_u8, trace_length=16) as w:
+            for i in xrange(40):
+                w.append(buffer_from_list(t_u8, [(i * 37 + j * 11) % 251 for j in xrange(16)]))
+        try:
+            results = []
+            for backend in ("threads", "processes"):
+                avg = []
+                c = Correlator(16, 40, 3)
+                for i in xrange(3 * 40):
+                    c.hypo[i] = (i * 7) % 9
+                c.preprocess()
+                w = DPAWorkflow(trace_set=tmp_name)
+                w.backend, w.processes, w.profile_cache = backend, 3, None
+                w.processors = [AverageCountProcessor(callback=lambda a, v, name: avg.append(a.as_list() + v.as_list())),
+                    CorrelationProcessor(correlator=c)]
+                w.process()
+                results.append((avg[0], c.matrix.as_list()))
+        finally:
+            os.unlink(tmp_name)
+        for x, y in zip(*results):
+            self.compareFloatList(x, y, precission=4)
+
+    def test_ttest(self):
+        "the t-test of a workflow matches the direct computation, also merged from several processes"
+        import pickle, random
+        from dpa import ttest
+        from dpa.traceset import TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import TTestProcessor
+        doctest.testmod(ttest)
+        r = random.Random(6)
+        labels = ["fixed" if r.random() < 0.5 else "random" for i in xrange(60)]
+        traces = [[r.randint(0, 200) + (j == 3 and labels[i] == "fixed") * 30 for j in xrange(12)] for i in xrange(60)]
+        direct = ttest.TTest(12, order=3)
+        for x, label in zip(traces, labels):
+            direct.add_trace(buffer_from_list(t_u8, x), 0 if label == "fixed" else 1)
+        self.assertEqual(direct.counts(), (labels.count("fixed"), labels.count("random")))
+        restored = pickle.loads(pickle.dumps(direct, pickle.HIGHEST_PROTOCOL))
+        expected = [direct.t(o).as_list() for o in (1, 2, 3)]
+        self.assertEqual([restored.t(o).as_list() for o in (1, 2, 3)], expected)
+        self.assertTrue(abs(expected[0][3]) > 4)
+        self.assertRaises(Exception, direct.t, 4)
+        import warnings
+        short, full = ttest.TTest(16, order=2), ttest.TTest(8, order=2)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for x, label in zip(traces, labels):
+                short.add_trace(buffer_from_list(t_u8, x), label == "random", length=8)
+                full.add_trace(buffer_from_list(t_u8, x[:8]), label == "random")
+        for o in (1, 2):
+            self.assertEqual(short.t(o).as_list()[:8], full.t(o).as_list())
+        tmp_name = "tmpfile.unittest.dts"
+        with TraceSetWriter(tmp_name, t_u8, trace_length=12) as w:
+            for x in traces:
+                w.append(buffer_from_list(t_u8, x))
+        try:
+            for backend in ("threads", "processes"):
+                res = []
+                w = DPAWorkflow(trace_set=tmp_name)
+                w.backend, w.processes, w.profile_cache = backend, 3, None
+                w.processors = [TTestProcessor(labels, labels=("fixed", "random"), order=3,
+                    callback=lambda t, name: res.extend(x.as_list() for x in t))]
+                w.process()
+                self.assertEqual(len(res), 3)
+                for x, y in zip(res, expected):
+                    self.compareFloatList(x, y, 4)
+        finally:
+            os.unlink(tmp_name)
+        p = TTestProcessor(["fixed", "other"], labels=("fixed", "random"))
+        p.min_size = 8
+        p.process(buffer_from_list(t_u8, traces[0][:8]), idx=0)
+        try:
+            p.process(buffer_from_list(t_u8, traces[1][:8]), idx=1)
+            self.fail("unknown label accepted")
+        except Exception as e:
+            self.assertTrue("trace 1" in str(e) and "'other'" in str(e))
+
+    def test_second_order(self):
+        "the tiles of centered products cover the same correlations as a single pass"
+        from dpa.traceset import TraceSetWriter
+        from dpa.workflow import DPAWorkflow
+        from dpa.processors import SecondOrderProcessor
+        from dpa.correlation import Correlator
+        b = buffer_from_list(t_u8, [1, 4, 6, 9])
+        mean = buffer_from_list(t_float, [2, 2, 2, 2])
+        pairs = buffer_from_list(t_s32, [0, 1, 2, 3, 1, 1])
+        self.assertEqual(centered_product(b, mean, pairs).as_list(), [-2, 28, 4])
+        self.assertRaises(Exception, centered_product, b, mean, buffer_from_list(t_s32, [0, 4]))
+        self.assertEqual(window_pairs(0, 4).as_list(), [0, 1, 0, 2, 0, 3, 1, 2, 1, 3, 2, 3])
+        self.assertEqual(window_pairs(4, 6, (8, 10)).as_list(), [4, 8, 4, 9, 5, 8, 5, 9])
+        self.assertEqual(sum((window_pairs(0, 6, first=i, count=4).as_list() for i in xrange(0, 15, 4)), []),
+            window_pairs(0, 6).as_list())
+        pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+        p = SecondOrderProcessor(window=(0, 6), other=(6, 9), tile_size=4)
+        self.assertEqual((p.count, p.tiles(), p.size), (18, 5, 9))
+        self.assertEqual(sum((p.get_tile(i).as_list() for i in xrange(p.tiles())), []),
+            [k for i in xrange(6) for j in xrange(6, 9) for k in (i, j)])
+        config = p.get_config()
+        p.tile = 1
+        self.assertNotEqual(p.get_config(), config)
+        traces, keys = 40, 3
+        tmp_name = "tmpfile.unittest.dts"
+        with TraceSetWriter(tmp_name, t_u8, trace_length=12) as w:
+            for i in xrange(traces):
+                w.append(buffer_from_list(t_u8, [(i * 37 + j * 11 + i * j * 5) % 251 for j in xrange(12)]))
+        def correlator(samples):
+            c = Correlator(samples, traces, keys)
+            for i in xrange(keys * traces):
+                c.hypo[i] = (i * 7) % 9
+            c.preprocess()
+            return c
+        results = []
+        try:
+            for tile_size in (0, 3):
+                matrices = []
+                w = DPAWorkflow(trace_set=tmp_name)
+                w.profile_cache = None
+                if tile_size:
+                    p = SecondOrderProcessor(window=(0, 4), tile_size=tile_size)
+                else:
+                    p = SecondOrderProcessor(pairs)
+                w.processors = [p]
+                p.correlate(w, correlator, lambda tile, c: matrices.append(c.matrix.as_list()))
+                self.assertEqual(len(matrices), p.tiles())
+                results.append([sum((m[k * len(m) / keys:(k + 1) * len(m) / keys] for m in matrices), [])
+                    for k in xrange(keys)])
+        finally:
+            os.unlink(tmp_name)
+        self.assertEqual(len(results[1][0]), len(pairs))
+        self.compareFloatList(sum(results[0], []), sum(results[1], []), 6)
+
+    def test_leakage(self):
+        "the native leakage models match a python implementation"
+        from dpa import leakage
+        from dpa.helpers import hw
+        from dpa.correlation import Correlator
+        doctest.testmod(leakage)
+        sbox = leakage.AES_SBOX.as_list()
+        data = buffer_from_list(t_u8, [(i * 73) % 256 for i in xrange(2 * 20)])
+        c = Correlator(1, 20, 256)
+        leakage.hypothesis(c, data, stride=2, offset=1, model=leakage.HD, table=leakage.AES_SBOX, ref_offset=0)
+        for k in (0, 1, 0x42, 255):
+            self.assertEqual([c.hypo[k * 20 + t] for t in xrange(20)],
+                [hw(sbox[data[2*t+1] ^ k] ^ data[2*t]) for t in xrange(20)])
+        des = Correlator(1, 20, 64)
+        leakage.hypothesis(des, data, stride=2, model=leakage.VALUE, table=leakage.DES_SBOX[0], keys=64)
+        self.assertEqual(des.hypo[0], leakage.DES_SBOX[0][data[0] & 0x3f])
+        self.assertEqual(leakage.hamming_weight(buffer_from_list(t_u8, [0, 7, 255])).as_list(), [0, 3, 8])
     
 if __name__ == '__main__':
     unittest.main()
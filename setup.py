@@ -7,14 +7,21 @@ setup(
     packages=['dpa'],
     package_dir={'dpa': 'dpa'},
     ext_modules = [
-	Extension("dpa.preprocessor", ["src/dpa/preprocess.c", "src/dpa/preprocessor.pyx"],
+	Extension("dpa.preprocessor", ["src/dpa/preprocess.c", "src/dpa/chain.c", "src/dpa/fir.c", "src/dpa/fft.c", "src/dpa/parallel.c",
+		"src/dpa/simd.c", "src/dpa/preprocessor.pyx"],
 		define_macros=[('WITH_FFT', '1')], libraries=["fftw3"],
 		include_dirs=['./src'],
-		depends=["src/dpa/preprocess.h", "src/dpa/types.pxh", "src/dpa/buffer.pxh", "src/dpa/preprocessor.pxd"]),
+		depends=["src/dpa/preprocess.h", "src/dpa/types.pxh", "src/dpa/buffer.pxh", "src/dpa/preprocessor.pxd",
+			"src/dpa/chain.h", "src/dpa/raster.h", "src/dpa/fir.h", "src/dpa/fft.h", "src/dpa/parallel.h",
+			"src/dpa/simd.h", "src/dpa/_simd.c"]),
 	Extension("dpa.correlation", ["src/dpa/correlator.cpp", "src/dpa/correlation.pyx"],
 		define_macros=[('SHARED', '1')],
 		language="c++",
-		depends=["src/dpa/correlator.h"])
+		depends=["src/dpa/correlator.h"]),
+	Extension("dpa.leakage", ["src/dpa/leakmodel.c", "src/dpa/leakage.pyx"],
+		depends=["src/dpa/leakmodel.h", "src/dpa/preprocessor.pxd"]),
+	Extension("dpa.ttest", ["src/dpa/moments.c", "src/dpa/ttest.pyx"],
+		depends=["src/dpa/moments.h", "src/dpa/preprocessor.pxd"])
 	]
 )
 
@@ -30,19 +30,8 @@ extern "C" {
 #  define NAME(x) x
 #endif
 
-/* define the rasterization configuration only once (__PREPROCESS_H is set at
- * the end of this file which may be included more than once) */
-// TODO: raster_config should be obsoleted and integrated in the appropriate
-// TODO  rasterization functions
-#ifndef __PREPROCESS_H
-struct _raster_config {
-	int trigger;
-	int pause_trigger;
-	int min_pause;
-	int max_pause;
-	int header_size;
-} raster_config = {120, 1100, 3, 6, 128};
-#endif
+#include "raster.h"
+#include "simd.h"
 
 #ifdef __cplusplus
 }
@@ -66,6 +55,25 @@ float NAME(compare)(const data_in_t *d1, const data_in_t *d2, int len) {
 	return res;
 }
 
+/* like compare(), but stops summing up once the result reaches limit. the
+ * result is thus exact if it is below limit and some value >= limit otherwise */
+float NAME(compare_limit)(const data_in_t *d1, const data_in_t *d2, int len, float limit) {
+	int cnt = 0, end;
+	float res = 0;
+
+	while(cnt < len) {
+		/* checking the limit once per block keeps the inner loop branch-free */
+		end = cnt + 16 < len ? cnt + 16 : len;
+		for(; cnt < end; cnt++) {
+			float val = d1[cnt] - d2[cnt];
+			res += (val*val);
+		}
+		if(res >= limit) break;
+	}
+
+	return res;
+}
+
 void NAME(spline)(data_out_t *out, const data_in_t * in, int outsize, int insize) {
 	int i;
 	double scale = (double) (insize-1) / (outsize-1);
@@ -73,6 +81,10 @@ void NAME(spline)(data_out_t *out, const data_in_t * in, int outsize, int insize
 		double inpos = i * scale;
 		int a = inpos;
 		// TODO should we do arithmetic rounding here?
+		if(a >= insize - 1) { // the last sample, in[a+1] is out of bounds
+			out[i] = in[insize - 1];
+			continue;
+		}
 		out[i] = in[a] * (1 - inpos + a) + in[a+1] * (inpos - a); //linear for now
 	}
 }
@@ -82,7 +94,7 @@ size_t NAME(raster_write)(data_out_t * out, const data_in_t *d, int dlen, int pa
 	return dlen+padlen;
 }
 
-int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * out_size, int raster, const data_in_t * edge, size_t edge_len) {
+int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * out_size, int raster, const data_in_t * edge, size_t edge_len, const raster_config_t * config) {
 	int cnt;
 	int last_pos = 0;
 
@@ -96,26 +108,27 @@ int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * ou
 	//size_t in_len = len;
 	data_out_t * out_ptr = out;	
 	
-	in_ptr += raster_config.header_size;
+	in_ptr += config->header_size;
 	// avoid flipping into negative
-	if(len < raster_config.header_size + edge_len) return -1;
-	len -= raster_config.header_size;
+	if(len < config->header_size + edge_len) return -1;
+	len -= config->header_size;
 	
 	tdata = in_ptr;
 	
 	comp_vals = (float *) malloc(len * sizeof(float));
 	//if(!comp_vals) { perror("malloc"); exit(0); }
 	
-	// calc edge matches
+	// calc edge matches. only values below the trigger are ever compared
+	// with each other, so the comparison can stop at the trigger
 	for(cnt=0; cnt < (len - edge_len); cnt++) {
-		float diff = NAME(compare)(tdata+cnt, edge, edge_len);
+		float diff = NAME(compare_limit)(tdata+cnt, edge, edge_len, config->trigger);
 		
 		comp_vals[cnt] = diff;		
 	}
 	
 	for(cnt=0; cnt < (len - edge_len); ) {
 		
-		if(comp_vals[cnt] < raster_config.trigger) {
+		if(comp_vals[cnt] < config->trigger) {
 			int min_val = comp_vals[cnt];
 			int min_pos = cnt;
 			int cnt2;
@@ -133,7 +146,7 @@ int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * ou
 				int distance = min_pos - last_pos;
 				
 				
-				if(raster && start >= raster_config.min_pause && distance < raster_config.pause_trigger / 2) {
+				if(raster && start >= config->min_pause && distance < config->pause_trigger / 2) {
 					if(distance >= raster) {
 						fprintf(stderr, "distance: %d @%d\n", distance, last_pos);
 					}
@@ -149,13 +162,13 @@ int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * ou
 					printf("%d\n",distance);
 				
 				if(min_pos < len - 2*max_distance)
-				if(distance > max_distance && distance < raster_config.pause_trigger)
+				if(distance > max_distance && distance < config->pause_trigger)
 					max_distance = distance;
 
-				if(distance > raster_config.pause_trigger) {
-					assert(start < raster_config.max_pause);
+				if(distance > config->pause_trigger) {
+					assert(start < config->max_pause);
 					start++;
-					if(start >= raster_config.min_pause && !raster)
+					if(start >= config->min_pause && !raster)
 						printf("last_pos: %d, min_pos: %d\n", last_pos, min_pos);
 				}
 			}
@@ -169,7 +182,7 @@ int NAME(raster)(data_out_t * out, const data_in_t * in, size_t len, size_t * ou
 	}
 	free(comp_vals);
 	fprintf(stderr,"max_distance: %d\n",max_distance);
-	if(start != raster_config.min_pause) { fprintf(stderr,"did not start %d", start); return 1; }
+	if(start != config->min_pause) { fprintf(stderr,"did not start %d", start); return 1; }
 	*out_size = out_ptr - out;
 	return start;
 }
@@ -193,15 +206,31 @@ void NAME(average_filter)(data_out_t * out, const data_in_t * in, size_t len, si
 
 void NAME(square_buf)(data_out_t * out, const data_in_t * in, size_t len) {
 	size_t i;
+	if(simd_square(out, SIMD_TYPE(data_out_t), in, SIMD_TYPE(data_in_t), len)) return;
 	for(i=0; i<len; i++)
 		out[i] = in[i] * in[i];
 }
-/* processes a trace updating the sum and square_sum buffers */
-void NAME(add_average)(data_out_t * out_sum, data_out_t * out_square_sum, const data_in_t * in, size_t len) {
+/* welford's update of the running mean and of the sum of squared deviations
+ * m2 (may be NULL) by the count-th trace */
+void NAME(add_moments)(data_out_t * mean, data_out_t * m2, const data_in_t * in, size_t len, size_t count) {
 	size_t i;
+	data_out_t inv = (data_out_t) 1 / count;
+	if(simd_add_moments(mean, m2, SIMD_TYPE(data_out_t), in, SIMD_TYPE(data_in_t), len, inv)) return;
 	for(i=0; i<len; i++) {
-		out_sum[i] += in[i];
-		if(out_square_sum) out_square_sum[i] += in[i] * in[i];
+		data_out_t delta = in[i] - mean[i];
+		mean[i] += delta * inv;
+		if(m2) m2[i] += delta * (in[i] - mean[i]);
+	}
+}
+/* chan's combination of the moments of count_a traces in mean/m2 with the
+ * moments of count_b traces in mean_b/m2_b */
+void NAME(merge_moments)(data_out_t * mean, data_out_t * m2, const data_in_t * mean_b, const data_in_t * m2_b, size_t len, size_t count_a, size_t count_b) {
+	size_t i;
+	double n = (double) count_a + count_b;
+	for(i=0; i<len; i++) {
+		double delta = mean_b[i] - mean[i];
+		mean[i] += delta * count_b / n;
+		if(m2) m2[i] += m2_b[i] + delta * delta * count_a * count_b / n;
 	}
 }
 void NAME(absolute)(data_in_t * out, const data_in_t * in, size_t len, int middle) {
@@ -246,6 +275,7 @@ size_t NAME(peak_extract)(data_in_t * out, const data_in_t * in, size_t len, dou
 
 void NAME(scale)(size_t len, data_out_t * out, const data_in_t * in, int issigned, double scale) {
 	int i;
+	if(simd_scale(out, SIMD_TYPE(data_out_t), in, SIMD_TYPE(data_in_t), len, issigned, scale)) return;
 	//issigned = issigned ? 128 : 0
 	for(i=0;i<len;i++)
 		out[i] = issigned + (in[i] - issigned) * scale;
@@ -254,6 +284,7 @@ void NAME(scale)(size_t len, data_out_t * out, const data_in_t * in, int issigne
 void NAME(diff)(size_t len, data_out_t * out, const data_in_t * a, const data_in_t * b, int absolute) {
 	int i;
 	int issigned = ((data_out_t) -1) < 0 ? 0 : ((data_out_t) -1) / 2 + 1;
+	if(simd_diff(out, SIMD_TYPE(data_out_t), a, b, SIMD_TYPE(data_in_t), len, absolute)) return;
 	for(i=0;i<len;i++) {
 		out[i] = a[i] - b[i];
 		if(absolute && a[i] < b[i])
@@ -282,6 +313,8 @@ void NAME(analyze)(const data_in_t * in, size_t len, double * average, double *
 	data_in_t _min = in[0];
 	data_in_t _max = in[0];
 	
+	if(simd_analyze(in, SIMD_TYPE(data_in_t), len, average, variance, min, max)) return;
+
 	for(i=1; i<len; i++) {
 		_avg += in[i];
 		if(in[i] < _min) _min = in[i];
@@ -308,10 +341,12 @@ void NAME(analyze)(const data_in_t * in, size_t len, double * average, double *
 int NAME(normalize)(data_out_t * out, const data_in_t * in, size_t len, double min, double max) {
 	int issigned = ((data_out_t) -1) < 0;	//probably superfluous
 	data_out_t type_max = issigned ? -1 ^ (1 << (sizeof(data_out_t) * 8 - 1)) : -1;
-	data_out_t type_min = type_max + 1;
-	double scale = (type_max - type_min) / (max - min);
+	data_out_t type_min = (int64_t) type_max + 1;
+	double scale = ((double) type_max - type_min) / (max - min);
+	int ret;
 
 	size_t i;
+	if(simd_normalize(out, SIMD_TYPE(data_out_t), in, SIMD_TYPE(data_in_t), len, min, max, scale, type_min, &ret)) return ret;
 	for(i=0;i<len;i++) {
 		if(in[i] > max || in[i] < min) return -i;
 		out[i] = (in[i] - min) * scale + type_min;
@@ -345,10 +380,24 @@ int NAME(normalize_avg)(size_t len, data_out_t * out, const data_in_t * in, size
 
 void NAME(rectify)(data_out_t * out, const data_in_t * in, size_t len, double avg) {
 	size_t i;
+	if(simd_rectify(out, SIMD_TYPE(data_out_t), in, SIMD_TYPE(data_in_t), len, avg)) return;
 	for(i=0;i<len;i++)
 		out[i] = in[i] > avg ? in[i] - avg : avg - in[i];
 }
 
+/* combines the n sample pairs (pairs[2k], pairs[2k+1]) of the trace in to their
+ * centered products. returns 0 if a pair exceeds the len samples of in */
+int NAME(centered_product)(data_out_t * out, const data_in_t * in, size_t len, const float * mean, const int32_t * pairs, size_t n) {
+	size_t k;
+	for(k=0;k<n;k++) {
+		uint32_t a = pairs[2*k], b = pairs[2*k+1];
+		if(a >= len || b >= len)
+			return 0;
+		out[k] = (in[a] - mean[a]) * (in[b] - mean[b]);
+	}
+	return 1;
+}
+
 void NAME(reorder)(data_out_t * out, const data_in_t * in, size_t len, size_t period) {
 	size_t i;
 	size_t poff[period];
@@ -359,91 +408,6 @@ void NAME(reorder)(data_out_t * out, const data_in_t * in, size_t len, size_t pe
 		out[ poff[i % period] + i / period ] = in[i];
 }
 
-size_t NAME(apply_filter)(data_out_t * out, const data_in_t * in, size_t len, const int8_t * filter, size_t filter_len, double scale, int issigned) {
-	unsigned int filter_sum = 0;
-	double tmp;
-	int i,j;
-	for(i=0;i<filter_len;i++) filter_sum+=filter[i];
-	
-	for(i=0;i<len-filter_len+1;i++) {
-		tmp = 0;
-		for(j=0; j<filter_len; j++)
-			tmp += filter[j] * in[i+j];
-		out[i] = (data_out_t) (issigned + ( ((double) tmp / (double) filter_sum) - issigned) * scale);
-	}
-	return len-filter_len;
-}
-
-/* ********************************************
- * frequency filtering using fourier transform
- * - uses libfftw3 for the transformation
- * TODO currently only implements bandpass operations
- * TODO should be more flexible */
-
-#ifdef WITH_FFT
-#include <complex.h>
-#include <fftw3.h>
-
-#ifndef __PREPROCESS_H
-fftw_plan fftw_plan_forward = NULL;
-fftw_plan fftw_plan_backward = NULL;
-int fftw_plan_size=0;
-#endif
-
-void NAME(fft_filter)(data_out_t * out_data, const data_in_t * in_data, size_t len, int start, int stop, double *scale, double *offset) {
-	double *in;
-	fftw_complex *out;
-	int i;
-
-
-	/* allocate memory */
-	in = (double*) fftw_malloc(sizeof(double) * len + 2);
-	out = (fftw_complex*) fftw_malloc(sizeof(fftw_complex) * (len / 2 + 1));
-
-	/* compute a new computation plan unless there is already one matching the input size */
-	if(len != fftw_plan_size) {
-		if(fftw_plan_forward) fftw_destroy_plan(fftw_plan_forward);
-		if(fftw_plan_backward) fftw_destroy_plan(fftw_plan_backward);
-		fftw_plan_forward  = fftw_plan_dft_r2c_1d(len, in, out, FFTW_ESTIMATE);
-		fftw_plan_backward = fftw_plan_dft_c2r_1d(len, out, in, FFTW_ESTIMATE);
-	}
-
-	/* fill input data */
-	for(i=0;i<len;i++)
-		in[i] = in_data[i];
-
-	fftw_execute(fftw_plan_forward); // do the fft
-
-	/* band pass */
-	//fprintf(stderr, "band pass: %d to %d\n", start, stop);
-	for(i=0;i<start;i++)
-		out[i] = 0;
-	for(i=stop;i<len/2+1;i++)
-		out[i] = 0;
-
-	fftw_execute(fftw_plan_backward); // reverse fft
-
-	int autoscale = *scale == 0;
-	if(autoscale) {
-		double min, max;
-		min = max = in[0];
-		for(i=1;i<len;i++) {
-			if(in[i] < min) min = in[i];
-			if(in[i] > max) max = in[i];
-		}
-		*offset = min;
-		*scale  = 255 / (max - min);
-		//fprintf(stderr, "autoscale: %f (%f)\n", *scale, *offset);
-	} else
-		*scale /= len;
-
-	for(i=0;i<len;i++)
-		out_data[i] = (in[i] - *offset) * *scale;
-
-	fftw_free(in); fftw_free(out);
-}
-#endif
-
 int NAME(load_buf)(const char * filename, data_in_t * buf, size_t len) {
 	FILE * f = fopen(filename, "r");
 	if(!f) {
@@ -0,0 +1,260 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+
+/* the vector kernels of simd.c
+ *
+ * this file is included once per instruction set, with the macros of simd.c
+ * mapping the operations below to its intrinsics and VNAME(x) naming the
+ * variant. Each kernel processes N samples (one register of floats or two
+ * of doubles) per step and computes in the same precision as the
+ * corresponding function of _preprocess.c, so the results are identical.
+ *
+ * analyze() sums up in 8 interleaved partial sums (held in 8 / DN
+ * registers), so its result does not depend on the instruction set. */
+
+#define ACC (8 / DN)
+/* samples per step of analyze(), a multiple of 8 */
+#define STEP (N > 8 ? N : 8)
+
+/* kernels for the input type in_t, LOAD(p) loads N samples as floats and
+ * SQUARE(p) their squares, computed like the scalar code does */
+#define INPUT_KERNELS(sfx, in_t, LOAD, SQUARE, square1) \
+static void VNAME(scale_##sfx)(float * out, const void * in_buf, size_t len, int issigned, double scale) { \
+	const in_t * in = in_buf; \
+	VF s = F_SET1((float) issigned); \
+	VD d = D_SET1(scale), z = D_SET1(issigned); \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) { \
+		VF t = F_SUB(LOAD(in + i), s); \
+		F_STORE(out + i, D_TO_F(D_ADD(z, D_MUL(F_TO_D_LO(t), d)), D_ADD(z, D_MUL(F_TO_D_HI(t), d)))); \
+	} \
+	for(; i < len; i++) \
+		out[i] = issigned + (in[i] - issigned) * scale; \
+} \
+\
+static void VNAME(diff_##sfx)(float * out, const void * a_buf, const void * b_buf, size_t len, int absolute) { \
+	const in_t * a = a_buf, * b = b_buf; \
+	VF zero = F_SET1(0); \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) { \
+		VF x = LOAD(a + i), y = LOAD(b + i); \
+		if(absolute) F_STORE(out + i, F_SEL_LT(x, y, F_SUB(y, x), F_SUB(x, y))); \
+		else F_STORE(out + i, F_ADD(F_SUB(x, y), zero)); \
+	} \
+	for(; i < len; i++) { \
+		out[i] = a[i] - b[i]; \
+		if(absolute && a[i] < b[i]) \
+			out[i] = b[i] - a[i]; \
+		if(!absolute) out[i] += 0; \
+	} \
+} \
+\
+static void VNAME(square_buf_##sfx)(float * out, const void * in_buf, size_t len) { \
+	const in_t * in = in_buf; \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) \
+		F_STORE(out + i, SQUARE(in + i)); \
+	for(; i < len; i++) \
+		out[i] = square1(in[i]); \
+} \
+\
+static void VNAME(add_moments_##sfx)(float * mean, float * m2, const void * in_buf, size_t len, float inv) { \
+	const in_t * in = in_buf; \
+	VF r = F_SET1(inv); \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) { \
+		VF x = LOAD(in + i), delta = F_SUB(x, F_LOAD(mean + i)), m = F_ADD(F_LOAD(mean + i), F_MUL(delta, r)); \
+		F_STORE(mean + i, m); \
+		if(m2) \
+			F_STORE(m2 + i, F_ADD(F_LOAD(m2 + i), F_MUL(delta, F_SUB(x, m)))); \
+	} \
+	for(; i < len; i++) { \
+		float delta = in[i] - mean[i]; \
+		mean[i] += delta * inv; \
+		if(m2) m2[i] += delta * (in[i] - mean[i]); \
+	} \
+} \
+\
+static void VNAME(rectify_##sfx)(float * out, const void * in_buf, size_t len, double avg) { \
+	const in_t * in = in_buf; \
+	VD m = D_SET1(avg); \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) { \
+		VF x = LOAD(in + i); \
+		VD lo = F_TO_D_LO(x), hi = F_TO_D_HI(x); \
+		F_STORE(out + i, D_TO_F(D_SEL_GT(lo, m, D_SUB(lo, m), D_SUB(m, lo)), \
+		                        D_SEL_GT(hi, m, D_SUB(hi, m), D_SUB(m, hi)))); \
+	} \
+	for(; i < len; i++) \
+		out[i] = in[i] > avg ? in[i] - avg : avg - in[i]; \
+} \
+\
+static void VNAME(analyze_##sfx)(const void * in_buf, size_t len, double * average, double * variance, double * min, double * max) { \
+	const in_t * in = in_buf; \
+	size_t i, k, end = len - len % STEP; \
+	VD s[ACC], lo[ACC], hi[ACC], x[2 * STEP / N], a, n = D_SET1(len); \
+	double p[8], mn[8], mx[8], avg; \
+	for(k=0;k<ACC;k++) { \
+		s[k] = D_SET1(0); \
+		lo[k] = hi[k] = D_SET1(in[0]); \
+	} \
+	for(i=0;i<end;i+=STEP) { \
+		for(k=0;k<STEP/N;k++) { \
+			VF f = LOAD(in + i + k * N); \
+			x[2 * k] = F_TO_D_LO(f); \
+			x[2 * k + 1] = F_TO_D_HI(f); \
+		} \
+		for(k=0;k<2*STEP/N;k++) { \
+			s[k % ACC] = D_ADD(s[k % ACC], x[k]); \
+			lo[k % ACC] = D_SEL_LT(x[k], lo[k % ACC], x[k], lo[k % ACC]); \
+			hi[k % ACC] = D_SEL_GT(x[k], hi[k % ACC], x[k], hi[k % ACC]); \
+		} \
+	} \
+	for(k=0;k<ACC;k++) { \
+		D_STORE(p + k * DN, s[k]); \
+		D_STORE(mn + k * DN, lo[k]); \
+		D_STORE(mx + k * DN, hi[k]); \
+	} \
+	for(i=end;i<len;i++) { \
+		p[i % 8] += in[i]; \
+		if(in[i] < mn[i % 8]) mn[i % 8] = in[i]; \
+		if(in[i] > mx[i % 8]) mx[i % 8] = in[i]; \
+	} \
+	avg = simd_sum8(p) / len; \
+	if(variance) { \
+		a = D_SET1(avg); \
+		for(k=0;k<ACC;k++) \
+			s[k] = D_SET1(0); \
+		for(i=0;i<end;i+=STEP) { \
+			for(k=0;k<STEP/N;k++) { \
+				VF f = LOAD(in + i + k * N); \
+				x[2 * k] = D_SUB(F_TO_D_LO(f), a); \
+				x[2 * k + 1] = D_SUB(F_TO_D_HI(f), a); \
+			} \
+			for(k=0;k<2*STEP/N;k++) \
+				s[k % ACC] = D_ADD(s[k % ACC], D_DIV(D_MUL(x[k], x[k]), n)); \
+		} \
+		for(k=0;k<ACC;k++) \
+			D_STORE(p + k * DN, s[k]); \
+		for(i=end;i<len;i++) { \
+			double dev = in[i] - avg; \
+			p[i % 8] += (dev * dev) / len; \
+		} \
+		*variance = simd_sum8(p); \
+	} \
+	if(average) *average = avg; \
+	if(min)     *min     = simd_min8(mn); \
+	if(max)     *max     = simd_max8(mx); \
+}
+
+static inline VF VNAME(load_u8)(const uint8_t * p) {
+	return I_TO_F(I_LOAD_U8(p));
+}
+static inline VF VNAME(load_u16)(const uint16_t * p) {
+	return I_TO_F(I_LOAD_U16(p));
+}
+static inline VF VNAME(load_s16)(const int16_t * p) {
+	return I_TO_F(I_LOAD_S16(p));
+}
+static inline VF VNAME(load_f)(const float * p) {
+	return F_LOAD(p);
+}
+/* integer squares wrap around like the int multiplication of the scalar code */
+static inline VF VNAME(square_u8)(const uint8_t * p) {
+	return I_TO_F(I_SQUARE(I_LOAD_U8(p)));
+}
+static inline VF VNAME(square_u16)(const uint16_t * p) {
+	return I_TO_F(I_SQUARE(I_LOAD_U16(p)));
+}
+static inline VF VNAME(square_s16)(const int16_t * p) {
+	return I_TO_F(I_SQUARE(I_LOAD_S16(p)));
+}
+static inline VF VNAME(square_f)(const float * p) {
+	VF x = F_LOAD(p);
+	return F_MUL(x, x);
+}
+
+INPUT_KERNELS(u8,  uint8_t,  VNAME(load_u8),  VNAME(square_u8),  simd_square_int)
+INPUT_KERNELS(u16, uint16_t, VNAME(load_u16), VNAME(square_u16), simd_square_int)
+INPUT_KERNELS(f,   float,    VNAME(load_f),   VNAME(square_f),   simd_square_float)
+INPUT_KERNELS(s16, int16_t,  VNAME(load_s16), VNAME(square_s16), simd_square_int)
+
+/* normalize() of floats to the integer type out_t, STORE(p, lo, hi) stores
+ * the integer part of N doubles to p */
+#define NORMALIZE_KERNEL(sfx, out_t, STORE) \
+static void VNAME(normalize_##sfx)(void * out_buf, const void * in_buf, size_t len, \
+                                   double min, double max, double scale, double type_min, int * ret) { \
+	const float * in = in_buf; \
+	out_t * out = out_buf; \
+	VD lo = D_SET1(min), hi = D_SET1(max), d = D_SET1(scale), t = D_SET1(type_min); \
+	size_t i = 0; \
+	for(; i + N <= len; i += N) { \
+		VF f = F_LOAD(in + i); \
+		VD a = F_TO_D_LO(f), b = F_TO_D_HI(f); \
+		if(D_OUTSIDE(a, lo, hi) || D_OUTSIDE(b, lo, hi)) \
+			break; /* the scalar loop reports the sample */ \
+		STORE(out + i, D_ADD(D_MUL(D_SUB(a, lo), d), t), D_ADD(D_MUL(D_SUB(b, lo), d), t)); \
+	} \
+	for(; i < len; i++) { \
+		if(in[i] > max || in[i] < min) { \
+			*ret = -i; \
+			return; \
+		} \
+		out[i] = (in[i] - min) * scale + type_min; \
+	} \
+	*ret = 1; \
+}
+
+NORMALIZE_KERNEL(u8_f,  uint8_t,  D_STORE_U8)
+NORMALIZE_KERNEL(u16_f, uint16_t, D_STORE_U16)
+
+static const simd_kernels_t VNAME(kernels) = {
+	{VNAME(scale_u8), VNAME(scale_u16), VNAME(scale_f), VNAME(scale_s16)},
+	{VNAME(diff_u8), VNAME(diff_u16), VNAME(diff_f), VNAME(diff_s16)},
+	{VNAME(square_buf_u8), VNAME(square_buf_u16), VNAME(square_buf_f), VNAME(square_buf_s16)},
+	{VNAME(add_moments_u8), VNAME(add_moments_u16), VNAME(add_moments_f), VNAME(add_moments_s16)},
+	{VNAME(rectify_u8), VNAME(rectify_u16), VNAME(rectify_f), VNAME(rectify_s16)},
+	{VNAME(analyze_u8), VNAME(analyze_u16), VNAME(analyze_f), VNAME(analyze_s16)},
+	{VNAME(normalize_u8_f), VNAME(normalize_u16_f)}
+};
+
+#undef ACC
+#undef STEP
+#undef INPUT_KERNELS
+#undef NORMALIZE_KERNEL
+
+/* the macros of the instruction set */
+#undef VNAME
+#undef VF
+#undef VD
+#undef VI
+#undef N
+#undef DN
+#undef F_LOAD
+#undef F_STORE
+#undef F_SET1
+#undef F_ADD
+#undef F_SUB
+#undef F_MUL
+#undef F_SEL_LT
+#undef I_LOAD_U8
+#undef I_LOAD_U16
+#undef I_LOAD_S16
+#undef I_TO_F
+#undef I_SQUARE
+#undef D_SET1
+#undef D_ADD
+#undef D_SUB
+#undef D_MUL
+#undef D_DIV
+#undef D_STORE
+#undef D_SEL_GT
+#undef D_SEL_LT
+#undef D_OUTSIDE
+#undef F_TO_D_LO
+#undef F_TO_D_HI
+#undef D_TO_F
+#undef D_STORE_U8
+#undef D_STORE_U16
@@ -0,0 +1,276 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#include <stdint.h>
+#include <stddef.h>
+#include <stdlib.h>
+
+#include "chain.h"
+
+/**************************************
+ * fused processing chains
+ *
+ * a chain applies several preprocessing steps (average_filter, integrate,
+ * rectify, peak_extract, normalize) in a single pass. Each input sample is
+ * pushed through all stages, which keep their running sums and windows in
+ * a small state, so no intermediate trace is written to memory.
+ *
+ * samples are passed between the stages as doubles, which represent all
+ * supported types exactly. After each stage the value is converted to the
+ * output type of the stage, so the result is identical to calling the
+ * separate functions with the same types. */
+
+#define TYPE_FLOAT  0x24
+#define TYPE_DOUBLE 0x28
+
+/* samples are processed in blocks of this size, which stay in the L1 cache
+ * while passing through all stages */
+#define CHAIN_BLOCK 1024
+
+typedef struct {
+	double * window; /* the last n input samples (ring buffer) */
+	size_t   pos;    /* position of the oldest sample in window */
+	size_t   seen;   /* number of input samples so far */
+	double   acc;    /* running sum / current peak maximum */
+	int      state;  /* peak extraction state */
+	double   scale;  /* normalization factor */
+	double   type_min;
+} chain_state_t;
+
+int chain_supports_type(int type) {
+	switch(type) {
+	case 0x01: case 0x11: case 0x02: case 0x12: case 0x04: case 0x14:
+	case TYPE_FLOAT: case TYPE_DOUBLE:
+		return 1;
+	}
+	return 0;
+}
+
+/* converts v to the given type, as an assignment in C would */
+static inline double chain_cast(double v, int type) {
+	switch(type) {
+	case 0x01: return (int8_t)   (int64_t) v;
+	case 0x11: return (uint8_t)  (int64_t) v;
+	case 0x02: return (int16_t)  (int64_t) v;
+	case 0x12: return (uint16_t) (int64_t) v;
+	case 0x04: return (int32_t)  (int64_t) v;
+	case 0x14: return (uint32_t) (int64_t) v;
+	case TYPE_FLOAT: return (float) v;
+	}
+	return v;
+}
+
+#define CAST_BLOCK(c_type) for(i=0;i<n;i++) v[i] = (c_type) (int64_t) v[i]; break;
+static void chain_cast_block(double * v, size_t n, int type) {
+	size_t i;
+	switch(type) {
+	case 0x01: CAST_BLOCK(int8_t)
+	case 0x11: CAST_BLOCK(uint8_t)
+	case 0x02: CAST_BLOCK(int16_t)
+	case 0x12: CAST_BLOCK(uint16_t)
+	case 0x04: CAST_BLOCK(int32_t)
+	case 0x14: CAST_BLOCK(uint32_t)
+	case TYPE_FLOAT: for(i=0;i<n;i++) v[i] = (float) v[i]; break;
+	}
+}
+
+/* converts n samples of the given type to doubles and back, these are also
+ * used by the fir and fft filters */
+int block_supports_type(int type) {
+	return chain_supports_type(type) || type == 0x18;
+}
+
+#define READ_BLOCK(c_type) for(i=0;i<n;i++) v[i] = ((const c_type *) buf)[i]; break;
+void chain_read_block(double * v, const void * buf, size_t n, int type) {
+	size_t i;
+	switch(type) {
+	case 0x01: READ_BLOCK(int8_t)
+	case 0x11: READ_BLOCK(uint8_t)
+	case 0x02: READ_BLOCK(int16_t)
+	case 0x12: READ_BLOCK(uint16_t)
+	case 0x04: READ_BLOCK(int32_t)
+	case 0x14: READ_BLOCK(uint32_t)
+	case 0x18: READ_BLOCK(uint64_t)
+	case TYPE_FLOAT: READ_BLOCK(float)
+	default: READ_BLOCK(double)
+	}
+}
+
+#define WRITE_BLOCK(c_type) for(i=0;i<n;i++) ((c_type *) buf)[i] = v[i]; break;
+void chain_write_block(void * buf, const double * v, size_t n, int type) {
+	size_t i;
+	switch(type) {
+	case 0x01: WRITE_BLOCK(int8_t)
+	case 0x11: WRITE_BLOCK(uint8_t)
+	case 0x02: WRITE_BLOCK(int16_t)
+	case 0x12: WRITE_BLOCK(uint16_t)
+	case 0x04: WRITE_BLOCK(int32_t)
+	case 0x14: WRITE_BLOCK(uint32_t)
+	case 0x18: WRITE_BLOCK(uint64_t)
+	case TYPE_FLOAT: WRITE_BLOCK(float)
+	default: WRITE_BLOCK(double)
+	}
+}
+
+/* returns an upper bound of the number of output samples for len input samples */
+size_t chain_output_length(const chain_stage_t * stages, size_t n_stages, size_t len) {
+	size_t k;
+	for(k=0;k<n_stages;k++) {
+		if(stages[k].kind == CHAIN_AVERAGE || stages[k].kind == CHAIN_INTEGRATE)
+			len = len >= stages[k].n ? len - stages[k].n + 1 : 0;
+	}
+	return len;
+}
+
+#define CAST_S8(x)  ((int8_t)   (int64_t) (x))
+#define CAST_U8(x)  ((uint8_t)  (int64_t) (x))
+#define CAST_S16(x) ((int16_t)  (int64_t) (x))
+#define CAST_U16(x) ((uint16_t) (int64_t) (x))
+#define CAST_S32(x) ((int32_t)  (int64_t) (x))
+#define CAST_U32(x) ((uint32_t) (int64_t) (x))
+#define CAST_FLOAT(x)  ((float) (x))
+#define CAST_DOUBLE(x) (x)
+/* float sums assigned to an integer output */
+#define CAST_VIA_FLOAT(x) chain_cast((float) (x), s->out_type)
+
+/* sliding sum of the last n samples, in the precision of the output type
+ * as given by CAST */
+#define INTEGRATE_LOOP(CAST) \
+		for(j=0;j<*n;j++) { \
+			x = v[j]; \
+			st->window[st->pos] = x; \
+			st->pos = st->pos + 1 == s->n ? 0 : st->pos + 1; \
+			st->acc = CAST(st->acc + x); \
+			if(st->seen < s->n - 1) { \
+				st->seen++; \
+				continue; \
+			} \
+			v[m++] = st->acc; \
+			st->acc = CAST(st->acc - st->window[st->pos]); \
+		} \
+		break;
+
+/* feeds the n samples of v into stage s, replacing them by the m <= n
+ * samples produced by the stage. returns m, or -1 on a normalization error,
+ * in which case *n is set to the index of the failing sample in v */
+static long chain_step(const chain_stage_t * s, chain_state_t * st, double * v, size_t * n) {
+	size_t j, m = 0;
+	double x;
+	/* integer sums are exact, float sums are rounded to float as in C */
+	int float_arith = (s->out_type == TYPE_FLOAT || s->in_type == TYPE_FLOAT)
+	               && s->out_type != TYPE_DOUBLE && s->in_type != TYPE_DOUBLE;
+
+	switch(s->kind) {
+	case CHAIN_AVERAGE:
+		for(j=0;j<*n;j++) {
+			x = v[j];
+			st->window[st->pos] = x;
+			st->pos = st->pos + 1 == s->n ? 0 : st->pos + 1;
+			st->acc += x;
+			if(st->seen < s->n - 1) {
+				st->seen++;
+				continue;
+			}
+			v[m++] = st->acc / s->n * s->a;
+			st->acc -= st->window[st->pos]; /* the oldest sample of the window */
+		}
+		chain_cast_block(v, m, s->out_type);
+		return m;
+	case CHAIN_INTEGRATE:
+		if(float_arith && s->out_type != TYPE_FLOAT) {
+			INTEGRATE_LOOP(CAST_VIA_FLOAT)
+			return m;
+		}
+		switch(s->out_type) {
+		case 0x01: INTEGRATE_LOOP(CAST_S8)
+		case 0x11: INTEGRATE_LOOP(CAST_U8)
+		case 0x02: INTEGRATE_LOOP(CAST_S16)
+		case 0x12: INTEGRATE_LOOP(CAST_U16)
+		case 0x04: INTEGRATE_LOOP(CAST_S32)
+		case 0x14: INTEGRATE_LOOP(CAST_U32)
+		case TYPE_FLOAT: INTEGRATE_LOOP(CAST_FLOAT)
+		default: INTEGRATE_LOOP(CAST_DOUBLE)
+		}
+		return m;
+	case CHAIN_RECTIFY:
+		for(j=0;j<*n;j++)
+			v[j] = v[j] > s->a ? v[j] - s->a : s->a - v[j];
+		chain_cast_block(v, *n, s->out_type);
+		return *n;
+	case CHAIN_PEAK:
+		for(j=0;j<*n;j++) {
+			x = v[j];
+			if(st->seen++ == 0) st->acc = x;
+			if(st->state == 0 && x < s->a - s->b) { st->state++; st->acc = x; }
+			if(st->state != 0 && x > st->acc) st->acc = x;
+			if(st->state == 1 && x > s->a + s->b) st->state++;
+			if(st->state == 2 && x < s->a - s->b) {
+				st->state = 1;
+				v[m++] = st->acc;
+				st->acc = x;
+			}
+		}
+		return m;
+	case CHAIN_NORMALIZE:
+		for(j=0;j<*n;j++) {
+			if(v[j] > s->b || v[j] < s->a) {
+				*n = j;
+				return -1;
+			}
+			v[j] = (v[j] - s->a) * st->scale + st->type_min;
+		}
+		chain_cast_block(v, *n, s->out_type);
+		return *n;
+	}
+	return *n;
+}
+
+/* runs the chain of n_stages stages over len samples of in, writing
+ * the result to out, which must have space for chain_output_length()
+ * samples.
+ * returns the number of samples written or -1 if a normalize stage failed,
+ * in which case error_index and error_value describe the failing sample */
+long chain_run(const chain_stage_t * stages, size_t n_stages, const void * in, size_t len,
+               void * out, size_t * error_index, double * error_value) {
+	chain_state_t * st = calloc(n_stages, sizeof(chain_state_t));
+	size_t * seen = calloc(n_stages, sizeof(size_t));
+	double v[CHAIN_BLOCK];
+	size_t i, k, pos = 0;
+	long ret = 0;
+	for(k=0;k<n_stages;k++) {
+		if(stages[k].kind == CHAIN_AVERAGE || stages[k].kind == CHAIN_INTEGRATE)
+			st[k].window = malloc(sizeof(double) * stages[k].n);
+		if(stages[k].kind == CHAIN_NORMALIZE) {
+			/* the range of the (integer) output type, as in normalize() */
+			int bits = (stages[k].out_type & 0xf) * 8;
+			st[k].type_min = stages[k].out_type & 0x10 ? 0 : -(double) (1 << (bits - 1));
+			st[k].scale = (double) ((1 << bits) - 1) / (stages[k].b - stages[k].a);
+		}
+	}
+
+	for(i=0;i<len && ret >= 0;i+=CHAIN_BLOCK) {
+		size_t n = len - i < CHAIN_BLOCK ? len - i : CHAIN_BLOCK;
+		chain_read_block(v, (const char *) in + i * (stages[0].in_type & 0xf), n, stages[0].in_type);
+		for(k=0;k<n_stages && n;k++) {
+			ret = chain_step(&stages[k], &st[k], v, &n);
+			if(ret < 0) {
+				*error_index = seen[k] + n;
+				*error_value = v[n];
+				break;
+			}
+			seen[k] += n;
+			n = ret;
+		}
+		if(ret >= 0) {
+			chain_write_block((char *) out + pos * (stages[n_stages - 1].out_type & 0xf), v, n, stages[n_stages - 1].out_type);
+			pos += n;
+		}
+	}
+
+	for(k=0;k<n_stages;k++)
+		free(st[k].window);
+	free(st);
+	free(seen);
+	return ret < 0 ? -1 : (long) pos;
+}
@@ -0,0 +1,28 @@
+#include <stdint.h>
+#include <stddef.h>
+
+/* stages of a fused processing chain, see chain_run() */
+#define CHAIN_AVERAGE   0
+#define CHAIN_INTEGRATE 1
+#define CHAIN_RECTIFY   2
+#define CHAIN_PEAK      3
+#define CHAIN_NORMALIZE 4
+
+/* configuration of a single stage. The stage reads samples of in_type and
+ * produces samples of out_type (buffer type codes as in types.pxh) */
+typedef struct {
+	int    kind;
+	int    in_type;
+	int    out_type;
+	size_t n;        /* window length of CHAIN_AVERAGE and CHAIN_INTEGRATE */
+	double a;        /* scale / avg / avg / min, depending on the kind */
+	double b;        /* - / - / - / std_dev / max */
+} chain_stage_t;
+
+int    chain_supports_type(int type);
+int    block_supports_type(int type);
+void   chain_read_block(double * v, const void * buf, size_t n, int type);
+void   chain_write_block(void * buf, const double * v, size_t n, int type);
+size_t chain_output_length(const chain_stage_t * stages, size_t n_stages, size_t len);
+long   chain_run(const chain_stage_t * stages, size_t n_stages, const void * in, size_t len,
+               void * out, size_t * error_index, double * error_value);
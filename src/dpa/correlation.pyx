@@ -3,14 +3,21 @@
 
 import os, sys
 import pickle
-from preprocessor cimport Buffer, _Buffer
+import struct
+from libc.stdlib cimport malloc, free
+from preprocessor cimport Buffer, _Buffer, _contiguous
 from preprocessor import types, Buffer#, _Buffer
-from correlator cimport Correlator as CCorrelator, correlator_add_trace_u8, correlator_add_trace_u16, correlator_add_trace_float, _F
+from helpers import cpu_count
+from correlator cimport ACCUMULATOR_DOUBLE, ACCUMULATOR_INT64
+from correlator cimport Correlator as CCorrelator, correlator_add_trace_u8, correlator_add_trace_u16, correlator_add_trace_s16, correlator_add_trace_s32, correlator_add_trace_float, _F
 from stdint cimport *
 
+# header of the state files written by Correlator.dump_state
+state_header = struct.Struct("=8sII6Q")
+
 cdef class Correlator:
 	"""
-	Correlator(samples, traces, keys)
+	Correlator(samples, traces, keys, shards=0, accumulator='double')
 	
 	creates a new :class:`Correlator` instance used to rapidly calculate
 	correlations in a DPA scenario
@@ -21,6 +28,19 @@ cdef class Correlator:
 		is the total number of traces to be processed
 	*keys*
 		is the number of hypothesis
+	*shards*
+		is the number of private accumulator sets, by default the number of
+		cpus (see :func:`dpa.helpers.cpu_count`). Threads adding traces
+		concurrently work on different shards without waiting for each other,
+		so there should be at least one per worker thread. Each shard used
+		takes (*keys* + 2) * *samples* * 8 bytes of memory.
+	*accumulator*
+		is either ``'double'`` or ``'int64'``. The latter sums up
+		:attr:`dpa.preprocessor.types.uint8_t`, ``uint16_t`` and ``int16_t``
+		traces in exact integer arithmetic, which is faster and does not lose
+		precision over many millions of traces (the squares of 16 bit samples
+		overflow after 2^31 traces). Float and ``int32_t`` traces can only be
+		added to a ``'double'`` accumulator.
 
 	>>> c = Correlator(2, 3, 1) #create a new correlator
 	>>> c.hypo[0] = 5           #calculate a hypothesis for each trace
@@ -44,17 +64,26 @@ cdef class Correlator:
 	cdef Buffer        _hypo
 	cdef Buffer        _matrix
 
-	def __init__(self, samples, traces, keys):
-		self._cor   = new CCorrelator(samples, traces, keys)
+	accumulators = {'double': ACCUMULATOR_DOUBLE, 'int64': ACCUMULATOR_INT64}
+
+	def __init__(self, samples, traces, keys, shards=0, accumulator='double'):
+		if accumulator not in self.accumulators:
+			raise Exception("unknown accumulator %r" % accumulator)
+		if shards <= 0:
+			shards = cpu_count()
+		self._cor   = new CCorrelator(samples, traces, keys, shards, self.accumulators[accumulator])
 		self.count  = 0
 		self._hypo   = _Buffer(self._cor.hypo,   keys * traces,  types.uint8_t)
 		self._matrix = _Buffer(self._cor.matrix, keys * samples, types.double)
+		self._hypo.base = self._matrix.base = self
 		self.preprocessed = False
 
 	property hypo:
+		"the (keys x traces) hypothesis :class:`dpa.preprocessor.Buffer`, supports the buffer protocol"
 		def __get__(self):
 			return self._hypo
 	property matrix:
+		"the (keys x samples) correlation :class:`dpa.preprocessor.Buffer`, supports the buffer protocol"
 		def __get__(self):
 			return self._matrix
 
@@ -70,6 +99,8 @@ cdef class Correlator:
 		"""
 		if not self.preprocessed:
 			raise Exception("need to call preprocess() prior to adding traces")
+		buf = _contiguous(buf)
+		self._check_type(buf.type)
 		if idx == -1:
 			idx = self.count
 			self.count += 1
@@ -80,10 +111,95 @@ cdef class Correlator:
 		elif buf.type == types.uint16_t:
 			with nogil:
 				self._cor.add_trace_u16(idx, <uint16_t *> buf.buf)
+		elif buf.type == types.int16_t:
+			with nogil:
+				self._cor.add_trace_s16(idx, <int16_t *> buf.buf)
+		elif buf.type == types.int32_t:
+			with nogil:
+				self._cor.add_trace_s32(idx, <int32_t *> buf.buf)
 		elif buf.type == types.float:
 			with nogil:
 				self._cor.add_trace_float(idx, <float *> buf.buf)
 
+	def _check_type(self, int type):
+		if type not in (types.uint8_t, types.uint16_t, types.int16_t, types.int32_t, types.float):
+			raise Exception("unsupported trace type %x" % type)
+		if (type & 0x20 or type == types.int32_t) and self._cor.accumulator == ACCUMULATOR_INT64:
+			raise Exception("float and int32_t traces need a 'double' accumulator")
+
+	def add_traces(self, buffers, idxs=None):
+		"""
+		add_traces(buffers, idxs=None)
+
+		processes a block of traces (a sequence of :class:`dpa.preprocessor.Buffer`
+		objects of the same type) at once. This is considerably faster than
+		calling :meth:`add_trace` for each of them, as the traces are processed
+		in cache-sized tiles. Blocks of 64 to 512 traces work best.
+
+		*idxs* is an optional sequence of trace numbers, one for each buffer,
+		allowing to add traces in arbitrary order
+
+		>>> from preprocessor import buffer_from_list
+		>>> c = Correlator(2, 3, 1)
+		>>> for i, h in enumerate([5, 4, 3]): c.hypo[i] = h
+		>>> c.preprocess()
+		>>> c.add_traces([buffer_from_list(types.uint8_t, l) for l in ([10, 0], [8, 30], [6, 15])])
+		>>> c.update_matrix()
+		>>> [round(v, 2) for v in c.matrix.as_list()]
+		[1.0, -0.5]
+		"""
+		if not self.preprocessed:
+			raise Exception("need to call preprocess() prior to adding traces")
+		cdef int n = len(buffers)
+		if n == 0:
+			return
+		cdef int auto_idx = idxs is None
+		if auto_idx:
+			idxs = range(self.count, self.count + n)
+		elif len(idxs) != n:
+			raise Exception("need exactly one index for each trace")
+		buffers = [_contiguous(b) for b in buffers]
+
+		cdef Buffer buf = buffers[0]
+		cdef int type = buf.type
+		self._check_type(type)
+
+		cdef void ** bufs = <void **> malloc(n * sizeof(void *))
+		cdef int *   idx  = <int *>   malloc(n * sizeof(int))
+		cdef int i
+		try:
+			for i in range(n):
+				buf = buffers[i]
+				if buf.type != type:
+					raise Exception("all traces must be of the same type")
+				if buf.length < self._cor.samples:
+					raise Exception("trace %d is shorter than %d samples" % (i, self._cor.samples))
+				bufs[i] = buf.buf
+				idx[i]  = idxs[i]
+				if idx[i] < 0 or idx[i] >= self._cor.traces:
+					raise Exception("trace index %d out of range" % idx[i])
+
+			if type == types.uint8_t:
+				with nogil:
+					self._cor.add_traces_u8(n, idx, <uint8_t **> bufs)
+			elif type == types.uint16_t:
+				with nogil:
+					self._cor.add_traces_u16(n, idx, <uint16_t **> bufs)
+			elif type == types.int16_t:
+				with nogil:
+					self._cor.add_traces_s16(n, idx, <int16_t **> bufs)
+			elif type == types.int32_t:
+				with nogil:
+					self._cor.add_traces_s32(n, idx, <int32_t **> bufs)
+			else:
+				with nogil:
+					self._cor.add_traces_float(n, idx, <float **> bufs)
+			if auto_idx:
+				self.count += n
+		finally:
+			free(bufs)
+			free(idx)
+
 	def preprocess(self):
 		"preprocesses the hypothesis. MUST be called before adding the first trace"
 		self._cor.preprocess()
@@ -93,6 +209,81 @@ cdef class Correlator:
 		"updates the correlation matrix. MUST be called before accessing the matrix"
 		self._cor.update_matrix()
 
+	def reset(self):
+		"""
+		reset()
+
+		discards all added traces, keeping the preprocessed hypothesis
+		"""
+		with nogil:
+			self._cor.reset()
+		self.count = 0
+
+	def dump_state(self, filename):
+		"""
+		dump_state(filename)
+
+		stores the hypothesis, key statistics and accumulated sums to *filename*
+
+		The state can be restored with :meth:`load_state` and combined with
+		other states using :meth:`merge`. This allows to split the processing
+		of a large trace set across processes or machines. The file format
+		stores all arrays aligned, so the file can also be memory-mapped.
+		"""
+		cdef char * cfilename = filename
+		cdef int ret
+		with nogil:
+			ret = self._cor.dump_state(cfilename)
+		if ret != 1:
+			raise IOError("failed to write correlator state to %s" % filename)
+
+	@staticmethod
+	def load_state(filename, shards=0):
+		"""
+		load_state(filename, shards=0) -> :class:`Correlator`
+
+		creates a new :class:`Correlator` from a state file written by :meth:`dump_state`
+
+		The returned instance is already preprocessed and can directly
+		be used to add further traces, to :meth:`merge` or to :meth:`update_matrix`.
+		"""
+		with open(filename) as f:
+			header = f.read(state_header.size)
+		if len(header) != state_header.size:
+			raise IOError("%s is not a correlator state" % filename)
+		magic, version, accumulator, samples, traces, keys, count, r1, r2 = state_header.unpack(header)
+		names = dict((v, k) for k, v in Correlator.accumulators.items())
+		if magic.rstrip('\0') != "DPACORR" or accumulator not in names:
+			raise IOError("%s is not a correlator state" % filename)
+
+		cdef Correlator c = Correlator(samples, traces, keys, shards, names[accumulator])
+		cdef char * cfilename = filename
+		cdef int ret
+		with nogil:
+			ret = c._cor.load_state(cfilename)
+		if ret != 1:
+			raise IOError("failed to load correlator state from %s" % filename)
+		c.count = count
+		c.preprocessed = True
+		return c
+
+	def merge(self, Correlator other):
+		"""
+		merge(other)
+
+		adds the traces processed by the :class:`Correlator` *other* to this instance
+
+		Both instances must have the same dimensions, accumulator and hypothesis
+		and should have processed disjoint sets of traces. The result is then
+		the same as if all traces had been added to a single instance.
+		"""
+		cdef int ret
+		with nogil:
+			ret = self._cor.merge(other._cor)
+		if ret != 1:
+			raise Exception("cannot merge correlators of different dimensions, accumulators or hypotheses")
+		self.count += other.count
+
 def dump_matrix(f, m, keys, samples):
 	"""
 	dump a octave readable form of the :attr:`Correlator.matrix` *m* to
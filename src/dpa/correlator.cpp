@@ -13,24 +13,75 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <sys/mman.h>
 
 #include "correlator.h"
 
-#define NUM_THREADS 4
+/* number of samples processed at once by add_traces, chosen so that a tile of
+ * each trace and of one mult_sum row stay in cache while iterating the keys */
+#define SAMPLE_BLOCK 512
 
-Correlator::Correlator(int _samples, int _traces, int _keys) {
+/* the memory of shards no thread has used yet stays untouched, so that
+ * having more shards than active threads costs no physical memory */
+template <class acc_t> static acc_t * new_zeroed(size_t len) {
+	return (acc_t *) calloc(len, sizeof(acc_t));
+}
+
+/* allocates the zeroed accumulators of a shard. Depending on the accumulator
+ * mode either the floating point or the integer arrays are used */
+static void shard_init(correlator_shard_t * s, size_t samples, size_t keys, int accumulator) {
+	s->count = 0;
+	s->sum = s->square_sum = s->mult_sum = NULL;
+	s->isum = s->isquare_sum = s->imult_sum = NULL;
+	if(accumulator == ACCUMULATOR_INT64) {
+		s->isum        = new_zeroed<int64_t>(samples);
+		s->isquare_sum = new_zeroed<int64_t>(samples);
+		s->imult_sum   = new_zeroed<int64_t>(keys * samples);
+	} else {
+		s->sum         = new_zeroed<intermediate_result_t>(samples);
+		s->square_sum  = new_zeroed<intermediate_result_t>(samples);
+		s->mult_sum    = new_zeroed<intermediate_result_t>(keys * samples);
+	}
+	pthread_mutex_init(&s->lock, NULL);
+}
+
+static void shard_clear(correlator_shard_t * s, size_t samples, size_t keys) {
+	if(s->count == 0) /* unused */
+		return;
+	s->count = 0;
+	if(s->sum) {
+		memset(s->sum,        0, sizeof(*s->sum) * samples);
+		memset(s->square_sum, 0, sizeof(*s->square_sum) * samples);
+		memset(s->mult_sum,   0, sizeof(*s->mult_sum) * keys * samples);
+	}
+	if(s->isum) {
+		memset(s->isum,        0, sizeof(*s->isum) * samples);
+		memset(s->isquare_sum, 0, sizeof(*s->isquare_sum) * samples);
+		memset(s->imult_sum,   0, sizeof(*s->imult_sum) * keys * samples);
+	}
+}
+
+static void shard_free(correlator_shard_t * s) {
+	free(s->sum);
+	free(s->square_sum);
+	free(s->mult_sum);
+	free(s->isum);
+	free(s->isquare_sum);
+	free(s->imult_sum);
+	pthread_mutex_destroy(&s->lock);
+}
+
+Correlator::Correlator(int _samples, int _traces, int _keys, int _shards, int _accumulator) {
 	count   = 0;
 	samples = _samples;
 	traces  = _traces;
 	keys    = _keys;
-	
-	sum        = new intermediate_result_t[samples];
-	square_sum = new intermediate_result_t[samples];
-	mult_sum   = new intermediate_result_t[keys * samples];
+	n_shards= _shards > 0 ? _shards : 1;
+	accumulator = _accumulator;
 
-	memset(sum,        0, sizeof(intermediate_result_t) * samples);
-	memset(square_sum, 0, sizeof(intermediate_result_t) * samples);
-	memset(mult_sum,   0, sizeof(intermediate_result_t) * samples * keys);
+	shards  = new correlator_shard_t[n_shards];
+	for(size_t i=0;i<n_shards;i++)
+		shard_init(&shards[i], samples, keys, accumulator);
 
 	key_avg    = new double[keys];
 	key_stddev = new double[keys];
@@ -39,42 +90,94 @@ Correlator::Correlator(int _samples, int _traces, int _keys) {
 
 	matrix     = new double[keys * samples];
 	byte_matrix= new uint8_t[keys * samples];
-
-	key_lock   = new pthread_mutex_t[keys];
-	for(size_t i=0;i<keys;i++)
-		pthread_mutex_init(&key_lock[i], NULL);
-	pthread_mutex_init(&data_lock, NULL);
 }
 
 Correlator::~Correlator() {
-	delete [] sum;
-	delete [] square_sum;
-	delete [] mult_sum;
+	for(size_t i=0;i<n_shards;i++)
+		shard_free(&shards[i]);
+	delete [] shards;
 	delete [] key_avg;
 	delete [] key_stddev;
+	delete [] hypo;
 	delete [] matrix;
 	delete [] byte_matrix;
-	delete [] key_lock;
+}
+
+/* the threads adding traces are numbered in the order of their first trace */
+static size_t thread_count = 0;
+static __thread size_t thread_index = 0;
+
+/* locks a shard for exclusive use by the calling thread
+ *
+ * each thread starts probing at its own shard, so that as long as there are
+ * at least as many shards as worker threads, threads never wait on each other */
+correlator_shard_t * Correlator::acquire_shard() {
+	if(thread_index == 0)
+		thread_index = __sync_add_and_fetch(&thread_count, 1);
+	size_t start = (thread_index - 1) % n_shards;
+	for(size_t i=0;i<n_shards;i++) {
+		correlator_shard_t * s = &shards[(start + i) % n_shards];
+		if(pthread_mutex_trylock(&s->lock) == 0)
+			return s;
+	}
+	pthread_mutex_lock(&shards[start].lock);
+	return &shards[start];
+}
+
+void Correlator::release_shard(correlator_shard_t * s) {
+	pthread_mutex_unlock(&s->lock);
+}
+
+/* adds n traces to the accumulators
+ *
+ * the update of mult_sum is the product of the (keys x n) hypothesis matrix h
+ * with the (n x samples) trace matrix d. It is computed in tiles of
+ * SAMPLE_BLOCK samples, so that the trace tiles are reused from cache for
+ * every key */
+template <class acc_t, class data_in_t>
+static void accumulate(acc_t * sum, acc_t * square_sum, acc_t * mult_sum,
+                       const hypo_in_t * h, size_t n, data_in_t ** d,
+                       size_t keys, size_t samples) {
+	size_t i,j,t,start,stop;
+	for(start=0;start<samples;start+=SAMPLE_BLOCK) {
+		stop = start + SAMPLE_BLOCK < samples ? start + SAMPLE_BLOCK : samples;
+		for(j=0;j<keys;j++) {
+			acc_t * row = mult_sum + j*samples;
+			for(t=0;t<n;t++) {
+				acc_t key = h[j*n + t];
+				const data_in_t * dt = d[t];
+				if(!key) continue;
+				for(i=start;i<stop;i++)
+					row[i] += key * (acc_t) dt[i];
+			}
+		}
+	}
+	for(t=0;t<n;t++) {
+		const data_in_t * dt = d[t];
+		for(i=0;i<samples;i++) {
+			sum[i]        += dt[i];
+			square_sum[i] += (acc_t) dt[i] * dt[i];
+		}
+	}
+}
+
+/* integer accumulation is only available for traces of up to 16 bit, whose
+ * squares cannot overflow the sums. The float and int32 instantiations exist
+ * to keep the add_traces macro type independent */
+template <>
+void accumulate<int64_t, float>(int64_t *, int64_t *, int64_t *, const hypo_in_t *,
+                                size_t, float **, size_t, size_t) {
+	fprintf(stderr, "Error: float traces cannot be added to an int64 accumulator\n");
+}
+template <>
+void accumulate<int64_t, int32_t>(int64_t *, int64_t *, int64_t *, const hypo_in_t *,
+                                  size_t, int32_t **, size_t, size_t) {
+	fprintf(stderr, "Error: int32 traces cannot be added to an int64 accumulator\n");
 }
 
 #define add_trace(name, data_in_t) \
 void Correlator::add_trace_##name(int hypo_idx, data_in_t * d) {\
-	size_t i,j;\
-	hypo_in_t key;\
-	for(j=0;j<keys;j++) {\
-		key = hypo[j*traces + hypo_idx];\
-		pthread_mutex_lock(&key_lock[j]);\
-		for(i=0;i<samples;i++)\
-			mult_sum[j*samples + i] += key * d[i];\
-		pthread_mutex_unlock(&key_lock[j]);\
-	}\
-	pthread_mutex_lock(&data_lock);\
-	for(i=0;i<samples;i++) {\
-		sum[i]        += d[i];\
-		square_sum[i] += d[i] * d[i];\
-	}\
-	count++;\
-	pthread_mutex_unlock(&data_lock);\
+	add_traces_##name(1, &hypo_idx, &d);\
 } \
 extern "C" { \
 void correlator_add_trace_##name(Correlator * c, int hypo_idx, data_in_t * buf) {\
@@ -82,43 +185,107 @@ void correlator_add_trace_##name(Correlator * c, int hypo_idx, data_in_t * buf)
 } \
 }
 
+#define add_traces(name, data_in_t) \
+void Correlator::add_traces_##name(int n, int * hypo_idx, data_in_t ** d) {\
+	size_t j,t;\
+	hypo_in_t * h = new hypo_in_t[keys * n];\
+	for(j=0;j<keys;j++)\
+		for(t=0;t<n;t++)\
+			h[j*n + t] = hypo[j*traces + hypo_idx[t]];\
+	correlator_shard_t * s = acquire_shard();\
+	if(accumulator == ACCUMULATOR_INT64)\
+		accumulate(s->isum, s->isquare_sum, s->imult_sum, h, n, d, keys, samples);\
+	else\
+		accumulate(s->sum, s->square_sum, s->mult_sum, h, n, d, keys, samples);\
+	s->count += n;\
+	release_shard(s);\
+	delete [] h;\
+} \
+extern "C" { \
+void correlator_add_traces_##name(Correlator * c, int n, int * hypo_idx, data_in_t ** bufs) {\
+	c->add_traces_##name(n, hypo_idx, bufs);\
+} \
+}
+
 add_trace(u8,   uint8_t)
 add_trace(u16,  uint16_t)
+add_trace(s16,  int16_t)
+add_trace(s32,  int32_t)
 add_trace(float,float)
 
+add_traces(u8,   uint8_t)
+add_traces(u16,  uint16_t)
+add_traces(s16,  int16_t)
+add_traces(s32,  int32_t)
+add_traces(float,float)
+
+/* sums up the accumulators of all shards. The mult_sum reduction is written
+ * to matrix, which is then converted in place by update_matrix()
+ *
+ * integer accumulators are summed up exactly and only converted at the end */
+template <class acc_t, class out_t>
+static void reduce_shards(out_t * out, acc_t * correlator_shard_t::*field, correlator_shard_t * shards, size_t n_shards, size_t len) {
+	size_t i,k;
+	for(i=0;i<len;i++) {
+		acc_t v = 0;
+		for(k=0;k<n_shards;k++)
+			v += (shards[k].*field)[i];
+		out[i] = v;
+	}
+}
+
+void Correlator::reduce(double * sum, double * square_sum) {
+	size_t k;
+	for(k=0;k<n_shards;k++)
+		pthread_mutex_lock(&shards[k].lock);
+
+	count = 0;
+	for(k=0;k<n_shards;k++)
+		count += shards[k].count;
+	if(accumulator == ACCUMULATOR_INT64) {
+		reduce_shards(sum,        &correlator_shard_t::isum,        shards, n_shards, samples);
+		reduce_shards(square_sum, &correlator_shard_t::isquare_sum, shards, n_shards, samples);
+		reduce_shards(matrix,     &correlator_shard_t::imult_sum,   shards, n_shards, keys * samples);
+	} else {
+		reduce_shards(sum,        &correlator_shard_t::sum,         shards, n_shards, samples);
+		reduce_shards(square_sum, &correlator_shard_t::square_sum,  shards, n_shards, samples);
+		reduce_shards(matrix,     &correlator_shard_t::mult_sum,    shards, n_shards, keys * samples);
+	}
+
+	for(k=0;k<n_shards;k++)
+		pthread_mutex_unlock(&shards[k].lock);
+}
+
 /* updates the output matrix by calculating the correlation values
  * from the intermediate result */
 void Correlator::update_matrix() {
 	size_t i,j;
 	double min=-1, max=1;
+	double * sum        = new double[samples];
+	double * square_sum = new double[samples];
+
+	reduce(sum, square_sum);
 	if(count < traces) fprintf(stderr, "Warning: this is a prelimary result (%zu / %zu)\n", count, traces);
 	if(count > traces) fprintf(stderr, "Error: too many traces read (%zu / %zu)\n", count, traces);
 
 	for(j=0;j<keys;j++) {
 		for(i=0;i<samples;i++) {
-			double cur_avg = (double) sum[i] / count;
+			double cur_avg = sum[i] / count;
 
-			double cur = (mult_sum[j*samples + i] - sum[i] * key_avg[j]) 
-			                   / sqrt((double) square_sum[i] / count - cur_avg * cur_avg)
+			double cur = (matrix[j*samples + i] - sum[i] * key_avg[j]) 
+			                   / sqrt(square_sum[i] / count - cur_avg * cur_avg)
 			                   / key_stddev[j]
 			                   / count; //(count - 1);
 			matrix[j*samples + i] = cur;
 			if(cur > max) max = cur;
 			if(cur < min) min = cur;
-
-			/*if(i <= 1) fprintf(stderr, "[%d,%d] %lf %lf %lf %zd %lf %lf %lf %lf\n", i, j,
-			mult_sum[j*samples + i] - sum[i] * key_avg[j],
-			sqrt((double) square_sum[i] / count - cur_avg * cur_avg),
-			matrix[j*samples + i],
-			count,
-			mult_sum[j*samples + i],
-			(double) sum[i] * key_avg[j],
-			key_stddev[j],
-			key_avg[j]);/**/
 		}
 	}
 	for(j=0; j<keys*samples; j++)
 		byte_matrix[j] = ((double) matrix[j] - min) * 255. / (max-min);
+
+	delete [] sum;
+	delete [] square_sum;
 }
 
 /* calculates average and standard deviation for the hypothesis vectors */
@@ -139,6 +306,180 @@ void Correlator::preprocess() {
 	}
 }
 
+/***********************************
+ * state serialization and merging
+ *
+ * a state file consists of a correlator_state_header_t followed by the
+ * arrays key_avg, key_stddev, hypo (padded to 8 bytes), sum, square_sum and
+ * mult_sum. The accumulator arrays are stored in the accumulator type, so
+ * every array is 8-byte aligned and the file can be memory-mapped */
+
+#define STATE_MAGIC   "DPACORR"
+#define STATE_VERSION 1
+
+static size_t state_hypo_size(size_t keys, size_t traces) {
+	return (keys * traces * sizeof(hypo_in_t) + 7) & ~(size_t) 7;
+}
+
+static size_t state_size(size_t samples, size_t traces, size_t keys) {
+	return sizeof(correlator_state_header_t) + 2 * keys * sizeof(double)
+	     + state_hypo_size(keys, traces) + (keys + 2) * samples * 8;
+}
+
+/* adds count traces worth of accumulated sums (given in the accumulator
+ * type) to one of the shards */
+template <class acc_t>
+static void add_to_shard(acc_t * sum, acc_t * square_sum, acc_t * mult_sum,
+                         const acc_t * state, size_t samples, size_t keys) {
+	size_t i;
+	for(i=0;i<samples;i++)
+		sum[i] += state[i];
+	state += samples;
+	for(i=0;i<samples;i++)
+		square_sum[i] += state[i];
+	state += samples;
+	for(i=0;i<keys*samples;i++)
+		mult_sum[i] += state[i];
+}
+
+void Correlator::add_state(size_t n, const void * state) {
+	correlator_shard_t * s = acquire_shard();
+	if(accumulator == ACCUMULATOR_INT64)
+		add_to_shard(s->isum, s->isquare_sum, s->imult_sum, (const int64_t *) state, samples, keys);
+	else
+		add_to_shard(s->sum, s->square_sum, s->mult_sum, (const intermediate_result_t *) state, samples, keys);
+	s->count += n;
+	release_shard(s);
+}
+
+/* sums up all shards into state (sum, square_sum, mult_sum) in the
+ * accumulator type, returning the total number of traces */
+size_t Correlator::get_state(void * state) {
+	size_t k, n = 0;
+	for(k=0;k<n_shards;k++)
+		pthread_mutex_lock(&shards[k].lock);
+
+	for(k=0;k<n_shards;k++)
+		n += shards[k].count;
+	if(accumulator == ACCUMULATOR_INT64) {
+		int64_t * out = (int64_t *) state;
+		reduce_shards(out,             &correlator_shard_t::isum,        shards, n_shards, samples);
+		reduce_shards(out + samples,   &correlator_shard_t::isquare_sum, shards, n_shards, samples);
+		reduce_shards(out + 2*samples, &correlator_shard_t::imult_sum,   shards, n_shards, keys * samples);
+	} else {
+		intermediate_result_t * out = (intermediate_result_t *) state;
+		reduce_shards(out,             &correlator_shard_t::sum,         shards, n_shards, samples);
+		reduce_shards(out + samples,   &correlator_shard_t::square_sum,  shards, n_shards, samples);
+		reduce_shards(out + 2*samples, &correlator_shard_t::mult_sum,    shards, n_shards, keys * samples);
+	}
+
+	for(k=0;k<n_shards;k++)
+		pthread_mutex_unlock(&shards[k].lock);
+	return n;
+}
+
+/* writes the complete state to a file, returns 1 on success */
+int Correlator::dump_state(const char * filename) {
+	correlator_state_header_t header;
+	size_t acc_len = (keys + 2) * samples;
+	size_t hypo_size = state_hypo_size(keys, traces);
+	uint8_t * state = new uint8_t[acc_len * 8 + hypo_size];
+	int ret = 1;
+
+	memset(&header, 0, sizeof(header));
+	memcpy(header.magic, STATE_MAGIC, sizeof(header.magic));
+	header.version     = STATE_VERSION;
+	header.accumulator = accumulator;
+	header.samples     = samples;
+	header.traces      = traces;
+	header.keys        = keys;
+	header.count       = get_state(state + hypo_size);
+
+	memset(state, 0, hypo_size);
+	memcpy(state, hypo, keys * traces * sizeof(hypo_in_t));
+
+	FILE * f = fopen(filename, "w");
+	if(!f) {
+		fprintf(stderr, "%s", filename);
+		perror("fopen");
+		delete [] state;
+		return 0;
+	}
+	if(fwrite(&header,    sizeof(header), 1,    f) != 1
+	|| fwrite(key_avg,    sizeof(double), keys, f) != keys
+	|| fwrite(key_stddev, sizeof(double), keys, f) != keys
+	|| fwrite(state, 1, acc_len * 8 + hypo_size, f) != acc_len * 8 + hypo_size) {
+		fprintf(stderr, "%s", filename);
+		perror("fwrite");
+		ret = 0;
+	}
+	if(fclose(f) != 0) ret = 0;
+	delete [] state;
+	return ret;
+}
+
+/* maps a state file and adds its accumulated sums to this instance
+ * hypothesis and key statistics are taken over from the file.
+ * returns 1 on success, 0 on io errors and -1 if the file does not match */
+int Correlator::load_state(const char * filename) {
+	struct stat st;
+	int fd = open(filename, O_RDONLY);
+	if(fd < 0) {
+		fprintf(stderr, "%s", filename);
+		perror("open");
+		return 0;
+	}
+	if(fstat(fd, &st) < 0 || (size_t) st.st_size < sizeof(correlator_state_header_t)) {
+		close(fd);
+		return -1;
+	}
+	void * map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if(map == MAP_FAILED) {
+		perror("mmap");
+		return 0;
+	}
+
+	const correlator_state_header_t * header = (const correlator_state_header_t *) map;
+	int ret = -1;
+	if(memcmp(header->magic, STATE_MAGIC, sizeof(header->magic)) == 0
+	&& header->version == STATE_VERSION && header->accumulator == (uint32_t) accumulator
+	&& header->samples == samples && header->traces == traces && header->keys == keys
+	&& (size_t) st.st_size == state_size(samples, traces, keys)) {
+		const uint8_t * p = (const uint8_t *) (header + 1);
+		memcpy(key_avg,    p, keys * sizeof(double)); p += keys * sizeof(double);
+		memcpy(key_stddev, p, keys * sizeof(double)); p += keys * sizeof(double);
+		memcpy(hypo,       p, keys * traces * sizeof(hypo_in_t));
+		p += state_hypo_size(keys, traces);
+		add_state(header->count, p);
+		ret = 1;
+	}
+	munmap(map, st.st_size);
+	return ret;
+}
+
+/* discards all added traces. The hypothesis and its preprocessing are kept */
+void Correlator::reset() {
+	for(size_t i=0;i<n_shards;i++)
+		shard_clear(&shards[i], samples, keys);
+	count = 0;
+}
+
+/* adds the accumulated sums of other to this instance. Both instances must
+ * have been created with the same dimensions and the same hypothesis.
+ * returns 1 on success and -1 if the instances do not match */
+int Correlator::merge(Correlator * other) {
+	if(other->samples != samples || other->traces != traces || other->keys != keys
+	|| other->accumulator != accumulator
+	|| memcmp(other->hypo, hypo, keys * traces * sizeof(hypo_in_t)) != 0)
+		return -1;
+	uint8_t * state = new uint8_t[(keys + 2) * samples * 8];
+	size_t n = other->get_state(state);
+	add_state(n, state);
+	delete [] state;
+	return 1;
+}
+
 /* C API functions
  * these are accessable even if CPP code cannot be directly used */
 extern "C" {
@@ -160,8 +501,8 @@ void dump_matrix(FILE * f, Correlator * c) {
 
 #ifdef SHARED
 /* creates a new correlator instance */
-Correlator * correlator_init(int samples, int traces, int keys) {
-	return new Correlator(samples, traces, keys);
+Correlator * correlator_init(int samples, int traces, int keys, int shards, int accumulator) {
+	return new Correlator(samples, traces, keys, shards, accumulator);
 }
 
 void correlator_free(Correlator * c) {
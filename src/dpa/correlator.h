@@ -1,19 +1,52 @@
 #include <stdint.h>
+#include <pthread.h>
 
 typedef uint8_t hypo_in_t;
 typedef double  intermediate_result_t;
 #define DATA_IN_FMTSTRING "%hhu"
 
-class Correlator {
+/* accumulator modes: ACCUMULATOR_INT64 sums up integer traces exactly */
+#define ACCUMULATOR_DOUBLE 0
+#define ACCUMULATOR_INT64  1
+
+/* a private set of accumulators. Concurrent add_trace calls work on
+ * different shards, which are only summed up in update_matrix() */
+typedef struct {
 	intermediate_result_t * sum;
 	intermediate_result_t * mult_sum;
 	intermediate_result_t * square_sum;
+	int64_t * isum;
+	int64_t * imult_sum;
+	int64_t * isquare_sum;
+	size_t count;
+
+	pthread_mutex_t lock;
+} correlator_shard_t;
+
+/* header of a serialized correlator state, see Correlator::dump_state */
+typedef struct {
+	char     magic[8];
+	uint32_t version;
+	uint32_t accumulator;
+	uint64_t samples;
+	uint64_t traces;
+	uint64_t keys;
+	uint64_t count;
+	uint64_t reserved[2];
+} correlator_state_header_t;
+
+class Correlator {
+	correlator_shard_t * shards;
+	size_t n_shards;
 
 	double    * key_avg;
 	double    * key_stddev;
 
-	pthread_mutex_t * key_lock;
-	pthread_mutex_t data_lock;
+	correlator_shard_t * acquire_shard();
+	void release_shard(correlator_shard_t *);
+	void reduce(double *, double *);
+	size_t get_state(void *);
+	void add_state(size_t, const void *);
     public:
 	hypo_in_t * hypo;
 	double    * matrix;
@@ -23,15 +56,28 @@ class Correlator {
 	size_t traces;
 	size_t keys;
 	size_t count;
+	int    accumulator;
 
-	Correlator(int,int,int);
+	Correlator(int,int,int,int=1,int=ACCUMULATOR_DOUBLE);
 	~Correlator();
 	void add_trace_u8(int, uint8_t *);
 	void add_trace_u16(int, uint16_t *);
+	void add_trace_s16(int, int16_t *);
+	void add_trace_s32(int, int32_t *);
 	void add_trace_float(int, float *);
+	void add_traces_u8(int, int *, uint8_t **);
+	void add_traces_u16(int, int *, uint16_t **);
+	void add_traces_s16(int, int *, int16_t **);
+	void add_traces_s32(int, int *, int32_t **);
+	void add_traces_float(int, int *, float **);
 
 	void update_matrix();
 	void preprocess();
+	void reset();
+
+	int dump_state(const char *);
+	int load_state(const char *);
+	int merge(Correlator *);
 };
 
 extern "C" {
@@ -39,9 +85,16 @@ extern "C" {
 
 	void correlator_add_trace_u8(Correlator * c, int hypo_idx, uint8_t * buf);
 	void correlator_add_trace_u16(Correlator * c, int hypo_idx, uint16_t * buf);
+	void correlator_add_trace_s16(Correlator * c, int hypo_idx, int16_t * buf);
+	void correlator_add_trace_s32(Correlator * c, int hypo_idx, int32_t * buf);
 	void correlator_add_trace_float(Correlator * c, int hypo_idx, float * buf);
+	void correlator_add_traces_u8(Correlator * c, int n, int * hypo_idx, uint8_t ** bufs);
+	void correlator_add_traces_u16(Correlator * c, int n, int * hypo_idx, uint16_t ** bufs);
+	void correlator_add_traces_s16(Correlator * c, int n, int * hypo_idx, int16_t ** bufs);
+	void correlator_add_traces_s32(Correlator * c, int n, int * hypo_idx, int32_t ** bufs);
+	void correlator_add_traces_float(Correlator * c, int n, int * hypo_idx, float ** bufs);
 
-	Correlator * correlator_init(int samples, int traces, int keys);
+	Correlator * correlator_init(int samples, int traces, int keys, int shards, int accumulator);
 	void         correlator_free(Correlator * c);
 
 	void correlator_preprocess(Correlator * c);
@@ -2,6 +2,10 @@ from stdint cimport *
 
 cdef extern from "correlator.h":
 	ctypedef uint8_t hypo_in_t
+	enum:
+		ACCUMULATOR_DOUBLE
+		ACCUMULATOR_INT64
+
 	cdef cppclass Correlator:
 		hypo_in_t * hypo
 		double    * matrix
@@ -11,18 +15,34 @@ cdef extern from "correlator.h":
 		size_t traces
 		size_t keys
 		size_t count
+		int    accumulator
 
-		Correlator(int,int,int)
+		Correlator(int,int,int,int,int)
 
 		void update_matrix()
 		void preprocess()
+		void reset() nogil
+
+		int dump_state(char * filename) nogil
+		int load_state(char * filename) nogil
+		int merge(Correlator * other) nogil
 
 		void add_trace_u8(int hypo_idx, void * d) nogil
 		void add_trace_u16(int hypo_idx, void * d) nogil
+		void add_trace_s16(int hypo_idx, void * d) nogil
+		void add_trace_s32(int hypo_idx, void * d) nogil
 		void add_trace_float(int hypo_idx, void * d) nogil
 
+		void add_traces_u8(int n, int * hypo_idx, uint8_t ** d) nogil
+		void add_traces_u16(int n, int * hypo_idx, uint16_t ** d) nogil
+		void add_traces_s16(int n, int * hypo_idx, int16_t ** d) nogil
+		void add_traces_s32(int n, int * hypo_idx, int32_t ** d) nogil
+		void add_traces_float(int n, int * hypo_idx, float ** d) nogil
+
 	void correlator_add_trace_u8(Correlator * c, int hypo_idx, void * buf) nogil
 	void correlator_add_trace_u16(Correlator * c, int hypo_idx, void * buf) nogil
+	void correlator_add_trace_s16(Correlator * c, int hypo_idx, void * buf) nogil
+	void correlator_add_trace_s32(Correlator * c, int hypo_idx, void * buf) nogil
 	void correlator_add_trace_float(Correlator * c, int hypo_idx, void * buf) nogil
 
 cdef struct _F:
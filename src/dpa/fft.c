@@ -0,0 +1,163 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#include <stdint.h>
+#include <stddef.h>
+#include <stdlib.h>
+#include <string.h>
+
+#ifdef WITH_FFT
+#include <complex.h>
+#include <fftw3.h>
+#include <pthread.h>
+
+#include "chain.h"
+#include "fft.h"
+
+/**************************************
+ * fftw plans
+ *
+ * creating a plan is expensive and the fftw planner is not thread-safe, so
+ * plans are created once per length, direction and batch size, under a lock,
+ * and cached for the lifetime of the process. Executing a plan on new arrays
+ * (fftw_execute_dft_r2c/c2r) is thread-safe, so all threads share the
+ * cached plans. The arrays need the alignment of fftw_malloc().
+ *
+ * batched plans transform howmany consecutive arrays of len samples
+ * (len / 2 + 1 bins respectively) at once. */
+
+typedef struct fft_plan_entry {
+	int    direction;
+	size_t len;
+	size_t howmany;
+	fftw_plan plan;
+	struct fft_plan_entry * next;
+} fft_plan_entry_t;
+
+static pthread_mutex_t fft_lock = PTHREAD_MUTEX_INITIALIZER;
+static fft_plan_entry_t * fft_plans = NULL;
+static unsigned fft_planner_flags = FFTW_ESTIMATE;
+
+/* returns the cached plan, creating it if necessary. returns NULL on failure */
+fftw_plan fft_plan(int direction, size_t len, size_t howmany) {
+	fft_plan_entry_t * e;
+	double * x;
+	fftw_complex * X;
+	int n = len;
+	size_t bins = len / 2 + 1;
+
+	pthread_mutex_lock(&fft_lock);
+	for(e=fft_plans;e;e=e->next)
+		if(e->direction == direction && e->len == len && e->howmany == howmany)
+			break;
+	if(!e && (e = calloc(1, sizeof(fft_plan_entry_t)))) {
+		/* planning may overwrite the arrays, so use scratch arrays */
+		x = fftw_malloc(sizeof(double) * len * howmany);
+		X = fftw_malloc(sizeof(fftw_complex) * bins * howmany);
+		if(x && X) {
+			if(direction == FFT_R2C)
+				e->plan = fftw_plan_many_dft_r2c(1, &n, howmany, x, NULL, 1, len, X, NULL, 1, bins, fft_planner_flags);
+			else
+				e->plan = fftw_plan_many_dft_c2r(1, &n, howmany, X, NULL, 1, bins, x, NULL, 1, len, fft_planner_flags);
+		}
+		fftw_free(x);
+		fftw_free(X);
+		if(e->plan) {
+			e->direction = direction;
+			e->len = len;
+			e->howmany = howmany;
+			e->next = fft_plans;
+			fft_plans = e;
+		} else {
+			free(e);
+			e = NULL;
+		}
+	}
+	pthread_mutex_unlock(&fft_lock);
+	return e ? e->plan : NULL;
+}
+
+/* sets the planner flags (FFTW_ESTIMATE, FFTW_MEASURE, ...) of new plans */
+void fft_set_planner_flags(unsigned flags) {
+	pthread_mutex_lock(&fft_lock);
+	fft_planner_flags = flags;
+	pthread_mutex_unlock(&fft_lock);
+}
+
+/* loads and stores the accumulated planning knowledge, returns 0 on failure */
+int fft_import_wisdom(const char * filename) {
+	int ret;
+	pthread_mutex_lock(&fft_lock);
+	ret = fftw_import_wisdom_from_filename(filename);
+	pthread_mutex_unlock(&fft_lock);
+	return ret;
+}
+
+int fft_export_wisdom(const char * filename) {
+	int ret;
+	pthread_mutex_lock(&fft_lock);
+	ret = fftw_export_wisdom_to_filename(filename);
+	pthread_mutex_unlock(&fft_lock);
+	return ret;
+}
+
+/**************************************
+ * frequency filtering
+ *
+ * applies a band pass to count traces of len samples, keeping the frequency
+ * bins start to stop - 1. Up to FFT_BATCH_SAMPLES samples of short traces
+ * are transformed at a time.
+ * returns 0 on success or -1 if memory ran out */
+int fft_bandpass(const void * const * in, int in_type, size_t len, size_t count,
+                 void * const * out, int out_type, size_t start, size_t stop) {
+	/* batches of short traces fit into the cache */
+	size_t batch = len < FFT_BATCH_SAMPLES ? FFT_BATCH_SAMPLES / len : 1;
+	size_t bins = len / 2 + 1;
+	size_t i, j, k, b;
+	double * x;
+	fftw_complex * X;
+	fftw_plan forward, backward;
+
+	if(count == 0 || len == 0) return 0;
+	if(batch > count) batch = count;
+	if(stop > bins) stop = bins;
+	if(start > stop) start = stop;
+	x = fftw_malloc(sizeof(double) * len * batch);
+	X = fftw_malloc(sizeof(fftw_complex) * bins * batch);
+	if(!x || !X) {
+		fftw_free(x); fftw_free(X);
+		return -1;
+	}
+
+	for(i=0;i<count;i+=batch) {
+		b = count - i < batch ? count - i : batch;
+		forward  = fft_plan(FFT_R2C, len, b);
+		backward = fft_plan(FFT_C2R, len, b);
+		if(!forward || !backward) {
+			fftw_free(x); fftw_free(X);
+			return -1;
+		}
+		for(k=0;k<b;k++)
+			chain_read_block(x + k * len, in[i + k], len, in_type);
+
+		fftw_execute_dft_r2c(forward, x, X);
+
+		/* band pass */
+		for(k=0;k<b;k++) {
+			memset(X + k * bins, 0, sizeof(fftw_complex) * start);
+			memset(X + k * bins + stop, 0, sizeof(fftw_complex) * (bins - stop));
+		}
+
+		fftw_execute_dft_c2r(backward, X, x); // reverse fft
+
+		/* fftw does not normalize the transformations */
+		for(j=0;j<len*b;j++)
+			x[j] /= len;
+		for(k=0;k<b;k++)
+			chain_write_block(out[i + k], x + k * len, len, out_type);
+	}
+	fftw_free(x); fftw_free(X);
+	return 0;
+}
+#endif
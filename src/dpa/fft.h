@@ -0,0 +1,18 @@
+#include <stdint.h>
+#include <stddef.h>
+
+/* directions of cached plans, see fft_plan() */
+#define FFT_R2C 0
+#define FFT_C2R 1
+
+/* number of samples of short traces transformed by one plan in fft_bandpass() */
+#define FFT_BATCH_SAMPLES 32768
+
+#ifdef FFTW3_H
+fftw_plan fft_plan(int direction, size_t len, size_t howmany);
+#endif
+void fft_set_planner_flags(unsigned flags);
+int  fft_import_wisdom(const char * filename);
+int  fft_export_wisdom(const char * filename);
+int  fft_bandpass(const void * const * in, int in_type, size_t len, size_t count,
+                  void * const * out, int out_type, size_t start, size_t stop);
@@ -0,0 +1,198 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#include <stdint.h>
+#include <stddef.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "chain.h"
+#include "fir.h"
+
+/**************************************
+ * fir filters
+ *
+ * a filter of n coefficients c computes
+ *   out[i] = offset + (sum_j c[j] * in[i+j] / divisor - offset) * scale
+ * for the len - n + 1 positions where it fully overlaps the input.
+ *
+ * short filters are applied directly, in blocks so that the compiler can
+ * vectorize the inner loop over the output samples. Long filters are applied
+ * by fft convolution using overlap-save: each block of fft_size input samples
+ * is transformed, multiplied by the precomputed frequency response and
+ * transformed back, which yields fft_size - n + 1 valid output samples.
+ *
+ * a prepared filter is read-only while filtering, so the same filter can be
+ * used by several threads at once. */
+
+#define FIR_BLOCK 1024
+
+#ifdef WITH_FFT
+#include <complex.h>
+#include <fftw3.h>
+#include "fft.h"
+#endif
+
+struct fir {
+	double * coeffs;
+	size_t   n;
+	double   divisor;
+	int      method;
+	size_t   fft_size;
+#ifdef WITH_FFT
+	fftw_complex * response; /* of the reversed coefficients, including 1 / (fft_size * divisor) */
+	fftw_plan forward;       /* shared plans, see fft_plan() */
+	fftw_plan backward;
+#endif
+};
+
+int fir_method(const fir_t * f) {
+	return f->method;
+}
+
+size_t fir_output_length(const fir_t * f, size_t len) {
+	return len >= f->n ? len - f->n + 1 : 0;
+}
+
+#ifdef WITH_FFT
+static int fir_prepare_fft(fir_t * f) {
+	size_t N = 1024, j;
+	double * x;
+	while(N < 8 * f->n) N <<= 1;
+	f->fft_size = N;
+	x = fftw_malloc(sizeof(double) * N);
+	f->response = fftw_malloc(sizeof(fftw_complex) * (N / 2 + 1));
+	if(!x || !f->response) {
+		fftw_free(x);
+		return 0;
+	}
+	f->forward  = fft_plan(FFT_R2C, N, 1);
+	f->backward = fft_plan(FFT_C2R, N, 1);
+	if(!f->forward || !f->backward) {
+		fftw_free(x);
+		return 0;
+	}
+
+	/* filtering computes a correlation, i.e. a convolution with the reversed coefficients */
+	memset(x, 0, sizeof(double) * N);
+	for(j=0;j<f->n;j++)
+		x[j] = f->coeffs[f->n - 1 - j] / (N * f->divisor);
+	fftw_execute_dft_r2c(f->forward, x, f->response);
+	fftw_free(x);
+	return 1;
+}
+#endif
+
+/* prepares a filter of the n coefficients coeffs. the results are divided by
+ * divisor. method selects FIR_DIRECT or FIR_FFT, FIR_AUTO chooses by the
+ * filter length. returns NULL if the filter could not be prepared */
+fir_t * fir_new(const double * coeffs, size_t n, double divisor, int method) {
+	fir_t * f;
+	if(n == 0 || divisor == 0)
+		return NULL;
+	f = calloc(1, sizeof(fir_t));
+	if(!f) return NULL;
+	f->n = n;
+	f->divisor = divisor;
+	f->coeffs = malloc(sizeof(double) * n);
+	if(!f->coeffs) {
+		free(f);
+		return NULL;
+	}
+	memcpy(f->coeffs, coeffs, sizeof(double) * n);
+	if(method == FIR_AUTO)
+		method = n >= FIR_FFT_THRESHOLD ? FIR_FFT : FIR_DIRECT;
+#ifdef WITH_FFT
+	if(method == FIR_FFT && !fir_prepare_fft(f)) {
+		fir_free(f);
+		return NULL;
+	}
+#else
+	method = FIR_DIRECT;
+#endif
+	f->method = method;
+	return f;
+}
+
+void fir_free(fir_t * f) {
+	if(!f) return;
+#ifdef WITH_FFT
+	fftw_free(f->response);
+#endif
+	free(f->coeffs);
+	free(f);
+}
+
+static long fir_run_direct(const fir_t * f, const void * in, int in_type, size_t m,
+                           void * out, int out_type, double scale, double offset) {
+	double * x = malloc(sizeof(double) * (FIR_BLOCK + f->n - 1));
+	double * y = malloc(sizeof(double) * FIR_BLOCK);
+	size_t i, j, k, b;
+	if(!x || !y) {
+		free(x); free(y);
+		return -1;
+	}
+	for(i=0;i<m;i+=FIR_BLOCK) {
+		b = m - i < FIR_BLOCK ? m - i : FIR_BLOCK;
+		chain_read_block(x, (const char *) in + i * (in_type & 0xf), b + f->n - 1, in_type);
+		memset(y, 0, sizeof(double) * b);
+		for(j=0;j<f->n;j++) {
+			const double c = f->coeffs[j];
+			const double * restrict xj = x + j;
+			double * restrict yk = y;
+			for(k=0;k<b;k++)
+				yk[k] += c * xj[k];
+		}
+		for(k=0;k<b;k++)
+			y[k] = offset + (y[k] / f->divisor - offset) * scale;
+		chain_write_block((char *) out + i * (out_type & 0xf), y, b, out_type);
+	}
+	free(x); free(y);
+	return m;
+}
+
+#ifdef WITH_FFT
+static long fir_run_fft(const fir_t * f, const void * in, int in_type, size_t len, size_t m,
+                        void * out, int out_type, double scale, double offset) {
+	size_t N = f->fft_size, L = N - f->n + 1;
+	size_t i, k, b, avail;
+	double * x = fftw_malloc(sizeof(double) * N);
+	fftw_complex * X = fftw_malloc(sizeof(fftw_complex) * (N / 2 + 1));
+	double * y;
+	if(!x || !X) {
+		fftw_free(x); fftw_free(X);
+		return -1;
+	}
+	for(i=0;i<m;i+=L) {
+		b = m - i < L ? m - i : L;
+		avail = len - i < N ? len - i : N;
+		chain_read_block(x, (const char *) in + i * (in_type & 0xf), avail, in_type);
+		memset(x + avail, 0, sizeof(double) * (N - avail));
+		fftw_execute_dft_r2c(f->forward, x, X);
+		for(k=0;k<N/2+1;k++)
+			X[k] *= f->response[k];
+		fftw_execute_dft_c2r(f->backward, X, x);
+		/* the first n - 1 samples are wrapped around */
+		y = x + f->n - 1;
+		for(k=0;k<b;k++)
+			y[k] = offset + (y[k] - offset) * scale;
+		chain_write_block((char *) out + i * (out_type & 0xf), y, b, out_type);
+	}
+	fftw_free(x); fftw_free(X);
+	return m;
+}
+#endif
+
+/* filters len samples of in, writing fir_output_length() samples to out.
+ * returns the number of samples written or -1 if memory ran out */
+long fir_run(const fir_t * f, const void * in, int in_type, size_t len,
+             void * out, int out_type, double scale, double offset) {
+	size_t m = fir_output_length(f, len);
+	if(m == 0) return 0;
+#ifdef WITH_FFT
+	if(f->method == FIR_FFT)
+		return fir_run_fft(f, in, in_type, len, m, out, out_type, scale, offset);
+#endif
+	return fir_run_direct(f, in, in_type, m, out, out_type, scale, offset);
+}
@@ -0,0 +1,19 @@
+#include <stdint.h>
+#include <stddef.h>
+
+/* methods of applying a fir filter, see fir_new() */
+#define FIR_AUTO   0
+#define FIR_DIRECT 1
+#define FIR_FFT    2
+
+/* filters with at least this many coefficients use FIR_FFT by default */
+#define FIR_FFT_THRESHOLD 64
+
+typedef struct fir fir_t;
+
+fir_t * fir_new(const double * coeffs, size_t n, double divisor, int method);
+void    fir_free(fir_t * f);
+int     fir_method(const fir_t * f);
+size_t  fir_output_length(const fir_t * f, size_t len);
+long    fir_run(const fir_t * f, const void * in, int in_type, size_t len,
+                void * out, int out_type, double scale, double offset);
@@ -0,0 +1,124 @@
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+
+"""
+Leakage models to generate the hypothesis of a :class:`dpa.correlation.Correlator`.
+
+Instead of filling :attr:`dpa.correlation.Correlator.hypo` element by element
+from python, :func:`hypothesis` computes the whole (keys x traces) matrix in one
+native call from a :class:`dpa.preprocessor.Buffer` holding the known input
+(e.g. plaintext or ciphertext) of each trace.
+
+>>> from preprocessor import buffer_from_list, types
+>>> from correlation import Correlator
+>>> c = Correlator(1, 3, 256)
+>>> plaintext = buffer_from_list(types.uint8_t, [0x00, 0x53, 0xff])
+>>> hypothesis(c, plaintext, stride=1, model=HW, table=AES_SBOX)
+>>> [c.hypo[i] for i in range(3)]             # key 0: HW(sbox(x))
+[4, 6, 3]
+>>> [c.hypo[0x53 * 3 + i] for i in range(3)]  # key 0x53
+[6, 4, 3]
+"""
+
+from libc.string cimport memcpy
+from stdint cimport *
+from preprocessor cimport Buffer, _contiguous
+from preprocessor import types, Buffer, new_buffer
+
+cdef extern from "leakmodel.h":
+	enum:
+		LEAKAGE_VALUE
+		LEAKAGE_HW
+		LEAKAGE_HD
+
+	uint8_t leakage_aes_sbox[256]
+	uint8_t leakage_aes_inv_sbox[256]
+	uint8_t leakage_des_sbox[8][64]
+
+	void leakage_hypothesis(uint8_t * hypo, size_t keys, size_t traces,
+	                        uint8_t * data, size_t stride, size_t offset, size_t ref_offset,
+	                        uint8_t * table, size_t table_mask, int model) nogil
+	void leakage_hamming_weight(uint8_t * out, uint8_t * in_buf, size_t len) nogil
+
+#: the intermediate value itself is the hypothesis
+VALUE = LEAKAGE_VALUE
+#: the hamming weight of the intermediate value
+HW    = LEAKAGE_HW
+#: the hamming distance between the intermediate value and a reference byte
+HD    = LEAKAGE_HD
+
+cdef Buffer _table(uint8_t * table, size_t length):
+	"copies a builtin table, so that modifications do not affect other users"
+	cdef Buffer out = new_buffer(length, types.uint8_t)
+	memcpy(out.buf, table, length)
+	return out
+
+#: the AES S-box (for first round attacks on the plaintext)
+AES_SBOX     = _table(leakage_aes_sbox, 256)
+#: the inverse AES S-box (for last round attacks on the ciphertext)
+AES_INV_SBOX = _table(leakage_aes_inv_sbox, 256)
+#: the eight DES S-boxes indexed by their 6-bit input
+DES_SBOX     = [_table(leakage_des_sbox[i], 64) for i in range(8)]
+
+def hypothesis(target, Buffer data, size_t stride, size_t offset=0, int model=HW,
+               Buffer table=None, int keys=256, ref_offset=None):
+	"""
+	hypothesis(target, data, stride, offset=0, model=HW, table=None, keys=256, ref_offset=None)
+
+	fills the hypothesis of *target* (a :class:`dpa.correlation.Correlator`
+	or its :attr:`hypo` :class:`dpa.preprocessor.Buffer`) for *keys* key guesses
+
+	*data*
+		is a :attr:`dpa.preprocessor.types.uint8_t` :class:`dpa.preprocessor.Buffer`
+		containing *stride* bytes of known input per trace. The byte attacked
+		is found at *offset* within each of these records.
+	*table*
+		is a lookup table (e.g. :data:`AES_SBOX` or one of :data:`DES_SBOX`),
+		whose length must be a power of two. The intermediate value is
+		table[data ^ key]. Without *table* it is data ^ key.
+	*model*
+		:data:`VALUE`, :data:`HW` or :data:`HD`. For the hamming distance the
+		reference byte is found at *ref_offset* (defaults to *offset*) within
+		each record.
+	"""
+	cdef Buffer hypo = target if isinstance(target, Buffer) else target.hypo
+	data, table = _contiguous(data), _contiguous(table)
+	if not hypo.is_contiguous():
+		raise Exception("the hypothesis buffer must not be strided")
+	if data.type != types.uint8_t:
+		raise Exception("data must be given as uint8_t")
+	if keys <= 0 or keys > 256 or hypo.length % keys:
+		raise Exception("hypothesis size is not a multiple of %d keys" % keys)
+	cdef size_t traces = hypo.length / keys
+	if ref_offset is None:
+		ref_offset = offset
+	if offset >= stride or ref_offset >= stride or data.length < traces * stride:
+		raise Exception("data does not contain %d records of %d bytes" % (traces, stride))
+	if model not in (VALUE, HW, HD):
+		raise Exception("unknown leakage model %r" % model)
+
+	cdef uint8_t * ctable = NULL
+	cdef size_t mask = 0xff
+	if table is not None:
+		if table.type != types.uint8_t or table.length & (table.length - 1):
+			raise Exception("table must be a uint8_t buffer of a power of two length")
+		ctable = <uint8_t *> table.buf
+		mask = table.length - 1
+	cdef size_t cref_offset = ref_offset
+	with nogil:
+		leakage_hypothesis(<uint8_t *> hypo.buf, keys, traces, <uint8_t *> data.buf,
+		                   stride, offset, cref_offset, ctable, mask, model)
+
+def hamming_weight(Buffer buf):
+	"""
+	hamming_weight(buf) -> :class:`dpa.preprocessor.Buffer`
+
+	returns the hamming weight of each byte of the uint8_t :class:`dpa.preprocessor.Buffer` *buf*
+	"""
+	buf = _contiguous(buf)
+	if buf.type != types.uint8_t:
+		raise Exception("buf must be given as uint8_t")
+	cdef Buffer out = new_buffer(buf.length, types.uint8_t)
+	with nogil:
+		leakage_hamming_weight(<uint8_t *> out.buf, <uint8_t *> buf.buf, buf.length)
+	return out
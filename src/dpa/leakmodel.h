@@ -0,0 +1,16 @@
+#include <stdint.h>
+#include <stddef.h>
+
+/* leakage models, see leakage_hypothesis() */
+#define LEAKAGE_VALUE 0
+#define LEAKAGE_HW    1
+#define LEAKAGE_HD    2
+
+extern const uint8_t leakage_aes_sbox[256];
+extern const uint8_t leakage_aes_inv_sbox[256];
+extern const uint8_t leakage_des_sbox[8][64];
+
+void leakage_hypothesis(uint8_t * hypo, size_t keys, size_t traces,
+                        const uint8_t * data, size_t stride, size_t offset, size_t ref_offset,
+                        const uint8_t * table, size_t table_mask, int model);
+void leakage_hamming_weight(uint8_t * out, const uint8_t * in, size_t len);
@@ -0,0 +1,140 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#include <stddef.h>
+#include <math.h>
+
+#include "moments.h"
+
+/**************************************
+ * streaming central moments
+ *
+ * the moments of a group of traces are stored as rows of stride samples: row 0
+ * holds the mean, row p-1 the sum M_p of the p-th powers of the deviations
+ * from the mean (p = 2..rows). They are updated one trace at a time and
+ * combined by the formulas of Pebay (2008), which avoid the cancellation of
+ * power sums. */
+
+#define MOMENTS_ROWS (2 * MOMENTS_MAX_ORDER)
+
+static const double binomial[MOMENTS_ROWS + 1][MOMENTS_ROWS + 1] = {
+	{1},
+	{1, 1},
+	{1, 2, 1},
+	{1, 3, 3, 1},
+	{1, 4, 6, 4, 1},
+	{1, 5, 10, 10, 5, 1},
+	{1, 6, 15, 20, 15, 6, 1},
+};
+
+/* adds the count-th trace in to the first len samples of the moments m */
+void moments_add(double * m, size_t rows, size_t stride, const float * in, size_t len, size_t count) {
+	size_t i, p, k;
+	double n = count, na = count - 1;
+	double f[MOMENTS_ROWS + 1], g[MOMENTS_ROWS + 1];
+	if(count == 1) {
+		for(i=0;i<len;i++) {
+			m[i] = in[i];
+			for(p=1;p<rows;p++)
+				m[p*stride + i] = 0;
+		}
+		return;
+	}
+	if(rows == 2) { /* welford's update */
+		for(i=0;i<len;i++) {
+			double delta = in[i] - m[i];
+			m[i] += delta / n;
+			m[stride + i] += delta * (in[i] - m[i]);
+		}
+		return;
+	}
+	/* f[k] = (-1/n)^k, g[p] = (na/n)^p * (1 - (-1/na)^(p-1)) */
+	f[0] = 1;
+	for(k=1;k<=rows;k++) {
+		f[k] = f[k-1] * (-1 / n);
+		g[k] = pow(na / n, k) * (1 - pow(-1 / na, k - 1));
+	}
+	for(i=0;i<len;i++) {
+		double d[MOMENTS_ROWS + 1];
+		d[0] = 1;
+		d[1] = in[i] - m[i];
+		for(k=2;k<=rows;k++)
+			d[k] = d[k-1] * d[1];
+		for(p=rows;p>=2;p--) {
+			double s = g[p] * d[p];
+			for(k=1;k+2<=p;k++)
+				s += binomial[p][k] * f[k] * d[k] * m[(p-k-1)*stride + i];
+			m[(p-1)*stride + i] += s;
+		}
+		m[i] += d[1] / n;
+	}
+}
+
+/* adds the moments m_b of count_b traces to the moments m of count traces */
+void moments_merge(double * m, const double * m_b, size_t rows, size_t len, size_t count, size_t count_b) {
+	size_t i, p, k;
+	double na = count, nb = count_b, n = na + nb;
+	double fa[MOMENTS_ROWS + 1], fb[MOMENTS_ROWS + 1], g[MOMENTS_ROWS + 1];
+	if(count_b == 0)
+		return;
+	if(count == 0) {
+		for(i=0;i<rows*len;i++)
+			m[i] = m_b[i];
+		return;
+	}
+	/* fa[k] = (-nb/n)^k, fb[k] = (na/n)^k, g[p] = (na*nb/n)^p * (1/nb^(p-1) - (-1/na)^(p-1)) */
+	fa[0] = fb[0] = 1;
+	for(k=1;k<=rows;k++) {
+		fa[k] = fa[k-1] * (-nb / n);
+		fb[k] = fb[k-1] * (na / n);
+		g[k] = pow(na * nb / n, k) * (1 / pow(nb, k - 1) - pow(-1 / na, k - 1));
+	}
+	for(i=0;i<len;i++) {
+		double d[MOMENTS_ROWS + 1];
+		d[0] = 1;
+		d[1] = m_b[i] - m[i];
+		for(k=2;k<=rows;k++)
+			d[k] = d[k-1] * d[1];
+		for(p=rows;p>=2;p--) {
+			double s = m_b[(p-1)*len + i] + g[p] * d[p];
+			for(k=1;k+2<=p;k++)
+				s += binomial[p][k] * (fa[k] * m[(p-k-1)*len + i] + fb[k] * m_b[(p-k-1)*len + i]) * d[k];
+			m[(p-1)*len + i] += s;
+		}
+		m[i] += d[1] * nb / n;
+	}
+}
+
+/* the mean and variance of the statistic of the t-test of the given order
+ * at sample i: the samples themselves for order 1, the squared deviations
+ * for order 2 and the standardized deviations to the power of order above */
+static void statistic(const double * m, size_t len, size_t i, double n, int order,
+                      double * mean, double * variance) {
+#define CM(p) (m[((p)-1)*len + i] / n)
+	if(order == 1) {
+		*mean = m[i];
+		*variance = CM(2);
+	} else if(order == 2) {
+		*mean = CM(2);
+		*variance = CM(4) - CM(2) * CM(2);
+	} else {
+		double var = CM(2);
+		*mean = CM(order) / pow(var, order / 2.);
+		*variance = (CM(2 * order) - CM(order) * CM(order)) / pow(var, order);
+	}
+#undef CM
+}
+
+/* welch's t-statistic of the t-test of the given order between the groups
+ * of count_a traces with the moments a and count_b traces with moments b */
+void moments_ttest(float * out, const double * a, size_t count_a, const double * b, size_t count_b,
+                   size_t len, int order) {
+	size_t i;
+	for(i=0;i<len;i++) {
+		double mean_a, var_a, mean_b, var_b;
+		statistic(a, len, i, count_a, order, &mean_a, &var_a);
+		statistic(b, len, i, count_b, order, &mean_b, &var_b);
+		out[i] = (mean_a - mean_b) / sqrt(var_a / count_a + var_b / count_b);
+	}
+}
@@ -0,0 +1,10 @@
+#include <stddef.h>
+
+/* the highest order of the t-tests, which need the central moments up to
+ * twice this order */
+#define MOMENTS_MAX_ORDER 3
+
+void moments_add(double * m, size_t rows, size_t stride, const float * in, size_t len, size_t count);
+void moments_merge(double * m, const double * m_b, size_t rows, size_t len, size_t count, size_t count_b);
+void moments_ttest(float * out, const double * a, size_t count_a, const double * b, size_t count_b,
+                   size_t len, int order);
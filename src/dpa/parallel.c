@@ -0,0 +1,81 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#define _GNU_SOURCE
+#include <stddef.h>
+#include <sched.h>
+#include <pthread.h>
+#include <unistd.h>
+
+#include "parallel.h"
+
+/**************************************
+ * native threads for batched kernels
+ *
+ * parallel_for() splits the items 0..n-1 into contiguous ranges of at least
+ * min_chunk items, runs fn() for each range in its own thread and waits for
+ * all of them. The calling thread processes the first range itself. */
+
+#define PARALLEL_MAX_THREADS 256
+
+static int parallel_num_threads = 0;
+
+/* returns the number of threads used by parallel_for(), by default the
+ * number of cpus this process may run on */
+int parallel_threads(void) {
+	cpu_set_t set;
+	int n = parallel_num_threads;
+	if(n <= 0) {
+		n = sched_getaffinity(0, sizeof(set), &set) == 0 ? CPU_COUNT(&set) : sysconf(_SC_NPROCESSORS_ONLN);
+		if(n <= 0) n = 1;
+	}
+	return n < PARALLEL_MAX_THREADS ? n : PARALLEL_MAX_THREADS;
+}
+
+/* sets the number of threads, 0 restores the default */
+void parallel_set_threads(int threads) {
+	parallel_num_threads = threads;
+}
+
+typedef struct {
+	parallel_fn fn;
+	void * ctx;
+	size_t begin;
+	size_t end;
+} parallel_range_t;
+
+static void * parallel_run(void * arg) {
+	parallel_range_t * r = arg;
+	r->fn(r->ctx, r->begin, r->end);
+	return NULL;
+}
+
+void parallel_for(size_t n, size_t min_chunk, parallel_fn fn, void * ctx) {
+	parallel_range_t ranges[PARALLEL_MAX_THREADS];
+	pthread_t threads[PARALLEL_MAX_THREADS];
+	int started[PARALLEL_MAX_THREADS];
+	size_t k, t = parallel_threads();
+
+	if(min_chunk == 0) min_chunk = 1;
+	if(t > n / min_chunk) t = n / min_chunk;
+	if(t <= 1) {
+		if(n) fn(ctx, 0, n);
+		return;
+	}
+	for(k=0;k<t;k++) {
+		ranges[k].fn = fn;
+		ranges[k].ctx = ctx;
+		ranges[k].begin = n * k / t;
+		ranges[k].end = n * (k + 1) / t;
+	}
+	for(k=1;k<t;k++)
+		started[k] = pthread_create(&threads[k], NULL, parallel_run, &ranges[k]) == 0;
+	parallel_run(&ranges[0]);
+	for(k=1;k<t;k++) {
+		if(started[k])
+			pthread_join(threads[k], NULL);
+		else /* out of threads, do it here */
+			parallel_run(&ranges[k]);
+	}
+}
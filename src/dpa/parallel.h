@@ -0,0 +1,8 @@
+#include <stddef.h>
+
+/* processes the items begin to end - 1 */
+typedef void (*parallel_fn)(void * ctx, size_t begin, size_t end);
+
+int  parallel_threads(void);
+void parallel_set_threads(int threads);
+void parallel_for(size_t n, size_t min_chunk, parallel_fn fn, void * ctx);
@@ -1,8 +1,34 @@
+from cpython.buffer cimport Py_buffer
+
+cdef class BufferPool:
+	cdef dict free_blocks
+	cdef readonly int huge_pages
+	cdef readonly size_t cached
+	cdef readonly size_t max_cached
+	cdef readonly size_t allocations
+	cdef void * get(self, size_t size, size_t * capacity) except? NULL
+	cdef void put(self, void * p, size_t capacity)
+	cdef void release(self, void * p, size_t capacity)
+
 cdef class Buffer:
 	cdef void * buf
 	cdef size_t length
 	cdef int type
+	cdef size_t capacity
+	cdef Py_ssize_t stride
 	cdef int is_allocated
+	cdef int readonly
+	cdef BufferPool pool
+	cdef void * map_addr
+	cdef size_t map_length
+	cdef object base
+	cdef Py_buffer view
+	cdef int has_view
+	cdef Py_ssize_t shape[1]
+	cdef Py_ssize_t strides[1]
 	cdef void init(self, void * buf, size_t length, int type)
+	cdef int is_contiguous(self)
+	cdef void * item(self, index) except NULL
 
 cdef Buffer _Buffer(void * buf, size_t length, int type)
+cdef Buffer _contiguous(Buffer buf)
@@ -5,6 +5,7 @@ from libc.stdlib cimport malloc, free
 from stdint cimport *
 from preprocess cimport *
 from threading import Lock
+from thread import get_ident
 
 import os, math
 from warnings import warn
@@ -22,20 +23,41 @@ cdef T(int target, int src=0):
 	if src == 0: src = target
 	return t_map[_T(target, src)]
 
-ctypedef struct _raster_config:
-	int trigger
-	int pause_trigger
-	int min_pause
-	int max_pause
-	int header_size
+cdef extern from "simd.h" nogil:
+	int simd_level()
+	int simd_set_level(int level)
 
-cdef extern _raster_config raster_config
+_simd_levels = ["none", "sse2", "avx2", "avx512"]
+
+def set_simd(level=None):
+	"""
+	set_simd(level=None) -> str
+
+	selects the vector kernels used by the preprocessing functions: ``"none"``,
+	``"sse2"``, ``"avx2"`` or ``"avx512"``. Instruction sets the cpu does not
+	support are lowered to the best supported one, which *None* selects.
+	Returns the selected level.
+
+	At import the level is set from the environment variable ``DPA_SIMD``.
+	"""
+	if level is not None and level not in _simd_levels:
+		raise ValueError("unknown simd level %r" % level)
+	return _simd_levels[simd_set_level(-1 if level is None else _simd_levels.index(level))]
+
+def get_simd():
+	"returns the instruction set of the vector kernels, see :func:`set_simd`"
+	return _simd_levels[simd_level()]
+
+set_simd(os.environ.get("DPA_SIMD") or None)
 
 # begin of the actual wrapping functions
+#
+# all functions returning a new Buffer accept an *out* Buffer to write the
+# result to instead. This allows to reuse output buffers for each trace.
 
-def average(Buffer buf, int n, int skip=1, double scale=1, int signed_scale=0, int dst_type=0):
+def average(Buffer buf, int n, int skip=1, double scale=1, int signed_scale=0, int dst_type=0, Buffer out=None):
 	"""
-	average(buf, n, skip=1, scale=1, dst_type=types.void) -> :class:`Buffer`
+	average(buf, n, skip=1, scale=1, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	average *n* samples of :class:`Buffer` *buf*,
 	the result is scaled by *scale*
@@ -48,28 +70,32 @@ def average(Buffer buf, int n, int skip=1, double scale=1, int signed_scale=0, i
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
+	buf = _contiguous(buf)
 	cdef l = (buf.length - n) / skip + 1
-	if dst_type == 0:
-		dst_type = buf.type
-	cdef Buffer out = new_buffer(l, dst_type)
+	dst_type = _dst_type(dst_type, buf, out)
+	out = _output(out, l, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	
 	with nogil:
 		fkt.average_filter(out.buf, buf.buf, buf.length, n, skip, scale, signed_scale)
 	return out
 
-def load_file(filename, int type, size_t length=0):
+def load_file(filename, int type, size_t length=0, Buffer out=None, mmap=False):
 	"""
-	load_file(filename, type, length=0) -> :class:`Buffer`
+	load_file(filename, type, length=0, out=None, mmap=False) -> :class:`Buffer`
 
 	reads a file into memory returning a :class:`Buffer`
 
 	a non-zero *length* specifies the maximum amounts of bytes read
+
+	If *mmap* is set, the file is mapped read-only instead (see :func:`map_file`).
 	"""
+	if mmap and out is None:
+		return map_file(filename, type, length)
 	if length == 0:
 		length = os.stat(filename).st_size / (type & 0xf)
 
-	cdef Buffer out = new_buffer(length, type)
+	out = _output(out, length, type)
 	cdef _F fkt = mod[T(type)]
 	cdef char* cfilename = filename
 	with nogil:
@@ -88,6 +114,7 @@ def write_file(filename, Buffer buf, size_t length=0):
 
 	a non-zero *length* specifies the maximum amounts of bytes written
 	"""
+	buf = _contiguous(buf)
 	if length == 0:
 		length = buf.length
 	cdef _F fkt = mod[T(buf.type)]
@@ -97,14 +124,17 @@ def write_file(filename, Buffer buf, size_t length=0):
 		ret = fkt.write_buf(cfilename, buf.buf, length)
 	return ret
 
-def filter(Buffer buf, Buffer filter_data, double scale=1, int signed_scale=0, int dst_type=0):
+def filter(Buffer buf, filter_data, double scale=1, int signed_scale=0, int dst_type=0, Buffer out=None):
 	"""
-	filter(buf, filter_data, scale=1, dst_type=types.void) -> :class:`Buffer`
+	filter(buf, filter_data, scale=1, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	applies a FIR filter to the :class:`Buffer` buf
 
-	*filter_data* is a :attr:`types.int8_t` :class:`Buffer` containing the filter coefficients,
-	which are automatically scaled by 1/sum(filter_data)
+	*filter_data* is a prepared :class:`FIRFilter` or its coefficients as a
+	:class:`Buffer` or a list (see :class:`FIRFilter`). Integer coefficients
+	are automatically scaled by 1/sum(filter_data), float coefficients are
+	used as they are. Preparing a :class:`FIRFilter` once saves this work
+	for each trace.
 
 	The result can be scaled by *scale*.
 
@@ -114,21 +144,14 @@ def filter(Buffer buf, Buffer filter_data, double scale=1, int signed_scale=0, i
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if filter_data.type & 0xf != types.int8_t: #include a bypass to allow uint8_t too (but values > 127 will fail!)
-		raise Exception("filter_data must be given as int8_t")
-	if dst_type == 0:
-		dst_type = buf.type
+	if not isinstance(filter_data, FIRFilter):
+		filter_data = FIRFilter(filter_data, normalize=isinstance(filter_data, Buffer)
+			and not filter_data.get_type() & 0x20)
+	return filter_data.process(buf, scale, signed_scale, dst_type, out)
 
-	cdef size_t length = buf.length - filter_data.length + 1
-	cdef Buffer out = new_buffer(length, dst_type)
-	cdef _F fkt = mod[T(dst_type, buf.type)]
-	with nogil:
-		fkt.apply_filter(out.buf, buf.buf, buf.length, <int8_t *>filter_data.buf, filter_data.length, scale, signed_scale)
-	return out
-
-def scale(Buffer buf, double scale=1.0, int signed_scale=0, int dst_type=0):
+def scale(Buffer buf, double scale=1.0, int signed_scale=0, int dst_type=0, Buffer out=None):
 	"""
-	scale(buf, scale=1.0, signed_scale=0, dst_type=types.void) -> :class:`Buffer`
+	scale(buf, scale=1.0, signed_scale=0, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	scales buffers values by *scale* (i.e. buf[i] *= scale)
 
@@ -138,10 +161,10 @@ def scale(Buffer buf, double scale=1.0, int signed_scale=0, int dst_type=0):
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
+	out = _output(out, buf.length, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		fkt.scale(buf.length, out.buf, buf.buf, signed_scale, scale)
@@ -155,6 +178,7 @@ def analyze(Buffer buf, int include_variance=True):
 
 	If *variance* is not needed, calculation is slightly quicker.
 	"""
+	buf = _contiguous(buf)
 	cdef double avg, var=0, _min, _max
 	cdef double * p_var = &var
 	if not include_variance: p_var = NULL
@@ -163,9 +187,9 @@ def analyze(Buffer buf, int include_variance=True):
 		fkt.analyze(buf.buf, buf.length, &avg, p_var, &_min, &_max)
 	return (avg, var, _min, _max)
 
-def peak_extract(Buffer buf, double avg=-1, double std_dev=-1, size_t break_count=0, size_t break_length=0, int dst_type=0):
+def peak_extract(Buffer buf, double avg=-1, double std_dev=-1, size_t break_count=0, size_t break_length=0, int dst_type=0, Buffer out=None):
 	"""
-	peak_extract(buf, avg=-1, std_dev=-1, break_count=0, break_length=0, dst_type=types.void) -> :class:`Buffer`
+	peak_extract(buf, avg=-1, std_dev=-1, break_count=0, break_length=0, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	extracts high peaks from :class:`Buffer` buf
 
@@ -181,15 +205,15 @@ def peak_extract(Buffer buf, double avg=-1, double std_dev=-1, size_t break_coun
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
 	if avg == -1 and std_dev == -1:
 		avg, var, _min, _max = analyze(buf)
 		std_dev = math.sqrt(var)
 
 	cdef size_t length = buf.length * 11 / 10 / 4 #l / 4 * 1.1
-	cdef Buffer out = new_buffer(length, dst_type)
+	out = _output(out, length, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		r_size = fkt.peak_extract(out.buf, buf.buf, buf.length, avg, std_dev, break_length, break_count)
@@ -199,18 +223,24 @@ def peak_extract(Buffer buf, double avg=-1, double std_dev=-1, size_t break_coun
 	return out
 
 def set_raster_config(int trigger=120, int pause_trigger=1100, int min_pause=0, int max_pause=0, int header_size=128):
-	raster_config.trigger = trigger
-	raster_config.pause_trigger = pause_trigger
-	raster_config.min_pause = min_pause
-	raster_config.max_pause = max_pause
-	raster_config.header_size = header_size
+	"""
+	set_raster_config(trigger=120, pause_trigger=1100, min_pause=0, max_pause=0, header_size=128)
+
+	sets the default configuration of :func:`raster` for arguments not passed
+	to it explicitly
+	"""
+	raster_defaults.trigger = trigger
+	raster_defaults.pause_trigger = pause_trigger
+	raster_defaults.min_pause = min_pause
+	raster_defaults.max_pause = max_pause
+	raster_defaults.header_size = header_size
 
-	#cython bug?
-	#raster_config = _raster_config(trigger, pause_trigger, min_pause, max_pause, header_size)
+cdef raster_config_t raster_defaults
+set_raster_config(120, 1100, 3, 6, 128)
 
-def spline(Buffer buf, size_t size, int dst_type=0):
+def spline(Buffer buf, size_t size, int dst_type=0, Buffer out=None):
 	"""
-	spline(buf, target_size, dst_type=types.void) -> :class:`Buffer`
+	spline(buf, target_size, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	linearly interpolates a :class:`Buffer` buf to fit a given length
 
@@ -221,15 +251,16 @@ def spline(Buffer buf, size_t size, int dst_type=0):
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
-	cdef Buffer out = new_buffer(size, dst_type)
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
+	out = _output(out, size, dst_type)
 	mod[T(dst_type, buf.type)].spline(out.buf, buf.buf, size, buf.length)
 	return out
 
-def raster(Buffer buf, Buffer edge, int period, int dst_type=0):
+def raster(Buffer buf, Buffer edge, int period, int dst_type=0, Buffer out=None,
+		trigger=None, pause_trigger=None, min_pause=None, max_pause=None, header_size=None):
 	"""
-	raster(buf, edge, period, dst_type=types.void) -> :class:`Buffer`
+	raster(buf, edge, period, dst_type=types.void, out=None, trigger=None, pause_trigger=None, min_pause=None, max_pause=None, header_size=None) -> :class:`Buffer`
 
 	aligns a given trace buf using the pattern defined by *edge*
 
@@ -239,48 +270,56 @@ def raster(Buffer buf, Buffer edge, int period, int dst_type=0):
 	    specifies the length of a period in samples
 	    each *period* in :class:`Buffer` buf is linearly interpolated to fit the length specified by *period*
 
-	See also :meth:`raster_config` to specify advanced attributes such as trigger_values
-	and expected pause intervals.
+	The remaining arguments specify advanced attributes such as trigger values
+	and expected pause intervals (see :class:`dpa.processors.RasterizeProcessor`).
+	Arguments which are not given are taken from :func:`set_raster_config`.
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
+	buf, edge = _contiguous(buf), _contiguous(edge)
 	if buf.type != edge.type:
 		raise Exception("edge must have same type as buffer")
-	if dst_type == 0:
-		dst_type = buf.type
+	dst_type = _dst_type(dst_type, buf, out)
+
+	cdef raster_config_t config = raster_defaults
+	if trigger is not None: config.trigger = trigger
+	if pause_trigger is not None: config.pause_trigger = pause_trigger
+	if min_pause is not None: config.min_pause = min_pause
+	if max_pause is not None: config.max_pause = max_pause
+	if header_size is not None: config.header_size = header_size
 
 	cdef size_t length = int(buf.length * 1.2 + 4 * 1024) #reserve some 20% additional space, raise exception later if we fail
-	cdef Buffer out = new_buffer(length, dst_type)
+	out = _output(out, length, dst_type)
 	cdef int ret
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
-		ret = fkt.raster(out.buf, buf.buf, buf.length, &out.length, period, edge.buf, edge.length)
+		ret = fkt.raster(out.buf, buf.buf, buf.length, &out.length, period, edge.buf, edge.length, &config)
 	if ret < 0:
 		raise Exception("rasterization failed with error-code %d" % ret)
 	if length < out.length:
 		raise Exception("Buffer Overflow, fix calculation in preprocessor.pyx")
 	return out
 
-def rectify(Buffer buf, double avg, int dst_type=0):
+def rectify(Buffer buf, double avg, int dst_type=0, Buffer out=None):
 	"""
-	rectify(buf, avg, dst_type=types.void) -> :class:`Buffer`
+	rectify(buf, avg, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	rectifies a traces, by calculating the absolute difference to *avg*
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
+	out = _output(out, buf.length, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		fkt.rectify(out.buf, buf.buf, buf.length, avg)
 	return out
 
-def reorder(Buffer buf, size_t period, int dst_type=0):
+def reorder(Buffer buf, size_t period, int dst_type=0, Buffer out=None):
 	"""
-	reorder(buf, period, dst_type=types.void) -> :class:`Buffer`
+	reorder(buf, period, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	reorders a rasterized :class:`Buffer` buf so that
 	
@@ -295,18 +334,18 @@ def reorder(Buffer buf, size_t period, int dst_type=0):
 	>>> reorder(buffer_from_list(types.uint8_t, [1,2,3,4,5,6,7,8,9,10]), 3)
 	[1, 4, 7, 10, 2, 5, 8, 3, 6, 9]
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
+	out = _output(out, buf.length, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		fkt.reorder(out.buf, buf.buf, buf.length, period)
 	return out
 
-def diff(Buffer a, Buffer b, int absolute=True, int dst_type=0):
+def diff(Buffer a, Buffer b, int absolute=True, int dst_type=0, Buffer out=None):
 	"""
-	diff(a, b, absolute=True, dst_type=types.void) -> :class:`Buffer`
+	diff(a, b, absolute=True, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	calculates abs(a[i] - b[i]) for each sample of :class:`Buffer` *a* and *b*,
 	returns a new :class:`Buffer` of length min(len(a), len(b))
@@ -316,47 +355,135 @@ def diff(Buffer a, Buffer b, int absolute=True, int dst_type=0):
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = a.type
+	a, b = _contiguous(a), _contiguous(b)
+	dst_type = _dst_type(dst_type, a, out)
 	if a.type != b.type:
 		raise Exception("both buffers must be of same type")
 
 	cdef int length = min(a.length, b.length)
-	cdef Buffer out = new_buffer(length, dst_type)
+	out = _output(out, length, dst_type)
 	cdef _F fkt = mod[T(dst_type, a.type)]
 	with nogil:
 		fkt.diff(length, out.buf, a.buf, b.buf, absolute)
 	return out
 
-def square(Buffer buf, int dst_type=0):
+def square(Buffer buf, int dst_type=0, Buffer out=None):
 	"""
-	square(buf, dst_type=types.void) -> :class:`Buffer`
+	square(buf, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	calculates the square of each value in :class:`Buffer` buf
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
+	out = _output(out, buf.length, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		fkt.square_buf(out.buf, buf.buf, buf.length)
 	return out
 
-def integrate(Buffer buf, int n, int dst_type=0):
+def centered_product(Buffer buf, Buffer mean, Buffer pairs, int dst_type=0, Buffer out=None):
+	"""
+	centered_product(buf, mean, pairs, dst_type=types.float, out=None) -> :class:`Buffer`
+
+	combines pairs of samples for second-order attacks. For the k-th pair (i, j)
+	the k-th output value is (buf[i] - mean[i]) * (buf[j] - mean[j]).
+
+	*pairs* is a :attr:`types.int32_t` :class:`Buffer` holding the two indices of
+	each pair one after the other and *mean* a float :class:`Buffer` of the mean
+	of each sample.
+	"""
+	buf, mean, pairs = _contiguous(buf), _contiguous(mean), _contiguous(pairs)
+	if dst_type == 0 and out is None:
+		dst_type = types.float
+	dst_type = _dst_type(dst_type, buf, out)
+	if mean.type != types.float:
+		raise Exception("mean must be a float buffer")
+	if pairs.type != types.int32_t or pairs.length % 2:
+		raise Exception("pairs must be an int32_t buffer of index pairs")
+
+	cdef size_t n = pairs.length / 2, length = min(buf.length, mean.length)
+	cdef int ret
+	out = _output(out, n, dst_type)
+	cdef _F fkt = mod[T(dst_type, buf.type)]
+	with nogil:
+		ret = fkt.centered_product(out.buf, buf.buf, length, <float *> mean.buf, <int32_t *> pairs.buf, n)
+	if not ret:
+		raise Exception("a sample pair exceeds the %d samples of the trace and the mean" % length)
+	return out
+
+def window_pairs(size_t start, size_t stop, other=None, size_t first=0, size_t count=0):
 	"""
-	integrate(buf, n, dst_type=types.void) -> :class:`Buffer`
+	window_pairs(start, stop, other=None, first=0, count=0) -> :class:`Buffer`
+
+	returns the sample pairs (i, j) with start <= i < j < stop or, if the window
+	*other* = (start, stop) is given, with start <= i < stop and j in *other*,
+	as :attr:`types.int32_t` :class:`Buffer` for :func:`centered_product`
+
+	The pairs are ordered by i and j. *first* and a non-zero *count* select a
+	part of them, so that large windows can be processed in tiles.
+
+	>>> print window_pairs(2, 5)
+	[2, 3, 2, 4, 3, 4]
+	>>> print window_pairs(0, 2, (5, 7), first=1, count=2)
+	[0, 6, 1, 5]
+	"""
+	cdef size_t i, j, k, o_start = 0, o_stop = 0, total, row
+	cdef int cross = other is not None
+	if stop < start:
+		raise Exception("invalid window (%d, %d)" % (start, stop))
+	if cross:
+		o_start, o_stop = other
+		if o_stop < o_start:
+			raise Exception("invalid window (%d, %d)" % (o_start, o_stop))
+		total = (stop - start) * (o_stop - o_start)
+	else:
+		total = (stop - start) * (stop - start - 1) / 2 if stop > start else 0
+	if first > total:
+		raise Exception("pair %d exceeds the %d pairs of the window" % (first, total))
+	if count == 0 or count > total - first:
+		count = total - first
+	cdef Buffer out = new_buffer(2 * count, types.int32_t)
+	cdef int32_t * p = <int32_t *> out.buf
+	if count == 0:
+		return out
+	with nogil:
+		#find the first pair
+		i = start
+		if cross:
+			row = o_stop - o_start
+			i += first / row
+			j = o_start + first % row
+		else:
+			k = first
+			while k >= stop - i - 1:
+				k -= stop - i - 1
+				i += 1
+			j = i + 1 + k
+			o_stop = stop
+		for k in range(count):
+			p[2 * k] = i
+			p[2 * k + 1] = j
+			j += 1
+			if j == o_stop:
+				i += 1
+				j = o_start if cross else i + 1
+	return out
+
+def integrate(Buffer buf, int n, int dst_type=0, Buffer out=None):
+	"""
+	integrate(buf, n, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	builds the sum of *n* samples each
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
-	cdef Buffer out = new_buffer(buf.length - n + 1, dst_type)
+	out = _output(out, buf.length - n + 1, dst_type)
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
 		fkt.integrate(out.buf, buf.buf, buf.length, n)
@@ -365,9 +492,9 @@ def integrate(Buffer buf, int n, int dst_type=0):
 class NormalizeException(Exception):
 	pass
 
-def normalize(Buffer buf, double min=-1, double max=-1, double adjust_factor=1.2, dst_type=0):
+def normalize(Buffer buf, double min=-1, double max=-1, double adjust_factor=1.2, dst_type=0, Buffer out=None):
 	"""
-	normalize(buf, min=NaN, max=NaN, adjust_factor=1.2, dst_type=types.void) -> :class:`Buffer`
+	normalize(buf, min=NaN, max=NaN, adjust_factor=1.2, dst_type=types.void, out=None) -> :class:`Buffer`
 
 	normalizes a trace with values in ]min, max[ to fit the whole range
 	of the *dst_type*
@@ -377,8 +504,8 @@ def normalize(Buffer buf, double min=-1, double max=-1, double adjust_factor=1.2
 
 	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
 	"""
-	if dst_type == 0:
-		dst_type = buf.type
+	buf = _contiguous(buf)
+	dst_type = _dst_type(dst_type, buf, out)
 
 	if min == -1 and max == -1:
 		tmp, tmp, min, max = analyze(buf, variance=False)
@@ -387,7 +514,7 @@ def normalize(Buffer buf, double min=-1, double max=-1, double adjust_factor=1.2
 		max = max - diff + adjust_factor * diff
 		#std_dev = math.sqrt(var)
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
+	out = _output(out, buf.length, dst_type)
 	cdef int ret
 	cdef _F fkt = mod[T(dst_type, buf.type)]
 	with nogil:
@@ -397,24 +524,356 @@ def normalize(Buffer buf, double min=-1, double max=-1, double adjust_factor=1.2
 
 	return out
 
-def fft_filter(Buffer buf, int start, int stop, dst_type=0):
-	if dst_type == 0:
-		dst_type = buf.type
+cdef extern from "fftw3.h":
+	enum:
+		FFTW_ESTIMATE
+		FFTW_MEASURE
+		FFTW_PATIENT
+		FFTW_EXHAUSTIVE
 
-	cdef Buffer out = new_buffer(buf.length, dst_type)
-	cdef double scale = 1
-	cdef double offset = 0
+cdef extern from "fft.h" nogil:
+	void fft_set_planner_flags(unsigned flags)
+	int fft_import_wisdom(char * filename)
+	int fft_export_wisdom(char * filename)
+	int fft_bandpass(void ** in_buf, int in_type, size_t len, size_t count, void ** out, int out_type, size_t start, size_t stop)
 
-	cdef _F fkt = mod[T(dst_type, buf.type)]
-	with nogil:
-		fkt.fft_filter(out.buf, buf.buf, buf.length, start, stop, &scale, &offset)
-	return out
+#: default location of the fftw wisdom, see :func:`load_fft_wisdom`
+fft_wisdom_file = os.path.expanduser("~/.cache/dpa/fftw-wisdom")
+
+def set_fft_planner(effort="estimate"):
+	"""
+	set_fft_planner(effort="estimate")
+
+	sets how much time fftw spends on finding fast plans for new transform
+	sizes: ``"estimate"``, ``"measure"``, ``"patient"`` or ``"exhaustive"``.
+	Plans are created once per size and kept for the lifetime of the process,
+	their planning results can be kept across runs with :func:`save_fft_wisdom`.
+	"""
+	efforts = {"estimate": FFTW_ESTIMATE, "measure": FFTW_MEASURE,
+		"patient": FFTW_PATIENT, "exhaustive": FFTW_EXHAUSTIVE}
+	if effort not in efforts:
+		raise ValueError("unknown planner effort %r" % effort)
+	fft_set_planner_flags(efforts[effort])
+
+def load_fft_wisdom(filename=None):
+	"""
+	load_fft_wisdom(filename=None) -> bool
+
+	loads fftw wisdom stored by :func:`save_fft_wisdom`, which speeds up
+	the planning of the transforms. Returns False if *filename* (default:
+	:data:`fft_wisdom_file`) could not be loaded.
+	"""
+	filename = filename or fft_wisdom_file
+	return os.path.exists(filename) and fft_import_wisdom(filename) != 0
+
+def save_fft_wisdom(filename=None):
+	"""
+	save_fft_wisdom(filename=None)
+
+	stores the fftw wisdom gathered so far in *filename* (default: :data:`fft_wisdom_file`)
+	"""
+	filename = filename or fft_wisdom_file
+	if not os.path.isdir(os.path.dirname(filename)):
+		os.makedirs(os.path.dirname(filename))
+	if not fft_export_wisdom(filename):
+		raise IOError("could not write %s" % filename)
+
+def fft_filter(Buffer buf, int start, int stop, dst_type=0, Buffer out=None):
+	"""
+	fft_filter(buf, start, stop, dst_type=types.void, out=None) -> :class:`Buffer`
+
+	applies a bandpass to :class:`Buffer` buf, keeping the frequency bins
+	from *start* to *stop* (see :func:`dpa.helpers.gen_bandbass`)
+
+	By explicitly specifying a *dst_type* the result :class:`Buffer` is forced to this type.
+	"""
+	return fft_filter_many([buf], start, stop, dst_type, [out] if out is not None else None)[0]
+
+def fft_filter_many(list bufs, int start, int stop, int dst_type=0, list out=None):
+	"""
+	fft_filter_many(bufs, start, stop, dst_type=types.void, out=None) -> list of :class:`Buffer`
+
+	applies the bandpass of :func:`fft_filter` to a list of buffers of the same
+	length and type, transforming several of them with a single batched fftw plan.
+	The results are written to the buffers of the list *out* if given.
+	"""
+	cdef size_t count = len(bufs), k
+	if count == 0:
+		return []
+	bufs = [_contiguous(x) for x in bufs]
+	if out is not None and len(out) != count:
+		raise ValueError("out must have as many buffers as bufs")
+	cdef Buffer first = bufs[0], b
+	dst_type = _dst_type(dst_type, first, out[0] if out else None)
+	if not block_supports_type(first.type) or not block_supports_type(dst_type):
+		raise TypeError("fft filtering is not supported for type %x to %x" % (first.type, dst_type))
+	res = []
+	for k in range(count):
+		b = bufs[k]
+		if b.length != first.length or b.type != first.type:
+			raise ValueError("all buffers must have the same length and type")
+		res.append(_output(out[k] if out else None, first.length, dst_type))
+
+	cdef void ** in_ptrs = <void **> malloc(sizeof(void *) * count)
+	cdef void ** out_ptrs = <void **> malloc(sizeof(void *) * count)
+	cdef int ret = -1
+	if in_ptrs != NULL and out_ptrs != NULL:
+		for k in range(count):
+			in_ptrs[k] = (<Buffer> bufs[k]).buf
+			out_ptrs[k] = (<Buffer> res[k]).buf
+		with nogil:
+			ret = fft_bandpass(in_ptrs, first.type, first.length, count, out_ptrs, dst_type,
+				max(start, 0), max(stop, 0))
+	free(in_ptrs)
+	free(out_ptrs)
+	if ret < 0:
+		raise MemoryError()
+	return res
+
+cdef extern from "fir.h" nogil:
+	enum:
+		FIR_AUTO
+		FIR_DIRECT
+		FIR_FFT
+	ctypedef struct fir_t:
+		pass
+	fir_t * fir_new(double * coeffs, size_t n, double divisor, int method)
+	void fir_free(fir_t * f)
+	int fir_method(fir_t * f)
+	size_t fir_output_length(fir_t * f, size_t len)
+	long fir_run(fir_t * f, void * in_buf, int in_type, size_t len, void * out, int out_type, double scale, double offset)
+
+cdef class FIRFilter:
+	"""
+	FIRFilter(coefficients, normalize=False, method="auto")
+
+	prepares a FIR filter with the given *coefficients* (a :class:`Buffer` or
+	a list) for :func:`filter`. With *normalize*, the results are divided by
+	the sum of the coefficients.
+
+	Filtering computes out[i] = sum(coefficients[j] * buf[i+j]) and returns
+	len(buf) - len(coefficients) + 1 samples. Short filters are applied
+	directly, filters of 64 and more coefficients by FFT convolution using the
+	frequency response computed here. *method* may force ``"direct"`` or ``"fft"``.
+	The results of both methods differ by rounding errors only.
+
+	>>> FIRFilter([0.5, 0.5]).process(buffer_from_list(types.float, [1, 2, 4, 8]))
+	[1.5, 3.0, 6.0]
+	"""
+	cdef fir_t * fir
+	cdef readonly size_t length
+
+	def __cinit__(self, coefficients, normalize=False, method="auto"):
+		methods = {"auto": FIR_AUTO, "direct": FIR_DIRECT, "fft": FIR_FFT}
+		if method not in methods:
+			raise ValueError("unknown filter method %r" % method)
+		if isinstance(coefficients, Buffer):
+			coefficients = coefficients.as_list()
+		cdef size_t n = len(coefficients), i
+		if n == 0:
+			raise ValueError("a filter needs at least one coefficient")
+		divisor = sum(coefficients) if normalize else 1
+		if divisor == 0:
+			raise ValueError("the filter coefficients sum up to 0 and cannot be normalized")
+		cdef double * c = <double *> malloc(sizeof(double) * n)
+		if c == NULL:
+			raise MemoryError()
+		for i in range(n):
+			c[i] = coefficients[i]
+		self.fir = fir_new(c, n, divisor, methods[method])
+		free(c)
+		if self.fir == NULL:
+			raise MemoryError()
+		self.length = n
+
+	def __dealloc__(self):
+		fir_free(self.fir)
+
+	property method:
+		"the method used for filtering, ``direct`` or ``fft``"
+		def __get__(self):
+			return "fft" if fir_method(self.fir) == FIR_FFT else "direct"
+
+	def process(self, Buffer buf, double scale=1, int signed_scale=0, int dst_type=0, Buffer out=None):
+		"""
+		process(buf, scale=1, signed_scale=0, dst_type=types.void, out=None) -> :class:`Buffer`
+
+		filters the :class:`Buffer` buf, see :func:`filter` for the arguments
+		"""
+		buf = _contiguous(buf)
+		dst_type = _dst_type(dst_type, buf, out)
+		if not block_supports_type(buf.type) or not block_supports_type(dst_type):
+			raise TypeError("filtering is not supported for type %x to %x" % (buf.type, dst_type))
+		cdef size_t length = fir_output_length(self.fir, buf.length)
+		out = _output(out, length, dst_type)
+		cdef long ret
+		with nogil:
+			ret = fir_run(self.fir, buf.buf, buf.type, buf.length, out.buf, dst_type, scale, signed_scale)
+		if ret < 0:
+			raise MemoryError()
+		return out
+
+cdef extern from "chain.h" nogil:
+	enum:
+		CHAIN_AVERAGE
+		CHAIN_INTEGRATE
+		CHAIN_RECTIFY
+		CHAIN_PEAK
+		CHAIN_NORMALIZE
+	ctypedef struct chain_stage_t:
+		int kind
+		int in_type
+		int out_type
+		size_t n
+		double a
+		double b
+	int chain_supports_type(int type)
+	int block_supports_type(int type)
+	size_t chain_output_length(chain_stage_t * stages, size_t n_stages, size_t len)
+	long chain_run(chain_stage_t * stages, size_t n_stages, void * in_buf, size_t len,
+	               void * out, size_t * error_index, double * error_value)
+
+cdef class Chain:
+	"""
+	Chain()
+
+	a sequence of preprocessing steps, that is applied to a trace in a single pass
+
+	Instead of creating an intermediate :class:`Buffer` for each step, the
+	samples are streamed through all steps at once. The result is the same
+	as calling the respective functions one after another.
+
+	>>> chain = Chain().integrate(2, dst_type=types.uint16_t).rectify(avg=6)
+	>>> print chain.process(buffer_from_list(types.uint8_t, [1, 2, 3, 4, 5])).as_list()
+	[3, 1, 1, 3]
+
+	Peak extraction requires *avg* and *std_dev* and keeps the input type,
+	and normalization requires *min* and *max* and an 8 or 16 bit integer
+	output type.
+	"""
+	cdef list stages
+	cdef chain_stage_t * compiled[0x30]
+
+	def __init__(self):
+		self.stages = []
+
+	def __dealloc__(self):
+		for i in range(0x30):
+			free(self.compiled[i])
+
+	def _add(self, kind, dst_type, n=0, a=0, b=0):
+		for i in range(0x30):
+			free(self.compiled[i])
+			self.compiled[i] = NULL
+		self.stages.append((kind, dst_type, n, a, b))
+		return self
+
+	def average(self, size_t n, double scale=1, int dst_type=0):
+		"adds an :func:`average` step, returns the :class:`Chain`"
+		return self._add(CHAIN_AVERAGE, dst_type, n, scale)
+	def integrate(self, size_t n, int dst_type=0):
+		"adds an :func:`integrate` step, returns the :class:`Chain`"
+		return self._add(CHAIN_INTEGRATE, dst_type, n)
+	def rectify(self, double avg, int dst_type=0):
+		"adds a :func:`rectify` step, returns the :class:`Chain`"
+		return self._add(CHAIN_RECTIFY, dst_type, 0, avg)
+	def peak_extract(self, double avg, double std_dev, int dst_type=0):
+		"adds a :func:`peak_extract` step (without break detection), returns the :class:`Chain`"
+		return self._add(CHAIN_PEAK, dst_type, 0, avg, std_dev)
+	def normalize(self, double min, double max, int dst_type=0):
+		"adds a :func:`normalize` step, returns the :class:`Chain`"
+		return self._add(CHAIN_NORMALIZE, dst_type, 0, min, max)
+
+	def __len__(self):
+		return len(self.stages)
+
+	cdef chain_stage_t * compile(self, int type):
+		"returns the stages for input traces of *type* or NULL if they cannot be fused"
+		if not 0 < type < 0x30 or not self.stages:
+			return NULL
+		if self.compiled[type] != NULL:
+			return self.compiled[type]
+		cdef chain_stage_t * stages = <chain_stage_t *> malloc(len(self.stages) * sizeof(chain_stage_t))
+		for k, (kind, dst_type, n, a, b) in enumerate(self.stages):
+			stages[k].kind = kind
+			stages[k].in_type = type
+			stages[k].out_type = type = dst_type or type
+			stages[k].n = n
+			stages[k].a = a
+			stages[k].b = b
+			if not chain_supports_type(type) or (kind in (CHAIN_AVERAGE, CHAIN_INTEGRATE) and n == 0) \
+				or (kind == CHAIN_PEAK and stages[k].in_type != type) \
+				or (kind == CHAIN_NORMALIZE and (type & 0x20 or type & 0xf > 2)):
+				free(stages)
+				return NULL
+		if not chain_supports_type(stages[0].in_type):
+			free(stages)
+			return NULL
+		self.compiled[stages[0].in_type] = stages
+		return stages
+
+	def accepts(self, int type):
+		"returns whether traces of *type* can be processed"
+		return self.compile(type) != NULL
+
+	def process(self, Buffer buf, Buffer out=None):
+		"""
+		process(buf, out=None) -> :class:`Buffer`
+
+		applies all steps to the :class:`Buffer` *buf*
+
+		Raises :class:`NormalizeException` if a sample exceeds the range of a
+		normalization step.
+		"""
+		buf = _contiguous(buf)
+		cdef chain_stage_t * stages = self.compile(buf.type)
+		if stages == NULL:
+			raise Exception("cannot process traces of type %x with this chain" % buf.type)
+		cdef size_t n_stages = len(self.stages)
+		cdef size_t length = chain_output_length(stages, n_stages, buf.length)
+		out = _output(out, length, stages[n_stages - 1].out_type)
+		cdef long ret
+		cdef size_t error_index = 0
+		cdef double error_value = 0
+		with nogil:
+			ret = chain_run(stages, n_stages, buf.buf, buf.length, out.buf, &error_index, &error_value)
+		if ret < 0:
+			raise NormalizeException("sample %d (%f) exceeded min,max range" % (error_index, error_value))
+		out.length = ret
+		return out
+
+cdef class _Moments:
+	"running mean and sum of squared deviations of a number of traces"
+	cdef Buffer mean
+	cdef Buffer m2
+	cdef size_t count
+	cdef object lock
+	def __init__(self, size_t size, int type):
+		self.mean = new_buffer(size, type)
+		self.m2 = new_buffer(size, type)
+		self.mean.zero()
+		self.m2.zero()
+		self.count = 0
+		self.lock = Lock()
+	cdef merge(self, _Moments other):
+		"adds the moments of *other*, whose lock has to be held by the caller"
+		if other.count == 0:
+			return
+		cdef _F fkt = mod[T(self.mean.type)]
+		with nogil:
+			fkt.merge_moments(self.mean.buf, self.m2.buf, other.mean.buf, other.m2.buf, self.mean.length, self.count, other.count)
+		self.count += other.count
 
 cdef class AverageCounter:
 	"""
 	The :class:`AverageCounter` processes traces sequentially and calculates a
 	average and variance trace based on the input traces.
 
+	Each thread updates its own running mean and variance (Welford's
+	algorithm), which are combined when the result is requested. Thus
+	threads do not wait on each other and the variance stays accurate
+	for many traces.
+
 	>>> a = AverageCounter(size=5, type=types.float)
 	>>> a.add_trace(buffer_from_list(types.uint8_t, [0, 1, 2, 3, 4]))
 	>>> a.add_trace(buffer_from_list(types.uint8_t, [2, 2, 2, 2, 2]))
@@ -426,10 +885,10 @@ cdef class AverageCounter:
 	>>> print var
 	[1.0, 0.25, 0.0, 0.25, 1.0]
 	"""
-	cdef Buffer out_sum
-	cdef Buffer out_square_sum
-	cdef int count
+	cdef size_t size
+	cdef int type
 	cdef int generate_variance
+	cdef dict shards
 	cdef object lock
 	def __init__(self, size_t size, int type, int auto_type=False, int generate_variance=True):
 		"""
@@ -437,37 +896,54 @@ cdef class AverageCounter:
 
 		creates an :class:`AverageCounter` instance with space for *size* samples
 
-		If *auto_type* is set, the function will try to automatically select
-		a fitting data type, based on the input :class:`Buffer` type set in *type*.
+		The moments are kept in the floating point *type*, integer types
+		(and *auto_type*) select :attr:`types.double`.
 		"""
-		if auto_type:
-			type_size = type & 0xf
-			if type_size < 8: #advance to a 8-byte sized type (uint64_t/double) if possible
-				type = (type & 0x30) | 8
-			else: #if values might get too big, double is a better choice
-				type = types.double
-		self.out_sum = new_buffer(size, type)
-		self.out_square_sum = new_buffer(size, type)
-		self.out_sum.zero()
-		self.out_square_sum.zero()
-		self.count = 0
+		if auto_type or not type & 0x20:
+			type = types.double
+		self.size = size
+		self.type = type
 		self.generate_variance = generate_variance
+		self.shards = {}
 		self.lock = Lock()
+	cdef _Moments _shard(self):
+		"returns the moments updated by the calling thread"
+		cdef long thread = get_ident()
+		s = self.shards.get(thread)
+		if s is None:
+			s = _Moments(self.size, self.type)
+			self.lock.acquire()
+			self.shards[thread] = s
+			self.lock.release()
+		return s
+	cdef _Moments _combined(self):
+		"returns the moments of all traces processed so far"
+		cdef _Moments total = _Moments(self.size, self.type), s
+		self.lock.acquire()
+		shards = self.shards.values()
+		self.lock.release()
+		for s in shards:
+			s.lock.acquire()
+			total.merge(s)
+			s.lock.release()
+		return total
 	def add_trace(self, Buffer buf, int length=0):
+		buf = _contiguous(buf)
 		if length == 0:
 			length = buf.length
-		if length > self.out_sum.length:
-			raise Exception("trace with len %d excceds averagecounter capacity of %d" % (length, self.out_sum.length))
+		if length > self.size:
+			raise Exception("trace with len %d excceds averagecounter capacity of %d" % (length, self.size))
 		if length > buf.length:
 			raise Exception("cannot force a buffer to be longer than it is")
-		if length != self.out_sum.length:
+		if length != self.size:
 			warn("processing incomplete trace, this may derange the result")
-		cdef _F fkt = mod[T(self.out_sum.type, buf.type)]
-		self.lock.acquire()
+		cdef _F fkt = mod[T(self.type, buf.type)]
+		cdef _Moments s = self._shard()
+		s.lock.acquire() #only contended while the result is computed
+		s.count += 1
 		with nogil:
-			fkt.add_average(self.out_sum.buf if self.generate_variance else NULL, self.out_square_sum.buf, buf.buf, length)
-		self.lock.release()
-		self.count += 1
+			fkt.add_moments(s.mean.buf, s.m2.buf if self.generate_variance else NULL, buf.buf, length, s.count)
+		s.lock.release()
 
 	def get_buf(self):
 		"""
@@ -476,10 +952,354 @@ cdef class AverageCounter:
 		returns one float buffer for :class:`Buffer` the average and
 		one for the variance of all processed traces
 		"""
-		avg = scale(self.out_sum, 1./self.count, dst_type=types.float)
-		variance = scale(self.out_square_sum, 1./self.count, dst_type=types.float)
-		variance = diff(variance, square(avg))
+		cdef _Moments total = self._combined()
+		avg = scale(total.mean, 1, dst_type=types.float)
+		variance = scale(total.m2, 1./total.count, dst_type=types.float)
 		return (avg, variance)
 	def __len__(self):
 		"returns the number of traces already processed"
-		return self.count
+		cdef _Moments s
+		cdef size_t count = 0
+		self.lock.acquire()
+		for s in self.shards.values():
+			count += s.count
+		self.lock.release()
+		return count
+	def merge(self, AverageCounter other):
+		"""
+		merge(other)
+
+		adds the traces accumulated by the :class:`AverageCounter` *other*,
+		which must have the same size and type
+		"""
+		if other.size != self.size or other.type != self.type:
+			raise Exception("cannot merge average counters of different size or type")
+		cdef _Moments total = other._combined()
+		cdef _Moments s = self._shard()
+		s.lock.acquire()
+		s.merge(total)
+		s.lock.release()
+	def __reduce__(self):
+		cdef _Moments total = self._combined()
+		return (_average_counter, (self.size, self.type, self.generate_variance,
+			total.count, memoryview(total.mean).tobytes(), memoryview(total.m2).tobytes()))
+
+def _average_counter(size, type, generate_variance, count, means, m2s):
+	"restores a pickled :class:`AverageCounter`"
+	cdef AverageCounter a = AverageCounter(size, type, generate_variance=generate_variance)
+	cdef size_t length = size * (type & 0xf)
+	if len(means) != length or len(m2s) != length:
+		raise Exception("invalid average counter state")
+	cdef _Moments s = a._shard()
+	memcpy(s.mean.buf, <char *> means, length)
+	memcpy(s.m2.buf, <char *> m2s, length)
+	s.count = count
+	return a
+
+cdef extern from "parallel.h" nogil:
+	ctypedef void (*parallel_fn)(void * ctx, size_t begin, size_t end)
+	int parallel_threads()
+	void parallel_set_threads(int threads)
+	void parallel_for(size_t n, size_t min_chunk, parallel_fn fn, void * ctx)
+
+def set_threads(int threads=0):
+	"""
+	set_threads(threads=0)
+
+	sets the number of native threads the :class:`TraceMatrix` functions use,
+	0 uses all cpus available to the process
+	"""
+	parallel_set_threads(threads)
+
+def get_threads():
+	"returns the number of native threads the :class:`TraceMatrix` functions use"
+	return parallel_threads()
+
+# each thread processes at least this many samples
+DEF ROWS_MIN_SAMPLES = 65536
+
+# arguments of the row kernels below, which apply a function of the type table
+# to the rows begin..end-1 of a matrix
+ctypedef struct _rows_t:
+	_F fkt
+	char * in_buf
+	char * in2_buf
+	char * out_buf
+	size_t in_stride
+	size_t out_stride
+	size_t cols
+	size_t n
+	size_t skip
+	double a
+	double b
+	int flag
+	double * stats
+	int * status
+
+cdef void _rows_average(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.fkt.average_filter(r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.cols, r.n, r.skip, r.a, r.flag)
+
+cdef void _rows_integrate(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.fkt.integrate(r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.cols, r.n)
+
+cdef void _rows_scale(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.fkt.scale(r.cols, r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.flag, r.a)
+
+cdef void _rows_rectify(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.fkt.rectify(r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.cols, r.a)
+
+cdef void _rows_diff(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.fkt.diff(r.cols, r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.in2_buf + i * r.in_stride, r.flag)
+
+cdef void _rows_normalize(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	for i in range(begin, end):
+		r.status[i] = r.fkt.normalize(r.out_buf + i * r.out_stride, r.in_buf + i * r.in_stride, r.cols, r.a, r.b)
+
+cdef void _rows_analyze(void * ctx, size_t begin, size_t end) nogil:
+	cdef _rows_t * r = <_rows_t *> ctx
+	cdef size_t i
+	cdef double * s
+	for i in range(begin, end):
+		s = r.stats + 4 * i
+		r.fkt.analyze(r.in_buf + i * r.in_stride, r.cols, &s[0], &s[1] if r.flag else NULL, &s[2], &s[3])
+
+cdef class TraceMatrix:
+	"""
+	TraceMatrix(rows, cols, type)
+
+	a block of *rows* traces of *cols* samples each, stored in a single
+	:class:`Buffer` (:attr:`data`). ``m[i]`` returns trace *i* as a
+	:class:`Buffer` sharing the memory of the matrix.
+
+	The methods apply the corresponding preprocessing function to all traces
+	in a single call, which releases the GIL and splits the traces among
+	native threads (see :func:`set_threads`). Functions returning traces
+	return a new :class:`TraceMatrix` or write to the matrix *out*.
+
+	>>> m = TraceMatrix.from_buffers([buffer_from_list(types.uint8_t, [1, 2, 3, 4]),
+	...                               buffer_from_list(types.uint8_t, [5, 7, 9, 11])])
+	>>> m.integrate(2).as_list()
+	[[3, 5, 7], [12, 16, 20]]
+	>>> m.analyze(include_variance=False)[1]
+	(8.0, 0.0, 5.0, 11.0)
+	"""
+	cdef readonly Buffer data
+	cdef readonly size_t rows
+	cdef readonly size_t cols
+	cdef Py_ssize_t shape[2]
+	cdef Py_ssize_t strides[2]
+
+	def __init__(self, size_t rows, size_t cols, int type, Buffer data=None):
+		if data is None:
+			data = _new_buffer(rows * cols, type)
+		elif data.type != type or data.length < rows * cols or not data.is_contiguous():
+			raise Exception("data buffer does not fit a %dx%d matrix of type %x" % (rows, cols, type))
+		self.data = data
+		self.rows = rows
+		self.cols = cols
+
+	@staticmethod
+	def from_buffers(bufs, size_t cols=0, int type=0):
+		"""
+		from_buffers(bufs, cols=0, type=types.void) -> :class:`TraceMatrix`
+
+		copies the :class:`Buffer` objects *bufs* into a new matrix. Longer traces
+		are truncated to *cols* samples, by default the length of the shortest one.
+		"""
+		cdef Buffer b
+		if not bufs:
+			raise ValueError("no traces given")
+		if type == 0:
+			type = (<Buffer> bufs[0]).type
+		if cols == 0:
+			cols = min(len(b) for b in bufs)
+		cdef TraceMatrix m = TraceMatrix(len(bufs), cols, type)
+		cdef size_t i
+		for i, b in enumerate(bufs):
+			if b.type != type or b.length < cols:
+				raise ValueError("trace %d does not fit the matrix" % i)
+			_gather(m[i], b[:cols])
+		return m
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self, size_t i):
+		if i >= self.rows:
+			raise IndexError("row index out of range")
+		cdef size_t size = self.cols * (self.data.type & 0xf)
+		cdef Buffer b = _Buffer(<char *> self.data.buf + i * size, self.cols, self.data.type)
+		b.readonly = self.data.readonly
+		b.base = self
+		return b
+
+	def get_type(self):
+		return self.data.type
+
+	def as_list(self):
+		"returns a list of the rows as lists"
+		return [self[i].as_list() for i in range(self.rows)]
+
+	def __repr__(self):
+		return "<TraceMatrix %dx%d of type %x>" % (self.rows, self.cols, self.data.type)
+
+	def __getbuffer__(self, Py_buffer * view, int flags):
+		cdef int type = self.data.type
+		if type not in _formats:
+			raise BufferError("type %x has no buffer format" % type)
+		if self.data.readonly and flags & PyBUF_WRITABLE:
+			raise BufferError("buffer is read-only")
+		cdef Py_ssize_t itemsize = type & 0xf
+		self.shape[0]   = self.rows
+		self.shape[1]   = self.cols
+		self.strides[0] = self.cols * itemsize
+		self.strides[1] = itemsize
+		view.buf        = self.data.buf
+		view.obj        = self
+		view.len        = self.rows * self.cols * itemsize
+		view.readonly   = self.data.readonly
+		view.itemsize   = itemsize
+		view.format     = NULL
+		if flags & PyBUF_FORMAT:
+			view.format = _formats[type]
+		view.ndim       = 2
+		view.shape      = self.shape   if flags & PyBUF_ND      else NULL
+		view.strides    = self.strides if flags & PyBUF_STRIDES else NULL
+		view.suboffsets = NULL
+		view.internal   = NULL
+
+	def __releasebuffer__(self, Py_buffer * view):
+		pass
+
+	cdef TraceMatrix _output(self, TraceMatrix out, size_t cols, int dst_type):
+		if out is None:
+			return TraceMatrix(self.rows, cols, dst_type)
+		out.data.check_writable()
+		if out.rows != self.rows or out.cols != cols or out.data.type != dst_type:
+			raise Exception("out matrix must be a %dx%d matrix of type %x" % (self.rows, cols, dst_type))
+		return out
+
+	cdef _run(self, parallel_fn fn, _rows_t * r, TraceMatrix out, int dst_type):
+		r.fkt = mod[T(dst_type, self.data.type)]
+		r.in_buf = <char *> self.data.buf
+		r.in_stride = self.cols * (self.data.type & 0xf)
+		if out is not None:
+			r.out_buf = <char *> out.data.buf
+			r.out_stride = out.cols * (dst_type & 0xf)
+		r.cols = self.cols
+		cdef size_t min_rows = ROWS_MIN_SAMPLES / self.cols + 1 if self.cols else 1
+		with nogil:
+			parallel_for(self.rows, min_rows, fn, r)
+
+	def average(self, size_t n, size_t skip=1, double scale=1, int signed_scale=0, int dst_type=0, TraceMatrix out=None):
+		"applies :func:`average` to all traces"
+		if n == 0 or n > self.cols or skip == 0:
+			raise ValueError("invalid average length")
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, (self.cols - n) / skip + 1, dst_type)
+		cdef _rows_t r
+		r.n, r.skip, r.a, r.flag = n, skip, scale, signed_scale
+		self._run(_rows_average, &r, out, dst_type)
+		return out
+
+	def integrate(self, size_t n, int dst_type=0, TraceMatrix out=None):
+		"applies :func:`integrate` to all traces"
+		if n == 0 or n > self.cols:
+			raise ValueError("invalid integration length")
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, self.cols - n + 1, dst_type)
+		cdef _rows_t r
+		r.n = n
+		self._run(_rows_integrate, &r, out, dst_type)
+		return out
+
+	def scale(self, double scale=1.0, int signed_scale=0, int dst_type=0, TraceMatrix out=None):
+		"applies :func:`scale` to all traces"
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, self.cols, dst_type)
+		cdef _rows_t r
+		r.a, r.flag = scale, signed_scale
+		self._run(_rows_scale, &r, out, dst_type)
+		return out
+
+	def rectify(self, double avg, int dst_type=0, TraceMatrix out=None):
+		"applies :func:`rectify` to all traces"
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, self.cols, dst_type)
+		cdef _rows_t r
+		r.a = avg
+		self._run(_rows_rectify, &r, out, dst_type)
+		return out
+
+	def diff(self, TraceMatrix other, int absolute=True, int dst_type=0, TraceMatrix out=None):
+		"applies :func:`diff` to the corresponding traces of this matrix and *other*"
+		if other.rows != self.rows or other.cols != self.cols or other.data.type != self.data.type:
+			raise Exception("both matrices must be of same shape and type")
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, self.cols, dst_type)
+		cdef _rows_t r
+		r.in2_buf = <char *> other.data.buf
+		r.flag = absolute
+		self._run(_rows_diff, &r, out, dst_type)
+		return out
+
+	def normalize(self, double min, double max, int dst_type=0, TraceMatrix out=None):
+		"""
+		applies :func:`normalize` with the fixed range *min*, *max* to all traces
+
+		If samples exceed the range, a :exc:`NormalizeException` is raised, whose
+		``rows`` attribute lists the failing traces.
+		"""
+		dst_type = dst_type or (out.data.type if out is not None else self.data.type)
+		out = self._output(out, self.cols, dst_type)
+		cdef _rows_t r
+		r.a, r.b = min, max
+		r.status = <int *> malloc(sizeof(int) * (self.rows or 1))
+		if r.status == NULL:
+			raise MemoryError()
+		try:
+			self._run(_rows_normalize, &r, out, dst_type)
+			failed = [i for i in range(self.rows) if r.status[i] != 1]
+		finally:
+			free(r.status)
+		if failed:
+			e = NormalizeException("%d traces exceeded min,max range %s, the first is %d" % (len(failed), (min, max), failed[0]))
+			e.rows = failed
+			raise e
+		return out
+
+	def analyze(self, int include_variance=True):
+		"""
+		analyze(include_variance=True) -> list of (average, variance, min, max)
+
+		applies :func:`analyze` to all traces
+		"""
+		cdef _rows_t r
+		r.flag = include_variance
+		r.stats = <double *> malloc(sizeof(double) * 4 * (self.rows or 1))
+		if r.stats == NULL:
+			raise MemoryError()
+		try:
+			for i in range(4 * self.rows):
+				r.stats[i] = 0
+			self._run(_rows_analyze, &r, None, self.data.type)
+			return [tuple(r.stats[4 * i + k] for k in range(4)) for i in range(self.rows)]
+		finally:
+			free(r.stats)
@@ -0,0 +1,13 @@
+#ifndef __RASTER_H
+#define __RASTER_H
+
+/* configuration of the rasterization, see raster() */
+typedef struct {
+	int trigger;       /* edge-comparism threshold starting the search for a match */
+	int pause_trigger; /* distance between matches indicating a pause */
+	int min_pause;     /* number of pauses that must occur */
+	int max_pause;     /* number of pauses allowed to occur */
+	int header_size;   /* number of samples to skip */
+} raster_config_t;
+
+#endif
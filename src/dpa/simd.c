@@ -0,0 +1,324 @@
+/*
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+*/
+#include <stdint.h>
+#include <stddef.h>
+#include <string.h>
+
+#include "simd.h"
+
+/**************************************
+ * vector kernels with cpu dispatch
+ *
+ * the kernels of _simd.c are compiled for SSE2, AVX2 and AVX-512. The most
+ * capable variant the cpu supports is selected at runtime, so the same
+ * binary runs on all x86 machines. Other compilers and architectures use
+ * the scalar loops of _preprocess.c only.
+ *
+ * there are kernels for float output from uint8_t, uint16_t, int16_t and float input
+ * (as used for the moments of AverageCounter) and for normalizing float traces. */
+
+#if defined(__GNUC__) && !defined(__clang__) && __GNUC__ >= 9 && (defined(__x86_64__) || defined(__i386__))
+#  define SIMD_X86 1
+#endif
+
+#define TYPE_U8    0x11
+#define TYPE_U16   0x12
+#define TYPE_S16   0x02
+#define TYPE_FLOAT 0x24
+
+typedef struct {
+	/* indexed by the input type, see simd_input() */
+	void (*scale[4])(float * out, const void * in, size_t len, int issigned, double scale);
+	void (*diff[4])(float * out, const void * a, const void * b, size_t len, int absolute);
+	void (*square[4])(float * out, const void * in, size_t len);
+	void (*add_moments[4])(float * mean, float * m2, const void * in, size_t len, float inv);
+	void (*rectify[4])(float * out, const void * in, size_t len, double avg);
+	void (*analyze[4])(const void * in, size_t len, double * average, double * variance, double * min, double * max);
+	/* indexed by the output type uint8_t or uint16_t, for float input */
+	void (*normalize[2])(void * out, const void * in, size_t len, double min, double max,
+	                     double scale, double type_min, int * ret);
+} simd_kernels_t;
+
+static double simd_sum8(const double * p) {
+	return ((p[0] + p[1]) + (p[2] + p[3])) + ((p[4] + p[5]) + (p[6] + p[7]));
+}
+
+static double simd_min8(const double * p) {
+	double r = p[0];
+	int i;
+	for(i=1;i<8;i++)
+		if(p[i] < r) r = p[i];
+	return r;
+}
+
+static double simd_max8(const double * p) {
+	double r = p[0];
+	int i;
+	for(i=1;i<8;i++)
+		if(p[i] > r) r = p[i];
+	return r;
+}
+
+/* the scalar squares of the kernels */
+static inline float simd_square_int(uint32_t x) {
+	return (int32_t) (x * x);
+}
+
+static inline float simd_square_float(float x) {
+	return x * x;
+}
+
+#ifdef SIMD_X86
+#include <immintrin.h>
+
+/* keep multiplications and additions separately rounded, as in the scalar code */
+#pragma GCC optimize("fp-contract=off")
+
+/* SSE2, 4 floats or 2 doubles per register */
+#pragma GCC push_options
+#pragma GCC target("sse2")
+static inline __m128 simd_sel_ps_sse2(__m128 mask, __m128 a, __m128 b) {
+	return _mm_or_ps(_mm_and_ps(mask, a), _mm_andnot_ps(mask, b));
+}
+static inline __m128d simd_sel_pd_sse2(__m128d mask, __m128d a, __m128d b) {
+	return _mm_or_pd(_mm_and_pd(mask, a), _mm_andnot_pd(mask, b));
+}
+static inline __m128i simd_load_u8_sse2(const uint8_t * p) {
+	int32_t v;
+	__m128i zero = _mm_setzero_si128();
+	memcpy(&v, p, sizeof(v));
+	return _mm_unpacklo_epi16(_mm_unpacklo_epi8(_mm_cvtsi32_si128(v), zero), zero);
+}
+/* there is no 32 bit multiplication in SSE2, so the even and odd lanes
+ * are multiplied to 64 bit separately */
+static inline __m128i simd_square_sse2(__m128i x) {
+	__m128i even = _mm_mul_epu32(x, x);
+	__m128i odd = _mm_mul_epu32(_mm_srli_epi64(x, 32), _mm_srli_epi64(x, 32));
+	return _mm_unpacklo_epi32(_mm_shuffle_epi32(even, _MM_SHUFFLE(0, 0, 2, 0)), _mm_shuffle_epi32(odd, _MM_SHUFFLE(0, 0, 2, 0)));
+}
+static inline void simd_store_u8_sse2(uint8_t * p, __m128i x) {
+	int32_t v;
+	x = _mm_packs_epi32(x, x);
+	v = _mm_cvtsi128_si32(_mm_packus_epi16(x, x));
+	memcpy(p, &v, sizeof(v));
+}
+static inline void simd_store_u16_sse2(uint16_t * p, __m128i x) {
+	x = _mm_srai_epi32(_mm_slli_epi32(x, 16), 16); /* the low 16 bits, for the signed pack */
+	_mm_storel_epi64((__m128i *) p, _mm_packs_epi32(x, x));
+}
+#define VNAME(x) x##_sse2
+#define VF __m128
+#define VD __m128d
+#define VI __m128i
+#define N  4
+#define DN 2
+#define F_LOAD(p)              _mm_loadu_ps(p)
+#define F_STORE(p, x)          _mm_storeu_ps(p, x)
+#define F_SET1(v)              _mm_set1_ps(v)
+#define F_ADD(a, b)            _mm_add_ps(a, b)
+#define F_SUB(a, b)            _mm_sub_ps(a, b)
+#define F_MUL(a, b)            _mm_mul_ps(a, b)
+#define F_SEL_LT(x, y, a, b)   simd_sel_ps_sse2(_mm_cmplt_ps(x, y), a, b)
+#define I_LOAD_U8(p)           simd_load_u8_sse2(p)
+#define I_LOAD_U16(p)          _mm_unpacklo_epi16(_mm_loadl_epi64((const __m128i *) (p)), _mm_setzero_si128())
+#define I_LOAD_S16(p)          _mm_srai_epi32(_mm_unpacklo_epi16(_mm_setzero_si128(), _mm_loadl_epi64((const __m128i *) (p))), 16)
+#define I_TO_F(x)              _mm_cvtepi32_ps(x)
+#define I_SQUARE(x)            simd_square_sse2(x)
+#define D_SET1(v)              _mm_set1_pd(v)
+#define D_ADD(a, b)            _mm_add_pd(a, b)
+#define D_SUB(a, b)            _mm_sub_pd(a, b)
+#define D_MUL(a, b)            _mm_mul_pd(a, b)
+#define D_DIV(a, b)            _mm_div_pd(a, b)
+#define D_STORE(p, x)          _mm_storeu_pd(p, x)
+#define D_SEL_GT(x, y, a, b)   simd_sel_pd_sse2(_mm_cmpgt_pd(x, y), a, b)
+#define D_SEL_LT(x, y, a, b)   simd_sel_pd_sse2(_mm_cmplt_pd(x, y), a, b)
+#define D_OUTSIDE(x, lo, hi)   _mm_movemask_pd(_mm_or_pd(_mm_cmpgt_pd(x, hi), _mm_cmplt_pd(x, lo)))
+#define F_TO_D_LO(x)           _mm_cvtps_pd(x)
+#define F_TO_D_HI(x)           _mm_cvtps_pd(_mm_movehl_ps(x, x))
+#define D_TO_F(lo, hi)         _mm_movelh_ps(_mm_cvtpd_ps(lo), _mm_cvtpd_ps(hi))
+#define D_STORE_U8(p, lo, hi)  simd_store_u8_sse2(p, _mm_unpacklo_epi64(_mm_cvttpd_epi32(lo), _mm_cvttpd_epi32(hi)))
+#define D_STORE_U16(p, lo, hi) simd_store_u16_sse2(p, _mm_unpacklo_epi64(_mm_cvttpd_epi32(lo), _mm_cvttpd_epi32(hi)))
+#include "_simd.c"
+#pragma GCC pop_options
+
+/* AVX2, 8 floats or 4 doubles per register */
+#pragma GCC push_options
+#pragma GCC target("avx2")
+static inline void simd_store_u8_avx2(uint8_t * p, __m128i a, __m128i b) {
+	__m128i x = _mm_packs_epi32(a, b);
+	_mm_storel_epi64((__m128i *) p, _mm_packus_epi16(x, x));
+}
+#define VNAME(x) x##_avx2
+#define VF __m256
+#define VD __m256d
+#define VI __m256i
+#define N  8
+#define DN 4
+#define F_LOAD(p)              _mm256_loadu_ps(p)
+#define F_STORE(p, x)          _mm256_storeu_ps(p, x)
+#define F_SET1(v)              _mm256_set1_ps(v)
+#define F_ADD(a, b)            _mm256_add_ps(a, b)
+#define F_SUB(a, b)            _mm256_sub_ps(a, b)
+#define F_MUL(a, b)            _mm256_mul_ps(a, b)
+#define F_SEL_LT(x, y, a, b)   _mm256_blendv_ps(b, a, _mm256_cmp_ps(x, y, _CMP_LT_OQ))
+#define I_LOAD_U8(p)           _mm256_cvtepu8_epi32(_mm_loadl_epi64((const __m128i *) (p)))
+#define I_LOAD_U16(p)          _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i *) (p)))
+#define I_LOAD_S16(p)          _mm256_cvtepi16_epi32(_mm_loadu_si128((const __m128i *) (p)))
+#define I_TO_F(x)              _mm256_cvtepi32_ps(x)
+#define I_SQUARE(x)            _mm256_mullo_epi32(x, x)
+#define D_SET1(v)              _mm256_set1_pd(v)
+#define D_ADD(a, b)            _mm256_add_pd(a, b)
+#define D_SUB(a, b)            _mm256_sub_pd(a, b)
+#define D_MUL(a, b)            _mm256_mul_pd(a, b)
+#define D_DIV(a, b)            _mm256_div_pd(a, b)
+#define D_STORE(p, x)          _mm256_storeu_pd(p, x)
+#define D_SEL_GT(x, y, a, b)   _mm256_blendv_pd(b, a, _mm256_cmp_pd(x, y, _CMP_GT_OQ))
+#define D_SEL_LT(x, y, a, b)   _mm256_blendv_pd(b, a, _mm256_cmp_pd(x, y, _CMP_LT_OQ))
+#define D_OUTSIDE(x, lo, hi)   _mm256_movemask_pd(_mm256_or_pd(_mm256_cmp_pd(x, hi, _CMP_GT_OQ), _mm256_cmp_pd(x, lo, _CMP_LT_OQ)))
+#define F_TO_D_LO(x)           _mm256_cvtps_pd(_mm256_castps256_ps128(x))
+#define F_TO_D_HI(x)           _mm256_cvtps_pd(_mm256_extractf128_ps(x, 1))
+#define D_TO_F(lo, hi)         _mm256_insertf128_ps(_mm256_castps128_ps256(_mm256_cvtpd_ps(lo)), _mm256_cvtpd_ps(hi), 1)
+#define D_STORE_U8(p, lo, hi)  simd_store_u8_avx2(p, _mm256_cvttpd_epi32(lo), _mm256_cvttpd_epi32(hi))
+#define D_STORE_U16(p, lo, hi) _mm_storeu_si128((__m128i *) (p), _mm_packus_epi32(_mm256_cvttpd_epi32(lo), _mm256_cvttpd_epi32(hi)))
+#include "_simd.c"
+#pragma GCC pop_options
+
+/* AVX-512, 16 floats or 8 doubles per register */
+#pragma GCC push_options
+#pragma GCC target("avx512f")
+static inline __m512i simd_join_avx512(__m256i a, __m256i b) {
+	return _mm512_inserti64x4(_mm512_castsi256_si512(a), b, 1);
+}
+static inline __m512 simd_join_ps_avx512(__m256 a, __m256 b) {
+	return _mm512_castpd_ps(_mm512_insertf64x4(_mm512_castps_pd(_mm512_castps256_ps512(a)), _mm256_castps_pd(b), 1));
+}
+#define VNAME(x) x##_avx512
+#define VF __m512
+#define VD __m512d
+#define VI __m512i
+#define N  16
+#define DN 8
+#define F_LOAD(p)              _mm512_loadu_ps(p)
+#define F_STORE(p, x)          _mm512_storeu_ps(p, x)
+#define F_SET1(v)              _mm512_set1_ps(v)
+#define F_ADD(a, b)            _mm512_add_ps(a, b)
+#define F_SUB(a, b)            _mm512_sub_ps(a, b)
+#define F_MUL(a, b)            _mm512_mul_ps(a, b)
+#define F_SEL_LT(x, y, a, b)   _mm512_mask_blend_ps(_mm512_cmp_ps_mask(x, y, _CMP_LT_OQ), b, a)
+#define I_LOAD_U8(p)           _mm512_cvtepu8_epi32(_mm_loadu_si128((const __m128i *) (p)))
+#define I_LOAD_U16(p)          _mm512_cvtepu16_epi32(_mm256_loadu_si256((const __m256i *) (p)))
+#define I_LOAD_S16(p)          _mm512_cvtepi16_epi32(_mm256_loadu_si256((const __m256i *) (p)))
+#define I_TO_F(x)              _mm512_cvtepi32_ps(x)
+#define I_SQUARE(x)            _mm512_mullo_epi32(x, x)
+#define D_SET1(v)              _mm512_set1_pd(v)
+#define D_ADD(a, b)            _mm512_add_pd(a, b)
+#define D_SUB(a, b)            _mm512_sub_pd(a, b)
+#define D_MUL(a, b)            _mm512_mul_pd(a, b)
+#define D_DIV(a, b)            _mm512_div_pd(a, b)
+#define D_STORE(p, x)          _mm512_storeu_pd(p, x)
+#define D_SEL_GT(x, y, a, b)   _mm512_mask_blend_pd(_mm512_cmp_pd_mask(x, y, _CMP_GT_OQ), b, a)
+#define D_SEL_LT(x, y, a, b)   _mm512_mask_blend_pd(_mm512_cmp_pd_mask(x, y, _CMP_LT_OQ), b, a)
+#define D_OUTSIDE(x, lo, hi)   (_mm512_cmp_pd_mask(x, hi, _CMP_GT_OQ) | _mm512_cmp_pd_mask(x, lo, _CMP_LT_OQ))
+#define F_TO_D_LO(x)           _mm512_cvtps_pd(_mm512_castps512_ps256(x))
+#define F_TO_D_HI(x)           _mm512_cvtps_pd(_mm256_castpd_ps(_mm512_extractf64x4_pd(_mm512_castps_pd(x), 1)))
+#define D_TO_F(lo, hi)         simd_join_ps_avx512(_mm512_cvtpd_ps(lo), _mm512_cvtpd_ps(hi))
+#define D_STORE_U8(p, lo, hi)  _mm_storeu_si128((__m128i *) (p), _mm512_cvtepi32_epi8(simd_join_avx512(_mm512_cvttpd_epi32(lo), _mm512_cvttpd_epi32(hi))))
+#define D_STORE_U16(p, lo, hi) _mm256_storeu_si256((__m256i *) (p), _mm512_cvtepi32_epi16(simd_join_avx512(_mm512_cvttpd_epi32(lo), _mm512_cvttpd_epi32(hi))))
+#include "_simd.c"
+#pragma GCC pop_options
+
+static const simd_kernels_t * simd_variants[] = {NULL, &kernels_sse2, &kernels_avx2, &kernels_avx512};
+#else
+static const simd_kernels_t * simd_variants[] = {NULL};
+#endif
+
+static int simd_current = SIMD_NONE;
+static const simd_kernels_t * simd_kernels = NULL;
+
+/* returns the most capable instruction set of this cpu */
+int simd_supported(void) {
+#ifdef SIMD_X86
+	__builtin_cpu_init();
+	if(__builtin_cpu_supports("avx512f")) return SIMD_AVX512;
+	if(__builtin_cpu_supports("avx2"))    return SIMD_AVX2;
+	if(__builtin_cpu_supports("sse2"))    return SIMD_SSE2;
+#endif
+	return SIMD_NONE;
+}
+
+int simd_level(void) {
+	return simd_current;
+}
+
+/* selects the kernels of the given instruction set, limited to the ones
+ * the cpu supports. a negative level selects the best one. returns the
+ * selected level */
+int simd_set_level(int level) {
+	int supported = simd_supported();
+	if(level < 0 || level > supported)
+		level = supported;
+	simd_current = level;
+	simd_kernels = simd_variants[level];
+	return level;
+}
+
+static int simd_input(int type) {
+	switch(type) {
+	case TYPE_U8:    return 0;
+	case TYPE_U16:   return 1;
+	case TYPE_FLOAT: return 2;
+	case TYPE_S16:   return 3;
+	}
+	return -1;
+}
+
+int simd_scale(void * out, int out_type, const void * in, int in_type, size_t len, int issigned, double scale) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || out_type != TYPE_FLOAT || k < 0) return 0;
+	simd_kernels->scale[k](out, in, len, issigned, scale);
+	return 1;
+}
+
+int simd_diff(void * out, int out_type, const void * a, const void * b, int in_type, size_t len, int absolute) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || out_type != TYPE_FLOAT || k < 0) return 0;
+	simd_kernels->diff[k](out, a, b, len, absolute);
+	return 1;
+}
+
+int simd_square(void * out, int out_type, const void * in, int in_type, size_t len) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || out_type != TYPE_FLOAT || k < 0) return 0;
+	simd_kernels->square[k](out, in, len);
+	return 1;
+}
+
+int simd_add_moments(void * mean, void * m2, int out_type, const void * in, int in_type, size_t len, double inv) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || out_type != TYPE_FLOAT || k < 0) return 0;
+	simd_kernels->add_moments[k](mean, m2, in, len, inv);
+	return 1;
+}
+
+int simd_rectify(void * out, int out_type, const void * in, int in_type, size_t len, double avg) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || out_type != TYPE_FLOAT || k < 0) return 0;
+	simd_kernels->rectify[k](out, in, len, avg);
+	return 1;
+}
+
+int simd_analyze(const void * in, int in_type, size_t len, double * average, double * variance, double * min, double * max) {
+	int k = simd_input(in_type);
+	if(!simd_kernels || k < 0 || len == 0) return 0;
+	simd_kernels->analyze[k](in, len, average, variance, min, max);
+	return 1;
+}
+
+int simd_normalize(void * out, int out_type, const void * in, int in_type, size_t len,
+                   double min, double max, double scale, double type_min, int * ret) {
+	if(!simd_kernels || in_type != TYPE_FLOAT || (out_type != TYPE_U8 && out_type != TYPE_U16)) return 0;
+	simd_kernels->normalize[out_type == TYPE_U16](out, in, len, min, max, scale, type_min, ret);
+	return 1;
+}
@@ -0,0 +1,30 @@
+#ifndef __SIMD_H
+#define __SIMD_H
+#include <stddef.h>
+
+/* instruction sets of the vector kernels, see simd_set_level() */
+#define SIMD_NONE   0
+#define SIMD_SSE2   1
+#define SIMD_AVX2   2
+#define SIMD_AVX512 3
+
+/* the type value (as in types.pxh) of a C type */
+#define SIMD_TYPE(t) (sizeof(t) | ((t) -1 > 0 ? 0x10 : 0) | ((t) 0.5 != 0 ? 0x20 : 0))
+
+int simd_supported(void);
+int simd_level(void);
+int simd_set_level(int level);
+
+/* the vector versions of the functions of _preprocess.c. each returns 0
+ * without doing anything if there is no kernel for the type combination,
+ * in which case the caller runs its scalar loop */
+int simd_scale(void * out, int out_type, const void * in, int in_type, size_t len, int issigned, double scale);
+int simd_diff(void * out, int out_type, const void * a, const void * b, int in_type, size_t len, int absolute);
+int simd_square(void * out, int out_type, const void * in, int in_type, size_t len);
+int simd_add_moments(void * mean, void * m2, int out_type, const void * in, int in_type, size_t len, double inv);
+int simd_rectify(void * out, int out_type, const void * in, int in_type, size_t len, double avg);
+int simd_analyze(const void * in, int in_type, size_t len, double * average, double * variance, double * min, double * max);
+int simd_normalize(void * out, int out_type, const void * in, int in_type, size_t len,
+                   double min, double max, double scale, double type_min, int * ret);
+
+#endif
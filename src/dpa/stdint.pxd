@@ -6,4 +6,5 @@ cdef extern from "stdint.h" nogil:
 	ctypedef unsigned int uint8_t
 	ctypedef unsigned int uint16_t
 	ctypedef unsigned int uint32_t
-	ctypedef unsigned int uint64_t 
+	ctypedef unsigned int uint64_t
+	ctypedef unsigned long uintptr_t
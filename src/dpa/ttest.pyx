@@ -0,0 +1,191 @@
+# Author: Hagen Fritsch, 2010
+# Licensed under the terms of the GNU-GPL-3.0
+
+"""
+Welch's t-test for leakage assessment (TVLA).
+
+A :class:`TTest` sorts traces into two groups (e.g. the traces of a fixed and
+of random inputs) and updates the mean and the central moments of each sample
+in a single pass. :meth:`TTest.t` computes the t-statistic of the first up to
+the third order at any time.
+
+>>> from preprocessor import buffer_from_list, types
+>>> t = TTest(3)
+>>> for x in ([1, 5, 2], [2, 7, 2], [3, 6, 2]): t.add_trace(buffer_from_list(types.uint8_t, x), 0)
+>>> for x in ([1, 1, 2], [2, 2, 3], [3, 0, 2]): t.add_trace(buffer_from_list(types.uint8_t, x), 1)
+>>> t.counts()
+(3, 3)
+>>> print t.t()
+[0.0, 7.5, -1.2247449159622192]
+"""
+
+from libc.string cimport memcpy
+from stdint cimport *
+from preprocessor cimport Buffer, _contiguous
+from preprocessor import types, new_buffer, scale
+from threading import Lock
+from thread import get_ident
+from warnings import warn
+
+cdef extern from "moments.h" nogil:
+	enum:
+		MOMENTS_MAX_ORDER
+
+	void moments_add(double * m, size_t rows, size_t stride, float * in_buf, size_t len, size_t count)
+	void moments_merge(double * m, double * m_b, size_t rows, size_t len, size_t count, size_t count_b)
+	void moments_ttest(float * out, double * a, size_t count_a, double * b, size_t count_b,
+	                   size_t len, int order)
+
+#: the highest order of the t-tests
+MAX_ORDER = MOMENTS_MAX_ORDER
+
+cdef class _Groups:
+	"the moments of both groups"
+	cdef list m
+	cdef size_t count[2]
+	cdef object lock
+	def __init__(self, size_t length):
+		self.m = [new_buffer(length, types.double), new_buffer(length, types.double)]
+		self.count[0] = self.count[1] = 0
+		self.lock = Lock()
+	cdef merge(self, _Groups other, size_t rows, size_t size):
+		"adds the moments of *other*, whose lock has to be held by the caller"
+		cdef int g
+		cdef Buffer m, m_b
+		for g in range(2):
+			m, m_b = self.m[g], other.m[g]
+			with nogil:
+				moments_merge(<double *> m.buf, <double *> m_b.buf, rows, size, self.count[g], other.count[g])
+			self.count[g] += other.count[g]
+
+cdef class TTest:
+	"""
+	TTest(size, order=1)
+
+	accumulates two groups of traces of *size* samples for the t-tests up to
+	the given *order* (at most :data:`MAX_ORDER`)
+
+	Like the :class:`dpa.preprocessor.AverageCounter` each thread updates its
+	own moments, which are combined when the t-statistic is requested.
+	"""
+	cdef readonly size_t size
+	cdef readonly int order
+	cdef size_t rows
+	cdef dict shards
+	cdef object lock
+	def __init__(self, size_t size, int order=1):
+		if order < 1 or order > MOMENTS_MAX_ORDER:
+			raise Exception("the order of the t-test must be between 1 and %d" % MOMENTS_MAX_ORDER)
+		self.size = size
+		self.order = order
+		self.rows = 2 * order
+		self.shards = {}
+		self.lock = Lock()
+	cdef _Groups _shard(self):
+		"returns the moments updated by the calling thread"
+		cdef long thread = get_ident()
+		s = self.shards.get(thread)
+		if s is None:
+			s = _Groups(self.rows * self.size)
+			self.lock.acquire()
+			self.shards[thread] = s
+			self.lock.release()
+		return s
+	cdef _Groups _combined(self):
+		"returns the moments of all traces processed so far"
+		cdef _Groups total = _Groups(self.rows * self.size), s
+		self.lock.acquire()
+		shards = self.shards.values()
+		self.lock.release()
+		for s in shards:
+			s.lock.acquire()
+			total.merge(s, self.rows, self.size)
+			s.lock.release()
+		return total
+	def add_trace(self, Buffer buf, int group, int length=0):
+		"""
+		add_trace(buf, group, length=0)
+
+		adds the :class:`dpa.preprocessor.Buffer` *buf* to the *group* 0 or 1
+		"""
+		buf = _contiguous(buf)
+		if group not in (0, 1):
+			raise Exception("invalid group %d" % group)
+		if length == 0:
+			length = buf.length
+		if length > self.size:
+			raise Exception("trace with len %d excceds ttest capacity of %d" % (length, self.size))
+		if length > buf.length:
+			raise Exception("cannot force a buffer to be longer than it is")
+		if length != self.size:
+			warn("processing incomplete trace, this may derange the result")
+		if buf.type != types.float:
+			buf = scale(buf, 1, dst_type=types.float)
+		cdef _Groups s = self._shard()
+		cdef Buffer m = s.m[group]
+		s.lock.acquire() #only contended while the result is computed
+		s.count[group] += 1
+		with nogil:
+			moments_add(<double *> m.buf, self.rows, self.size, <float *> buf.buf, length, s.count[group])
+		s.lock.release()
+
+	def t(self, int order=1):
+		"""
+		t(order=1) -> :class:`dpa.preprocessor.Buffer`
+
+		returns the t-statistic of the given *order* for each sample as float buffer
+		"""
+		if order < 1 or order > self.order:
+			raise Exception("the t-test of order %d has not been accumulated" % order)
+		cdef _Groups total = self._combined()
+		if total.count[0] < 2 or total.count[1] < 2:
+			raise Exception("each group needs at least two traces")
+		cdef Buffer out = new_buffer(self.size, types.float), a = total.m[0], b = total.m[1]
+		with nogil:
+			moments_ttest(<float *> out.buf, <double *> a.buf, total.count[0],
+			              <double *> b.buf, total.count[1], self.size, order)
+		return out
+	def counts(self):
+		"returns the number of traces of both groups"
+		cdef _Groups s
+		cdef size_t a = 0, b = 0
+		self.lock.acquire()
+		for s in self.shards.values():
+			a += s.count[0]
+			b += s.count[1]
+		self.lock.release()
+		return a, b
+	def __len__(self):
+		"returns the number of traces already processed"
+		return sum(self.counts())
+	def merge(self, TTest other):
+		"""
+		merge(other)
+
+		adds the traces accumulated by the :class:`TTest` *other*, which must
+		have the same size and order
+		"""
+		if other.size != self.size or other.order != self.order:
+			raise Exception("cannot merge t-tests of different size or order")
+		cdef _Groups total = other._combined()
+		cdef _Groups s = self._shard()
+		s.lock.acquire()
+		s.merge(total, self.rows, self.size)
+		s.lock.release()
+	def __reduce__(self):
+		cdef _Groups total = self._combined()
+		return (_ttest, (self.size, self.order, total.count[0], total.count[1],
+			memoryview(total.m[0]).tobytes(), memoryview(total.m[1]).tobytes()))
+
+def _ttest(size, order, count_a, count_b, moments_a, moments_b):
+	"restores a pickled :class:`TTest`"
+	cdef TTest t = TTest(size, order)
+	cdef size_t length = t.rows * size * sizeof(double)
+	if len(moments_a) != length or len(moments_b) != length:
+		raise Exception("invalid t-test state")
+	cdef _Groups s = t._shard()
+	cdef Buffer a = s.m[0], b = s.m[1]
+	memcpy(a.buf, <char *> moments_a, length)
+	memcpy(b.buf, <char *> moments_b, length)
+	s.count[0], s.count[1] = count_a, count_b
+	return t